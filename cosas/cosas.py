@@ -91,26 +91,9 @@ class TodoStore(object):
         if not tags:
             # No tags specified, so return all tasks.
             return self.get_all_tasks()
-        # Get all tasks for the first tag.
-        results = dict(
-            (doc.doc_id, doc) for doc in
-            self.db.get_from_index(TAGS_INDEX, tags[0]))
-        # Now loop over the rest of the tags (if any) and remove from the
-        # results any document that does not have that particular tag.
-        for tag in tags[1:]:
-            # Get the ids of all documents with this tag.
-            ids = [
-                doc.doc_id for doc in self.db.get_from_index(TAGS_INDEX, tag)]
-            for key in results.keys():
-                if key not in ids:
-                    # Remove the document from result, because it does not have
-                    # this particular tag.
-                    del results[key]
-                    if not results:
-                        # If results is empty, we're done: there are no
-                        # documents with all tags.
-                        return []
-        return results.values()
+        # Let the database find the tasks that have every tag.
+        return self.db.get_from_index_intersection(
+            [(TAGS_INDEX, tag) for tag in tags])
 
     def get_task(self, doc_id):
         """Get a task from the database."""
@@ -59,12 +59,17 @@ typedef struct _u1query u1query;
 typedef int (*u1db_doc_callback)(void *context, u1db_document *doc);
 typedef int (*u1db_key_callback)(void *context, int num_fields,
                                  const char **key);
+typedef int (*u1db_typed_key_callback)(void *context, int num_fields,
+                                       const char **key,
+                                       const int *is_integer);
 typedef int (*u1db_doc_gen_callback)(void *context, u1db_document *doc,
                                      int gen, const char *trans_id);
+typedef int (*u1db_doc_id_callback)(void *context, const char *doc_id);
 typedef int (*u1db_doc_id_gen_callback)(void *context, const char *doc_id,
                                         int gen);
 typedef int (*u1db_trans_info_callback)(void *context, const char *doc_id,
                                         int gen, const char *trans_id);
+typedef int (*u1db_id_allocator)(void *context, char *id);
 
 #define U1DB_OK 0
 #define U1DB_INVALID_PARAMETER -1
@@ -106,6 +111,10 @@ typedef int (*u1db_trans_info_callback)(void *context, const char *doc_id,
 
 /**
  * The basic constructor for a new connection.
+ *
+ * Databases with an older sql_schema are upgraded. Returns NULL if the
+ * database can not be opened, which includes the ones with a newer
+ * sql_schema than this library knows.
  */
 u1database *u1db_open(const char *fname);
 
@@ -126,6 +135,31 @@ int u1db_set_replica_uid(u1database *db, const char *replica_uid);
  */
 int u1db_set_document_size_limit(u1database *db, int limit);
 
+/**
+ * Set how the ids of new documents and transactions are made.
+ *
+ * New databases default to u1db_time_ordered_id, databases created before it
+ * existed keep using u1db_random_id.
+ *
+ * @param context Will be passed to allocator.
+ * @param allocator Called to write the 32 unique hex digits of a new id to
+ *                  its id argument. It returns a status code.
+ */
+int u1db_set_id_allocator(u1database *db, void *context,
+                          u1db_id_allocator allocator);
+
+/**
+ * An id allocator making the hex digits of a random uuid.
+ */
+int u1db_random_id(void *context, char *id);
+
+/**
+ * An id allocator making hex digits that sort in the order they were made.
+ *
+ * This keeps inserts local in the database indexes.
+ */
+int u1db_time_ordered_id(void *context, char *id);
+
 /**
  * Get the replica_uid defined for this database.
  *
@@ -160,6 +194,42 @@ int u1db_create_doc_from_json(u1database *db, const char *json,
  */
 int u1db_put_doc(u1database *db, u1db_document *doc);
 
+/**
+ * Put new content for many documents in a single transaction.
+ *
+ * Each document is checked as u1db_put_doc would check it. The documents
+ * that fail those checks are skipped, the others are all stored together.
+ *
+ * @param n_docs The number of documents being passed.
+ * @param docs (IN/OUT) The documents to store. The revision of each stored
+ *             document will be updated to point at its new revision.
+ * @param statuses (OUT) An array of n_docs status codes, set to U1DB_OK for
+ *                 the documents that were stored, and to the reason why
+ *                 the others were not.
+ * @return U1DB_OK unless the transaction itself failed, in which case none
+ *         of the documents have been stored, their revisions are left
+ *         unchanged, and the statuses of the documents that passed their
+ *         checks or were not reached are set to the returned status.
+ */
+int u1db_put_docs(u1database *db, int n_docs, u1db_document **docs,
+                  int *statuses);
+
+/**
+ * Create many new documents in a single transaction.
+ *
+ * A new doc_id is generated for each document. Either all the documents are
+ * stored, or none of them are.
+ *
+ * @param n_docs The number of documents to create.
+ * @param jsons The JSON strings of the new documents.
+ * @param docs (OUT) An array of n_docs NULL pointers, each will be set to a
+ *             u1db_document that needs to be freed with u1db_free_doc. They
+ *             are left NULL if any of the documents could not be stored.
+ * @return a status code indicating success or failure.
+ */
+int u1db_create_docs(u1database *db, int n_docs, const char **jsons,
+                     u1db_document **docs);
+
 /**
  * Mark conflicts as having been resolved.
  * @param doc (IN/OUT) The new content. doc->doc_rev will be updated with the
@@ -432,6 +502,31 @@ int u1db_get_from_index_list(u1database *db, u1query *query, void *context,
 int u1db_get_from_index(u1database *db, u1query *query, void *context,
                         u1db_doc_callback cb, int n_values, ...);
 
+/**
+ * Get the ids of the documents which match a given index.
+ *
+ * Only the index is read, not the documents. Each doc_id is passed to cb once.
+ *
+ * @param query A u1query object, as created by u1db_query_init.
+ * @param context Will be returned via the doc_id callback
+ * @param n_values The number of parameters being passed, must be >= 1
+ * @param values The values to match in the index.
+ */
+int u1db_get_doc_ids_from_index_list(u1database *db, u1query *query,
+                                     void *context, u1db_doc_id_callback cb,
+                                     int n_values, const char **values);
+
+/**
+ * Count the documents which match a given index.
+ *
+ * @param query A u1query object, as created by u1db_query_init.
+ * @param n_values The number of parameters being passed, must be >= 1
+ * @param values The values to match in the index.
+ * @param count (OUT) The number of distinct matching documents.
+ */
+int u1db_count_from_index_list(u1database *db, u1query *query, int n_values,
+                               const char **values, int *count);
+
 /**
  * Get documents with key values in the specified range
  *
@@ -455,6 +550,16 @@ int u1db_get_range_from_index(u1database *db, u1query *query,
 int u1db_get_index_keys(u1database *db, char *index_name, void *context,
                         u1db_key_callback cb);
 
+/**
+ * Get keys under which documents are indexed, telling which are integers.
+ *
+ * The values of number() and bool() expressions are integers, given as
+ * text like the other values; cb is also given whether each field of the
+ * key is an integer.
+ */
+int u1db_get_typed_index_keys(u1database *db, char *index_name,
+                              void *context, u1db_typed_key_callback cb);
+
 
 /**
  * Get documents matching a single column index.
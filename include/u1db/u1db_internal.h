@@ -34,6 +34,8 @@ struct _u1database
     sqlite3 *sql_handle;
     char *replica_uid;
     int document_size_limit;
+    u1db_id_allocator id_allocator;
+    void *id_allocator_context;
 };
 
 struct _u1query {
@@ -402,6 +404,15 @@ int u1db__process_doc(u1database *db, sqlite3_stmt *statement,
  */
 int u1db__generate_hex_uuid(char *uuid);
 
+/**
+ * Generate a unique id that sorts after the ids generated before it.
+ *
+ * 12 hex digits of milliseconds since the epoch, followed by 20 random ones.
+ *
+ * @param id A buffer to put the id, must be 32 bytes long.
+ */
+int u1db__generate_time_ordered_hex_id(char *id);
+
 
 /**
  * Format a given query.
@@ -446,6 +457,15 @@ int u1db__format_range_query(int n_fields, const char **start_values,
  */
 int u1db__format_index_keys_query(int n_fields, char **buf);
 
+/**
+ * Register the SQL functions used by the sql_schema upgrades.
+ *
+ * u1db_typed_index_value(field, value) returns the values of number() and
+ * bool() expressions that sql_schema 7 stored as text as integers, and the
+ * other values as they are.
+ */
+int u1db__create_functions(u1database *db);
+
 /**
  * Given this document content, update the indexed fields in the db.
  */
@@ -38,10 +38,14 @@ typedef struct _u1db_document_internal
     int generation; // Part of the sync api
 } u1db_document_internal;
 
+// The sql_schema created by dbschema.sql, which is shared with the Python
+// backends. Older databases are upgraded, newer ones are refused.
+#define U1DB__SQL_SCHEMA 8
+
 
 static int increment_doc_rev(u1database *db, const char *cur_rev,
                              char **doc_rev);
-static int generate_transaction_id(char buf[35]);
+static int generate_transaction_id(u1database *db, char buf[35]);
 
 static int
 initialize(u1database *db)
@@ -50,6 +54,13 @@ initialize(u1database *db)
     int i, status, final_status;
     char default_replica_uid[33] = {'\0'};
 
+    // This only has an effect before the first table is created, and can
+    // not be done inside a transaction.
+    status = sqlite3_exec(db->sql_handle, "PRAGMA auto_vacuum = INCREMENTAL",
+                          NULL, NULL, NULL);
+    if (status != SQLITE_OK) {
+        return status;
+    }
     status = sqlite3_exec(db->sql_handle, "BEGIN EXCLUSIVE", NULL, NULL, NULL);
     if (status != SQLITE_OK) {
         return status;
@@ -96,6 +107,175 @@ rollback:
     return status;
 }
 
+// New databases are created with time ordered ids, the ones created before
+// those existed keep random ids.
+static void
+load_id_allocator(u1database *db)
+{
+    sqlite3_stmt *statement;
+    const char *allocator;
+    int status;
+
+    db->id_allocator = u1db_random_id;
+    db->id_allocator_context = NULL;
+    status = sqlite3_prepare_v2(db->sql_handle,
+        "SELECT value FROM u1db_config WHERE name = 'id_allocator'", -1,
+        &statement, NULL);
+    if (status != SQLITE_OK) {
+        return;
+    }
+    status = sqlite3_step(statement);
+    if (status == SQLITE_ROW) {
+        allocator = (const char *)sqlite3_column_text(statement, 0);
+        if (allocator != NULL && strcmp(allocator, "time_ordered") == 0) {
+            db->id_allocator = u1db_time_ordered_id;
+        }
+    }
+    sqlite3_finalize(statement);
+}
+
+static int
+get_sql_schema(u1database *db, int *version)
+{
+    sqlite3_stmt *statement;
+    int status;
+
+    status = sqlite3_prepare_v2(db->sql_handle,
+        "SELECT value FROM u1db_config WHERE name = 'sql_schema'", -1,
+        &statement, NULL);
+    if (status != SQLITE_OK) {
+        return status;
+    }
+    status = sqlite3_step(statement);
+    if (status == SQLITE_ROW) {
+        *version = sqlite3_column_int(statement, 0);
+        status = U1DB_OK;
+    } else if (status == SQLITE_DONE) {
+        status = U1DB_INVALID_PARAMETER;
+    }
+    sqlite3_finalize(statement);
+    return status;
+}
+
+// The statements upgrading a database from a given sql_schema version to
+// the next one, as in SQLiteDatabase._sql_schema_upgrades. Each list ends
+// with NULL.
+static const char *upgrade_from_0[] = {
+    "CREATE INDEX IF NOT EXISTS document_fields_doc_id_idx"
+    " ON document_fields(doc_id)",
+    NULL};
+static const char *upgrade_from_1[] = {
+    "ALTER TABLE document ADD COLUMN"
+    " has_conflicts INTEGER NOT NULL DEFAULT 0",
+    "UPDATE document SET has_conflicts = 1"
+    " WHERE doc_id IN (SELECT doc_id FROM conflicts)",
+    NULL};
+static const char *upgrade_from_2[] = {
+    "CREATE TABLE document_changes (doc_id TEXT PRIMARY KEY,"
+    " last_generation INTEGER NOT NULL, last_trans_id TEXT NOT NULL)",
+    "CREATE INDEX document_changes_generation_idx"
+    " ON document_changes(last_generation)",
+    "INSERT OR REPLACE INTO document_changes"
+    " SELECT doc_id, generation, transaction_id FROM transaction_log"
+    " ORDER BY generation",
+    NULL};
+static const char *upgrade_from_3[] = {
+    "CREATE TABLE index_builds (name TEXT, offset INT, field TEXT,"
+    " CONSTRAINT index_builds_pkey PRIMARY KEY (name, offset))",
+    NULL};
+// The digests are left NULL, as for the documents written here; the Python
+// backends compute the missing ones when they need them.
+static const char *upgrade_from_4[] = {
+    "ALTER TABLE document ADD COLUMN content_digest TEXT",
+    "ALTER TABLE conflicts ADD COLUMN content_digest TEXT",
+    NULL};
+static const char *upgrade_from_5[] = {
+    "CREATE TABLE replica_dictionary ("
+    " replica_id INTEGER PRIMARY KEY,"
+    " replica_uid TEXT NOT NULL UNIQUE)",
+    NULL};
+static const char *upgrade_from_6[] = {
+    "CREATE TABLE retired_replicas (replica_uid TEXT PRIMARY KEY)",
+    NULL};
+// The values of number() and bool() are stored as integers.
+static const char *upgrade_from_7[] = {
+    "CREATE TABLE typed_document_fields (doc_id TEXT NOT NULL,"
+    " field_name TEXT NOT NULL, value)",
+    "INSERT INTO typed_document_fields SELECT doc_id, field_name,"
+    " u1db_typed_index_value(field_name, value) FROM document_fields",
+    "DROP TABLE document_fields",
+    "ALTER TABLE typed_document_fields RENAME TO document_fields",
+    "CREATE INDEX document_fields_field_value_doc_idx"
+    " ON document_fields(field_name, value, doc_id)",
+    "CREATE INDEX document_fields_doc_id_idx"
+    " ON document_fields(doc_id)",
+    NULL};
+static const char **schema_upgrades[U1DB__SQL_SCHEMA] = {
+    upgrade_from_0, upgrade_from_1, upgrade_from_2, upgrade_from_3,
+    upgrade_from_4, upgrade_from_5, upgrade_from_6, upgrade_from_7};
+
+// Bring the database up to U1DB__SQL_SCHEMA, refusing newer ones.
+static int
+upgrade_schema(u1database *db)
+{
+    int status, version, i;
+    char version_str[16];
+    sqlite3_stmt *statement = NULL;
+
+    status = get_sql_schema(db, &version);
+    if (status != U1DB_OK) {
+        return status;
+    }
+    if (version > U1DB__SQL_SCHEMA) {
+        return U1DB_INVALID_PARAMETER;
+    }
+    if (version == U1DB__SQL_SCHEMA) {
+        return U1DB_OK;
+    }
+    status = sqlite3_exec(db->sql_handle, "BEGIN EXCLUSIVE", NULL, NULL, NULL);
+    if (status != SQLITE_OK) {
+        return status;
+    }
+    // Another connection may have upgraded it in the meantime.
+    status = get_sql_schema(db, &version);
+    if (status != U1DB_OK) {
+        goto rollback;
+    }
+    for (; version < U1DB__SQL_SCHEMA; version++) {
+        for (i = 0; schema_upgrades[version][i] != NULL; i++) {
+            status = sqlite3_exec(db->sql_handle,
+                schema_upgrades[version][i], NULL, NULL, NULL);
+            if (status != SQLITE_OK) {
+                goto rollback;
+            }
+        }
+    }
+    snprintf(version_str, sizeof(version_str), "%d", version);
+    status = sqlite3_prepare_v2(db->sql_handle,
+        "UPDATE u1db_config SET value = ? WHERE name = 'sql_schema'", -1,
+        &statement, NULL);
+    if (status != SQLITE_OK) {
+        goto rollback;
+    }
+    status = sqlite3_bind_text(statement, 1, version_str, -1,
+                               SQLITE_TRANSIENT);
+    if (status == SQLITE_OK) {
+        status = sqlite3_step(statement);
+    }
+    sqlite3_finalize(statement);
+    if (status != SQLITE_DONE) {
+        goto rollback;
+    }
+    status = sqlite3_exec(db->sql_handle, "COMMIT", NULL, NULL, NULL);
+    if (status != SQLITE_OK) {
+        goto rollback;
+    }
+    return U1DB_OK;
+rollback:
+    sqlite3_exec(db->sql_handle, "ROLLBACK", NULL, NULL, NULL);
+    return status;
+}
+
 u1database *
 u1db_open(const char *fname)
 {
@@ -109,7 +289,18 @@ u1db_open(const char *fname)
     }
     // TODO: surely this is not right? We should get the db sqlite, and only if
     // that fails because it's not there, should we initialize?!?
+    status = u1db__create_functions(db);
+    if (status != SQLITE_OK) {
+        u1db_free(&db);
+        return NULL;
+    }
     initialize(db);
+    status = upgrade_schema(db);
+    if (status != U1DB_OK) {
+        u1db_free(&db);
+        return NULL;
+    }
+    load_id_allocator(db);
     return db;
 }
 
@@ -137,6 +328,8 @@ u1db__copy(u1database *db)
         return NULL;
     }
     sqlite3_backup_finish(backup);
+    new_db->id_allocator = db->id_allocator;
+    new_db->id_allocator_context = db->id_allocator_context;
     u1db_set_replica_uid(new_db, db->replica_uid);
     u1db_set_document_size_limit(db, 0);
     return new_db;
@@ -452,7 +645,8 @@ write_doc(u1database *db, const char *doc_id, const char *doc_rev,
 
     if (is_update) {
         status = sqlite3_prepare_v2(db->sql_handle,
-            "UPDATE document SET doc_rev = ?, content = ? WHERE doc_id = ?", -1,
+            "UPDATE document SET doc_rev = ?, content = ?,"
+            " content_digest = NULL WHERE doc_id = ?", -1,
             &statement, NULL);
         if (status != SQLITE_OK) { goto finish; }
         status = delete_old_fields(db, doc_id);
@@ -482,7 +676,7 @@ write_doc(u1database *db, const char *doc_id, const char *doc_rev,
     if (status != SQLITE_OK) { goto finish; }
     status = u1db__update_indexes(db, doc_id, content);
     if (status != U1DB_OK) { goto finish; }
-    status = generate_transaction_id(transaction_id);
+    status = generate_transaction_id(db, transaction_id);
     if (status != U1DB_OK) { goto finish; }
     sqlite3_finalize(statement);
     status = sqlite3_prepare_v2(db->sql_handle,
@@ -495,6 +689,21 @@ write_doc(u1database *db, const char *doc_id, const char *doc_rev,
                                SQLITE_TRANSIENT);
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_step(statement);
+    if (status != SQLITE_DONE) { goto finish; }
+    sqlite3_finalize(statement);
+    // Record this as the latest change of the document, for whats_changed.
+    status = sqlite3_prepare_v2(db->sql_handle,
+        "INSERT OR REPLACE INTO document_changes"
+        " (doc_id, last_generation, last_trans_id)"
+        " VALUES (?, last_insert_rowid(), ?)",
+        -1, &statement, NULL);
+    if (status != SQLITE_OK) { goto finish; }
+    status = sqlite3_bind_text(statement, 1, doc_id, -1, SQLITE_TRANSIENT);
+    if (status != SQLITE_OK) { goto finish; }
+    status = sqlite3_bind_text(statement, 2, transaction_id, -1,
+                               SQLITE_TRANSIENT);
+    if (status != SQLITE_OK) { goto finish; }
+    status = sqlite3_step(statement);
     if (status == SQLITE_DONE) {
         status = SQLITE_OK;
     }
@@ -567,6 +776,32 @@ finish:
 }
 
 
+// Keep document.has_conflicts in step with the rows in conflicts.
+static int
+update_conflict_flag(u1database *db, const char *doc_id)
+{
+    sqlite3_stmt *statement;
+    int status;
+
+    status = sqlite3_prepare_v2(db->sql_handle,
+        "UPDATE document SET has_conflicts = EXISTS (SELECT 1 FROM conflicts"
+        " WHERE conflicts.doc_id = document.doc_id) WHERE doc_id = ?", -1,
+        &statement, NULL);
+    if (status != SQLITE_OK) {
+        return status;
+    }
+    status = sqlite3_bind_text(statement, 1, doc_id, -1, SQLITE_TRANSIENT);
+    if (status != SQLITE_OK) { goto finish; }
+    status = sqlite3_step(statement);
+    if (status == SQLITE_DONE) {
+        status = SQLITE_OK;
+    }
+finish:
+    sqlite3_finalize(statement);
+    return status;
+}
+
+
 // Add a conflict for this doc
 static int
 write_conflict(u1database *db, const char *doc_id, const char *doc_rev,
@@ -576,7 +811,8 @@ write_conflict(u1database *db, const char *doc_id, const char *doc_rev,
     int status;
 
     status = sqlite3_prepare_v2(db->sql_handle,
-        "INSERT INTO conflicts VALUES (?, ?, ?)", -1,
+        "INSERT INTO conflicts (doc_id, doc_rev, content) VALUES (?, ?, ?)",
+        -1,
         &statement, NULL);
     if (status != SQLITE_OK) {
         return status;
@@ -594,7 +830,7 @@ write_conflict(u1database *db, const char *doc_id, const char *doc_rev,
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_step(statement);
     if (status == SQLITE_DONE) {
-        status = SQLITE_OK;
+        status = update_conflict_flag(db, doc_id);
     }
 finish:
     sqlite3_finalize(statement);
@@ -616,8 +852,9 @@ u1db__check_doc_size(u1database *db, u1db_document *doc)
     return U1DB_DOCUMENT_TOO_BIG;
 }
 
-int
-u1db_put_doc(u1database *db, u1db_document *doc)
+// Check and store a single document, a transaction should already be held.
+static int
+put_doc_in_transaction(u1database *db, u1db_document *doc)
 {
     const char *old_content = NULL, *old_doc_rev = NULL;
     int status;
@@ -625,9 +862,6 @@ u1db_put_doc(u1database *db, u1db_document *doc)
     int conflicted;
     sqlite3_stmt *statement = NULL;
 
-    if (db == NULL || doc == NULL) {
-        return U1DB_INVALID_PARAMETER;
-    }
     status = u1db__is_doc_id_valid(doc->doc_id);
     if (status != U1DB_OK) {
         return status;
@@ -636,10 +870,6 @@ u1db_put_doc(u1database *db, u1db_document *doc)
     if (status != U1DB_OK) {
         return status;
     }
-    status = sqlite3_exec(db->sql_handle, "BEGIN", NULL, NULL, NULL);
-    if (status != SQLITE_OK) {
-        return status;
-    }
     status = lookup_conflict(db, doc->doc_id, &conflicted);
     if (status != U1DB_OK) { goto finish; }
     if (conflicted) {
@@ -692,6 +922,22 @@ u1db_put_doc(u1database *db, u1db_document *doc)
     }
 finish:
     sqlite3_finalize(statement);
+    return status;
+}
+
+int
+u1db_put_doc(u1database *db, u1db_document *doc)
+{
+    int status;
+
+    if (db == NULL || doc == NULL) {
+        return U1DB_INVALID_PARAMETER;
+    }
+    status = sqlite3_exec(db->sql_handle, "BEGIN", NULL, NULL, NULL);
+    if (status != SQLITE_OK) {
+        return status;
+    }
+    status = put_doc_in_transaction(db, doc);
     if (status == SQLITE_OK) {
         status = sqlite3_exec(db->sql_handle, "COMMIT", NULL, NULL, NULL);
     } else {
@@ -700,6 +946,152 @@ finish:
     return status;
 }
 
+// Is this a failure of a single document, rather than of the transaction?
+static int
+is_doc_put_error(int status)
+{
+    return (status == U1DB_INVALID_DOC_ID || status == U1DB_DOCUMENT_TOO_BIG
+            || status == U1DB_CONFLICTED || status == U1DB_REVISION_CONFLICT);
+}
+
+// Put back the revisions the documents had before a rolled back batch.
+static void
+restore_doc_revs(int n_docs, u1db_document **docs, char **old_revs)
+{
+    int i;
+
+    for (i = 0; i < n_docs; i++) {
+        if (docs[i] == NULL) {
+            continue;
+        }
+        free(docs[i]->doc_rev);
+        docs[i]->doc_rev = old_revs[i];
+        docs[i]->doc_rev_len = (old_revs[i] == NULL) ? 0 : strlen(old_revs[i]);
+        old_revs[i] = NULL;
+    }
+}
+
+// Store docs in a single transaction. If all_or_nothing is set, a document
+// failing its checks rolls back the whole batch, otherwise it is skipped.
+static int
+put_docs_in_transaction(u1database *db, int n_docs, u1db_document **docs,
+                        int *statuses, int all_or_nothing)
+{
+    char **old_revs = NULL;
+    int status = U1DB_OK, i, last = -1;
+
+    old_revs = (char **)calloc(n_docs + 1, sizeof(char *));
+    if (old_revs == NULL) {
+        status = U1DB_NOMEM;
+        goto finish;
+    }
+    for (i = 0; i < n_docs; i++) {
+        if (docs[i] == NULL || docs[i]->doc_rev == NULL) {
+            continue;
+        }
+        old_revs[i] = strdup(docs[i]->doc_rev);
+        if (old_revs[i] == NULL) {
+            status = U1DB_NOMEM;
+            goto finish;
+        }
+    }
+    status = sqlite3_exec(db->sql_handle, "BEGIN", NULL, NULL, NULL);
+    if (status != SQLITE_OK) { goto finish; }
+    for (i = 0; i < n_docs; i++) {
+        last = i;
+        if (docs[i] == NULL) {
+            statuses[i] = U1DB_INVALID_PARAMETER;
+        } else {
+            statuses[i] = put_doc_in_transaction(db, docs[i]);
+        }
+        if (statuses[i] != U1DB_OK && (all_or_nothing
+                || !is_doc_put_error(statuses[i]))) {
+            status = statuses[i];
+            break;
+        }
+    }
+    if (status == SQLITE_OK) {
+        status = sqlite3_exec(db->sql_handle, "COMMIT", NULL, NULL, NULL);
+    }
+    if (status != SQLITE_OK) {
+        sqlite3_exec(db->sql_handle, "ROLLBACK", NULL, NULL, NULL);
+        // Nothing was stored, so no document keeps its new revision.
+        restore_doc_revs(n_docs, docs, old_revs);
+    }
+finish:
+    if (status != U1DB_OK) {
+        // The documents that were not reached share the failure of the
+        // batch, as do the ones that would have been stored.
+        for (i = 0; i < n_docs; i++) {
+            if (i > last || statuses[i] == U1DB_OK) {
+                statuses[i] = status;
+            }
+        }
+    }
+    if (old_revs != NULL) {
+        for (i = 0; i < n_docs; i++) {
+            free(old_revs[i]);
+        }
+        free(old_revs);
+    }
+    return status;
+}
+
+int
+u1db_put_docs(u1database *db, int n_docs, u1db_document **docs,
+              int *statuses)
+{
+    if (db == NULL || docs == NULL || statuses == NULL || n_docs < 0) {
+        return U1DB_INVALID_PARAMETER;
+    }
+    return put_docs_in_transaction(db, n_docs, docs, statuses, 0);
+}
+
+int
+u1db_create_docs(u1database *db, int n_docs, const char **jsons,
+                 u1db_document **docs)
+{
+    char *doc_id;
+    int *statuses = NULL;
+    int status = U1DB_OK, i;
+
+    if (db == NULL || jsons == NULL || docs == NULL || n_docs < 0) {
+        return U1DB_INVALID_PARAMETER;
+    }
+    for (i = 0; i < n_docs; i++) {
+        if (jsons[i] == NULL || docs[i] != NULL) {
+            return U1DB_INVALID_PARAMETER;
+        }
+    }
+    for (i = 0; i < n_docs; i++) {
+        doc_id = u1db__allocate_doc_id(db);
+        if (doc_id == NULL) {
+            status = U1DB_INVALID_DOC_ID;
+            goto finish;
+        }
+        status = u1db__allocate_document(doc_id, NULL, jsons[i], 0, &docs[i]);
+        free(doc_id);
+        if (status != U1DB_OK) { goto finish; }
+        if (docs[i] == NULL) {
+            status = U1DB_NOMEM;
+            goto finish;
+        }
+    }
+    statuses = (int *)calloc(n_docs + 1, sizeof(int));
+    if (statuses == NULL) {
+        status = U1DB_NOMEM;
+        goto finish;
+    }
+    status = put_docs_in_transaction(db, n_docs, docs, statuses, 1);
+finish:
+    free(statuses);
+    if (status != U1DB_OK) {
+        for (i = 0; i < n_docs; i++) {
+            u1db_free_doc(&docs[i]);
+        }
+    }
+    return status;
+}
 
 static int
 find_current_doc_for_conflict(u1database *db, const char *doc_id,
@@ -791,7 +1183,7 @@ delete_conflict(u1database *db, const char *doc_id, const char *doc_rev)
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_step(statement);
     if (status == SQLITE_DONE) {
-        status = U1DB_OK;
+        status = update_conflict_flag(db, doc_id);
     }
 finish:
     sqlite3_finalize(statement);
@@ -1187,6 +1579,9 @@ u1db_get_docs(u1database *db, int n_doc_ids, const char **doc_ids,
 {
     int status, i;
     sqlite3_stmt *statement;
+    const char *revision;
+    const char *content;
+    u1db_document *doc;
 
     if (db == NULL || doc_ids == NULL || cb == NULL || n_doc_ids < 0) {
         return U1DB_INVALID_PARAMETER;
@@ -1196,9 +1591,11 @@ u1db_get_docs(u1database *db, int n_doc_ids, const char **doc_ids,
             return U1DB_INVALID_PARAMETER;
         }
     }
+    // The conflict flag is read along with the document, so each doc_id
+    // costs a single step of the one prepared statement.
     status = sqlite3_prepare_v2(db->sql_handle,
-        "SELECT doc_rev, content FROM document WHERE doc_id = ?", -1,
-        &statement, NULL);
+        "SELECT doc_rev, content, has_conflicts FROM document"
+        " WHERE doc_id = ?", -1, &statement, NULL);
     if (status != SQLITE_OK) { goto finish; }
     for (i = 0; i < n_doc_ids; ++i) {
         status = sqlite3_bind_text(statement, 1, doc_ids[i], -1,
@@ -1207,11 +1604,18 @@ u1db_get_docs(u1database *db, int n_doc_ids, const char **doc_ids,
         status = sqlite3_step(statement);
         if (status == SQLITE_ROW) {
             // We have a document
-            status = u1db__process_doc(
-                db, statement, doc_ids[i], check_for_conflicts,
-                include_deleted, context, cb);
-            if (status != U1DB_OK) {
-                goto finish;
+            revision = (char *)sqlite3_column_text(statement, 0);
+            content = (char *)sqlite3_column_text(statement, 1);
+            if (content != NULL || include_deleted) {
+                status = u1db__allocate_document(
+                    doc_ids[i], revision, content, 0, &doc);
+                if (status != U1DB_OK) {
+                    goto finish;
+                }
+                if (check_for_conflicts) {
+                    doc->has_conflicts = sqlite3_column_int(statement, 2);
+                }
+                cb(context, doc);
             }
         } else if (status == SQLITE_DONE) {
             // This document doesn't exist
@@ -1247,10 +1651,8 @@ u1db_get_all_docs(u1database *db, int include_deleted, int *generation,
     if (status != U1DB_OK)
         return status;
     status = sqlite3_prepare_v2(db->sql_handle,
-        "SELECT document.doc_id, document.doc_rev, document.content, "
-        "count(conflicts.doc_rev) FROM document LEFT OUTER JOIN conflicts ON "
-        "conflicts.doc_id = document.doc_id GROUP BY document.doc_id, "
-        "document.doc_rev, document.content", -1, &statement, NULL);
+        "SELECT doc_id, doc_rev, content, has_conflicts FROM document", -1,
+        &statement, NULL);
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_step(statement);
     while (status == SQLITE_ROW) {
@@ -1364,9 +1766,9 @@ get_last_transaction_id(u1database *db, int *gen, char **trans_id)
     sqlite3_stmt *statement;
 
     status = sqlite3_prepare_v2(db->sql_handle,
-        "SELECT generation, transaction_id"
-        " FROM transaction_log"
-        " ORDER BY generation DESC LIMIT 1",
+        "SELECT last_generation, last_trans_id"
+        " FROM document_changes"
+        " ORDER BY last_generation DESC LIMIT 1",
         -1, &statement, NULL);
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_step(statement);
@@ -1415,9 +1817,9 @@ u1db_whats_changed(u1database *db, int *gen, char **trans_id,
         return -1; // Bad parameters
     }
     status = sqlite3_prepare_v2(db->sql_handle,
-        "SELECT max(generation) as g, doc_id, transaction_id"
-        " FROM transaction_log WHERE generation > ?"
-        " GROUP BY doc_id ORDER BY g",
+        "SELECT last_generation, doc_id, last_trans_id"
+        " FROM document_changes WHERE last_generation > ?"
+        " ORDER BY last_generation",
         -1, &statement, NULL);
     if (status != SQLITE_OK) {
         return status;
@@ -1515,7 +1917,8 @@ u1db__get_generation(u1database *db, int *generation)
         return U1DB_INVALID_PARAMETER;
     }
     status = sqlite3_prepare_v2(db->sql_handle,
-        "SELECT max(generation) FROM transaction_log", -1,
+        "SELECT last_generation FROM document_changes"
+        " ORDER BY last_generation DESC LIMIT 1", -1,
         &statement, NULL);
     if (status != SQLITE_OK) {
         return status;
@@ -1586,7 +1989,8 @@ u1db__get_generation_info(u1database *db, int *generation, char **trans_id)
         return U1DB_INVALID_PARAMETER;
     }
     status = sqlite3_prepare_v2(db->sql_handle,
-        "SELECT max(generation), transaction_id FROM transaction_log", -1,
+        "SELECT last_generation, last_trans_id FROM document_changes"
+        " ORDER BY last_generation DESC LIMIT 1", -1,
         &statement, NULL);
     if (status != SQLITE_OK) {
         return status;
@@ -1596,6 +2000,10 @@ u1db__get_generation_info(u1database *db, int *generation, char **trans_id)
         // No records, we are at rev 0
         status = SQLITE_OK;
         *generation = 0;
+        *trans_id = strdup("");
+        if (*trans_id == NULL) {
+            status = U1DB_NOMEM;
+        }
     } else if (status == SQLITE_ROW) {
         status = SQLITE_OK;
         *generation = sqlite3_column_int(statement, 0);
@@ -1693,7 +2101,7 @@ u1db__allocate_doc_id(u1database *db)
     }
     buf[0] = 'D';
     buf[1] = '-';
-    status = u1db__generate_hex_uuid(&buf[2]);
+    status = db->id_allocator(db->id_allocator_context, &buf[2]);
     if (status != U1DB_OK) {
         free(buf);
         return NULL;
@@ -1702,11 +2110,23 @@ u1db__allocate_doc_id(u1database *db)
 }
 
 static int
-generate_transaction_id(char buf[35])
+generate_transaction_id(u1database *db, char buf[35])
 {
     buf[0] = 'T';
     buf[1] = '-';
-    return u1db__generate_hex_uuid(&buf[2]);
+    return db->id_allocator(db->id_allocator_context, &buf[2]);
+}
+
+int
+u1db_set_id_allocator(u1database *db, void *context,
+                      u1db_id_allocator allocator)
+{
+    if (db == NULL || allocator == NULL) {
+        return U1DB_INVALID_PARAMETER;
+    }
+    db->id_allocator = allocator;
+    db->id_allocator_context = context;
+    return U1DB_OK;
 }
 
 u1db_table *
@@ -2127,6 +2547,19 @@ finish:
     return status;
 }
 
+// Let every connection know that its cached index definitions are stale.
+static int
+bump_index_schema_version(u1database *db)
+{
+    int status;
+    status = sqlite3_exec(db->sql_handle,
+        "INSERT OR REPLACE INTO u1db_config"
+        " VALUES ('index_schema_version', COALESCE((SELECT value"
+        " FROM u1db_config WHERE name = 'index_schema_version'), 0) + 1)",
+        NULL, NULL, NULL);
+    return status;
+}
+
 int
 u1db_create_index_list(u1database *db, const char *index_name,
                        int n_expressions, const char **expressions)
@@ -2216,6 +2649,10 @@ u1db_create_index_list(u1database *db, const char *index_name,
             goto finish;
         }
     }
+    status = bump_index_schema_version(db);
+    if (status != SQLITE_OK) {
+        goto finish;
+    }
     status = u1db__index_all_docs(db, n_unique, unique_expressions);
 finish:
     if (unique_expressions != NULL) {
@@ -2276,12 +2713,14 @@ u1db_delete_index(u1database *db, const char *index_name)
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_step(statement);
     if (status != SQLITE_DONE) { goto finish; }
-    status = SQLITE_OK;
+    status = bump_index_schema_version(db);
+    if (status != SQLITE_OK) { goto finish; }
     sqlite3_finalize(statement);
     status = sqlite3_prepare_v2(
         db->sql_handle, "DELETE FROM document_fields WHERE "
         "document_fields.field_name NOT IN (SELECT field from "
-        "index_definitions)", -1, &statement, NULL);
+        "index_definitions UNION SELECT field FROM index_builds)", -1,
+        &statement, NULL);
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_step(statement);
     if (status != SQLITE_DONE) { goto finish; }
@@ -22,12 +22,23 @@
 #include <stdarg.h>
 #include <string.h>
 #include <ctype.h>
+#include <errno.h>
 #include <json/json.h>
 
 #define NO_GLOB 0
 #define IS_GLOB 1
 #define ENDS_IN_GLOB 2
 
+// What an index query returns
+#define QUERY_DOCS 0
+#define QUERY_DOC_IDS 1
+#define QUERY_COUNT 2
+
+// The values of an index expression
+#define TEXT_VALUES 0
+#define SOME_INTEGER_VALUES 1
+#define INTEGER_VALUES 2
+
 #define EXPRESSION 1
 #define INTEGER 2
 
@@ -38,9 +49,13 @@
 #endif
 
 
+// The values of number() and bool() are integers, which are stored in
+// document_fields as numbers. Their data is the integer as text.
 typedef struct string_list_item_
 {
     char *data;
+    int is_number;
+    sqlite3_int64 number;
     struct string_list_item_ *next;
 } string_list_item;
 
@@ -117,6 +132,21 @@ append(string_list *list, const char *data)
     return U1DB_OK;
 }
 
+static int
+append_number(string_list *list, sqlite3_int64 number)
+{
+    int status = U1DB_OK;
+    char string_value[MAX_INT_STR_LEN];
+
+    snprintf(string_value, MAX_INT_STR_LEN, "%lld", (long long)number);
+    status = append(list, string_value);
+    if (status != U1DB_OK)
+        return status;
+    list->tail->is_number = 1;
+    list->tail->number = number;
+    return U1DB_OK;
+}
+
 static int
 appendn(string_list *list, const char *data, int size)
 {
@@ -224,6 +254,7 @@ append_node(parse_tree *t, parse_tree *node)
     return U1DB_OK;
 }
 
+static int parse(const char *expression, parse_tree *result);
 static int parse_op(string_list *tokens, char *term, parse_tree *result);
 static int parse_term(string_list *tokens, parse_tree *result);
 typedef int(*op_function)(parse_tree *, json_object *, string_list *);
@@ -257,8 +288,7 @@ static int
 extract_value(json_object *val, int value_type, string_list *values)
 {
     int status = U1DB_OK;
-    int i, integer_value, boolean_value, length;
-    char string_value[MAX_INT_STR_LEN];
+    int i, length;
     if (json_object_is_type(val, json_type_string) && value_type ==
             json_type_string) {
         status = append(values, json_object_get_string(val));
@@ -266,19 +296,12 @@ extract_value(json_object *val, int value_type, string_list *values)
     }
     if (json_object_is_type(val, json_type_int) && value_type ==
             json_type_int) {
-        integer_value = json_object_get_int(val);
-        snprintf(string_value, MAX_INT_STR_LEN, "%d", integer_value);
-        status = append(values, string_value);
+        status = append_number(values, json_object_get_int64(val));
         goto finish;
     }
     if (json_object_is_type(val, json_type_boolean) &&
             value_type == json_type_boolean) {
-        boolean_value = json_object_get_boolean(val);
-        if (boolean_value) {
-            status = append(values, "1");
-        } else {
-            status = append(values, "0");
-        }
+        status = append_number(values, json_object_get_boolean(val) ? 1 : 0);
         goto finish;
     }
     if (json_object_is_type(val, json_type_array)) {
@@ -427,9 +450,8 @@ op_number(parse_tree *tree, json_object *obj, string_list *result)
 {
     string_list *values = NULL;
     string_list_item *item = NULL;
-    char *p = NULL, *new_value = NULL, *value = NULL, *number = NULL;
+    char *p = NULL, *number = NULL;
     parse_tree *node = NULL;
-    int count, zeroes, value_size, isnumber;
     int status = U1DB_OK;
 
     node = tree->first_child;
@@ -441,6 +463,8 @@ op_number(parse_tree *tree, json_object *obj, string_list *result)
     if (status != U1DB_OK)
         goto finish;
     node = node->next_sibling;
+    // The second argument used to be the width numbers were zero padded to.
+    // It is still checked, but numbers are stored as integers now.
     number = node->data;
     for (p = number; *p; p++) {
         if (isdigit(*p) == 0) {
@@ -448,40 +472,10 @@ op_number(parse_tree *tree, json_object *obj, string_list *result)
             goto finish;
         }
     }
-    zeroes = atoi(number);
     for (item = values->head; item != NULL; item = item->next)
     {
-        value = item->data;
-        isnumber = 1;
-        for (p = value; *p; p++) {
-            if (isdigit(*p) == 0) {
-                isnumber = 0;
-                break;
-            }
-        }
-        if (isnumber == 0) {
-            continue;
-        }
-        value_size = max(strlen(value), zeroes) + 1;
-        new_value = (char *)calloc(value_size, 1);
-        if (new_value == NULL)
-        {
-            status = U1DB_NOMEM;
-            goto finish;
-        }
-        count = snprintf(new_value, value_size, "%0*d", zeroes, atoi(value));
-        if (count != (value_size - 1)) {
-            // Most likely encoding issues.
-            status = U1DB_INVALID_PARAMETER;
-            free(new_value);
-            goto finish;
-        }
-        if ((status = append(result, new_value)) != U1DB_OK)
-        {
-            free(new_value);
+        if ((status = append_number(result, item->number)) != U1DB_OK)
             goto finish;
-        }
-        free(new_value);
     }
 finish:
     if (values != NULL)
@@ -558,22 +552,16 @@ op_bool(parse_tree *tree, json_object *obj, string_list *result)
     status = init_list(&values);
     if (status != U1DB_OK)
         return status;
-    status = get_values(tree->first_child, obj, values);
-    if (status != U1DB_OK)
-        goto finish;
-    //just return all the strings which have been filtered and converted from
+    //just return all the integers which have been filtered and converted from
     //booleans by extract_field_values.
-
     status = extract_field_values(
         obj, tree->first_child->field_path->head, json_type_boolean, values);
     if (status != U1DB_OK)
         goto finish;
     for (item = values->head; item != NULL; item = item->next)
     {
-        if ((status = append(result, item->data)) != U1DB_OK)
-        {
-            return status;
-        }
+        if ((status = append_number(result, item->number)) != U1DB_OK)
+            goto finish;
     }
 finish:
     if (values != NULL)
@@ -696,52 +684,186 @@ finish:
     return status;
 }
 
-int
-u1db_get_from_index_list(u1database *db, u1query *query, void *context,
-                         u1db_doc_callback cb, int n_values,
-                         const char **values)
+static int format_query(int n_fields, const char **values, char **buf,
+                        int *wildcard, int query_type,
+                        const int *value_kinds);
+
+// What the values of a parsed index expression are: number() and bool()
+// only have integers, combine() has integers if any of its parts does.
+static int
+get_value_kind(parse_tree *tree)
+{
+    parse_tree *node = NULL;
+    int n_text = 0, n_integer = 0;
+
+    if (tree->op == (void *)op_number || tree->op == (void *)op_bool)
+        return INTEGER_VALUES;
+    if (tree->op != (void *)op_combine)
+        return TEXT_VALUES;
+    for (node = tree->first_child; node != NULL; node = node->next_sibling) {
+        switch (get_value_kind(node)) {
+        case TEXT_VALUES:
+            n_text++;
+            break;
+        case INTEGER_VALUES:
+            n_integer++;
+            break;
+        default:
+            return SOME_INTEGER_VALUES;
+        }
+    }
+    if (n_integer == 0)
+        return TEXT_VALUES;
+    if (n_text == 0)
+        return INTEGER_VALUES;
+    return SOME_INTEGER_VALUES;
+}
+
+static int
+get_expression_value_kind(const char *expression, int *kind)
+{
+    int status = U1DB_OK;
+    parse_tree *tree = NULL;
+
+    status = init_parse_tree(&tree);
+    if (status != U1DB_OK)
+        goto finish;
+    status = parse(expression, tree);
+    if (status != U1DB_OK)
+        goto finish;
+    *kind = get_value_kind(tree);
+finish:
+    destroy_parse_tree(tree);
+    return status;
+}
+
+// Is value the text of an integer, as queries give the values of number()
+// and bool()?
+static int
+is_integer(const char *value)
+{
+    if (*value == '-')
+        value++;
+    if (*value == '\0')
+        return 0;
+    for (; *value != '\0'; value++) {
+        if (!isdigit(*value))
+            return 0;
+    }
+    return 1;
+}
+
+// Look up what the values of each field of query are, and check that
+// values only gives integers and '*' for the fields with only integers.
+static int
+check_index_values(u1query *query, const char **values, int *value_kinds)
+{
+    int i, status = U1DB_OK;
+
+    for (i = 0; i < query->num_fields; ++i) {
+        status = get_expression_value_kind(query->fields[i], &value_kinds[i]);
+        if (status != U1DB_OK)
+            return status;
+        if (values == NULL || values[i] == NULL ||
+                value_kinds[i] != INTEGER_VALUES)
+            continue;
+        if (strcmp(values[i], "*") != 0 && !is_integer(values[i]))
+            return U1DB_INVALID_VALUE_FOR_INDEX;
+    }
+    return U1DB_OK;
+}
+
+// Bind a value of an index query. number() and bool() store integers, so
+// the integers given for those are bound as integers.
+static int
+bind_index_value(sqlite3_stmt *statement, int bind_arg, int value_kind,
+                 const char *value)
+{
+    sqlite3_int64 number;
+    char *end = NULL;
+
+    if (value_kind != TEXT_VALUES && is_integer(value)) {
+        errno = 0;
+        number = strtoll(value, &end, 10);
+        // Integers that do not fit in 64 bits are never indexed.
+        if (*end == '\0' && errno != ERANGE)
+            return sqlite3_bind_int64(statement, bind_arg, number);
+    }
+    return sqlite3_bind_text(statement, bind_arg, value, -1,
+                             SQLITE_TRANSIENT);
+}
+
+// Prepare the statement for an index query returning query_type.
+static int
+prepare_index_query(u1database *db, u1query *query, int n_values,
+                    const char **values, int query_type,
+                    sqlite3_stmt **statement)
 {
     int status = U1DB_OK;
-    sqlite3_stmt *statement = NULL;
     char *query_str = NULL;
     int i, bind_arg;
     int wildcard[20] = {0};
+    int value_kinds[20] = {0};
 
-    if (db == NULL || query == NULL || cb == NULL || n_values < 0)
-    {
-        return U1DB_INVALID_PARAMETER;
-    }
     if (query->num_fields != n_values) {
         return U1DB_INVALID_VALUE_FOR_INDEX;
     }
     if (n_values > 20) {
         return U1DB_NOT_IMPLEMENTED;
     }
-    status = u1db__format_query(
-        query->num_fields, values, &query_str, wildcard);
+    status = check_index_values(query, values, value_kinds);
+    if (status != U1DB_OK) { goto finish; }
+    status = format_query(query->num_fields, values, &query_str, wildcard,
+                          query_type, value_kinds);
     if (status != U1DB_OK) { goto finish; }
     status = sqlite3_prepare_v2(db->sql_handle, query_str, -1,
-                                &statement, NULL);
+                                statement, NULL);
     if (status != SQLITE_OK) { goto finish; }
     // Bind all of the 'field_name' parameters. sqlite_bind starts at 1
     bind_arg = 1;
     for (i = 0; i < query->num_fields; ++i) {
-        status = sqlite3_bind_text(statement, bind_arg, query->fields[i], -1,
+        status = sqlite3_bind_text(*statement, bind_arg, query->fields[i], -1,
                                    SQLITE_TRANSIENT);
         bind_arg++;
         if (status != SQLITE_OK) { goto finish; }
         if (wildcard[i] == NO_GLOB) {
             // Not a wildcard, so add the argument
-            status = sqlite3_bind_text(statement, bind_arg, values[i], -1,
-                                       SQLITE_TRANSIENT);
+            status = bind_index_value(*statement, bind_arg, value_kinds[i],
+                                      values[i]);
             bind_arg++;
         } else if (wildcard[i] == ENDS_IN_GLOB) {
-            status = sqlite3_bind_text(statement, bind_arg, values[i], -1,
+            status = sqlite3_bind_text(*statement, bind_arg, values[i], -1,
                                        SQLITE_TRANSIENT);
             bind_arg++;
         }
         if (status != SQLITE_OK) { goto finish; }
     }
+finish:
+    if (status != SQLITE_OK) {
+        sqlite3_finalize(*statement);
+        *statement = NULL;
+    }
+    if (query_str != NULL) {
+        free(query_str);
+    }
+    return status;
+}
+
+int
+u1db_get_from_index_list(u1database *db, u1query *query, void *context,
+                         u1db_doc_callback cb, int n_values,
+                         const char **values)
+{
+    int status = U1DB_OK;
+    sqlite3_stmt *statement = NULL;
+
+    if (db == NULL || query == NULL || cb == NULL || n_values < 0)
+    {
+        return U1DB_INVALID_PARAMETER;
+    }
+    status = prepare_index_query(db, query, n_values, values, QUERY_DOCS,
+                                 &statement);
+    if (status != U1DB_OK) { goto finish; }
     status = sqlite3_step(statement);
     while (status == SQLITE_ROW) {
         status = u1db__process_doc(db, statement, NULL, 1, 0, context, cb);
@@ -753,9 +875,60 @@ u1db_get_from_index_list(u1database *db, u1query *query, void *context,
     }
 finish:
     sqlite3_finalize(statement);
-    if (query_str != NULL) {
-        free(query_str);
+    return status;
+}
+
+int
+u1db_get_doc_ids_from_index_list(u1database *db, u1query *query,
+                                 void *context, u1db_doc_id_callback cb,
+                                 int n_values, const char **values)
+{
+    int status = U1DB_OK;
+    sqlite3_stmt *statement = NULL;
+
+    if (db == NULL || query == NULL || cb == NULL || n_values < 0)
+    {
+        return U1DB_INVALID_PARAMETER;
+    }
+    status = prepare_index_query(db, query, n_values, values, QUERY_DOC_IDS,
+                                 &statement);
+    if (status != U1DB_OK) { goto finish; }
+    status = sqlite3_step(statement);
+    while (status == SQLITE_ROW) {
+        status = cb(context,
+                    (const char *)sqlite3_column_text(statement, 0));
+        if (status != U1DB_OK) { goto finish; }
+        status = sqlite3_step(statement);
+    }
+    if (status == SQLITE_DONE) {
+        status = U1DB_OK;
+    }
+finish:
+    sqlite3_finalize(statement);
+    return status;
+}
+
+int
+u1db_count_from_index_list(u1database *db, u1query *query, int n_values,
+                           const char **values, int *count)
+{
+    int status = U1DB_OK;
+    sqlite3_stmt *statement = NULL;
+
+    if (db == NULL || query == NULL || count == NULL || n_values < 0)
+    {
+        return U1DB_INVALID_PARAMETER;
+    }
+    status = prepare_index_query(db, query, n_values, values, QUERY_COUNT,
+                                 &statement);
+    if (status != U1DB_OK) { goto finish; }
+    status = sqlite3_step(statement);
+    if (status == SQLITE_ROW) {
+        *count = sqlite3_column_int(statement, 0);
+        status = U1DB_OK;
     }
+finish:
+    sqlite3_finalize(statement);
     return status;
 }
 
@@ -771,6 +944,7 @@ u1db_get_range_from_index(u1database *db, u1query *query,
     char *stripped = NULL;
     int start_wildcard[20] = {0};
     int end_wildcard[20] = {0};
+    int value_kinds[20] = {0};
 
     if (db == NULL || query == NULL || cb == NULL || n_values < 0) {
         return U1DB_INVALID_PARAMETER;
@@ -778,6 +952,13 @@ u1db_get_range_from_index(u1database *db, u1query *query,
     if (n_values != query->num_fields) {
         return U1DB_INVALID_VALUE_FOR_INDEX;
     }
+    if (n_values > 20) {
+        return U1DB_NOT_IMPLEMENTED;
+    }
+    status = check_index_values(query, start_values, value_kinds);
+    if (status != U1DB_OK) { goto finish; }
+    status = check_index_values(query, end_values, value_kinds);
+    if (status != U1DB_OK) { goto finish; }
     status = u1db__format_range_query(
         query->num_fields, start_values, end_values, &query_str,
         start_wildcard, end_wildcard);
@@ -794,9 +975,8 @@ u1db_get_range_from_index(u1database *db, u1query *query,
         bind_arg++;
         if (start_values != NULL) {
             if (start_wildcard[i] == NO_GLOB) {
-                status = sqlite3_bind_text(
-                    statement, bind_arg, start_values[i], -1,
-                    SQLITE_TRANSIENT);
+                status = bind_index_value(
+                    statement, bind_arg, value_kinds[i], start_values[i]);
                 bind_arg++;
             } else if (start_wildcard[i] == ENDS_IN_GLOB) {
                 if (stripped != NULL)
@@ -815,9 +995,8 @@ u1db_get_range_from_index(u1database *db, u1query *query,
         }
         if (end_values != NULL) {
             if (end_wildcard[i] == NO_GLOB) {
-                status = sqlite3_bind_text(
-                    statement, bind_arg, end_values[i], -1,
-                    SQLITE_TRANSIENT);
+                status = bind_index_value(
+                    statement, bind_arg, value_kinds[i], end_values[i]);
                 bind_arg++;
             } else if (end_wildcard[i] == ENDS_IN_GLOB) {
                 if (stripped != NULL)
@@ -885,14 +1064,42 @@ finish:
 }
 
 
+struct typed_key_cb_to_key_cb {
+    void *user_context;
+    u1db_key_callback user_cb;
+};
+
+static int
+typed_key_cb_to_key_cb(void *context, int num_fields, const char **key,
+                       const int *is_integer)
+{
+    struct typed_key_cb_to_key_cb *ctx;
+
+    ctx = (struct typed_key_cb_to_key_cb *)context;
+    return ctx->user_cb(ctx->user_context, num_fields, key);
+}
+
 int
 u1db_get_index_keys(u1database *db, char *index_name,
                     void *context, u1db_key_callback cb)
+{
+    struct typed_key_cb_to_key_cb ctx;
+
+    ctx.user_context = context;
+    ctx.user_cb = cb;
+    return u1db_get_typed_index_keys(db, index_name, &ctx,
+                                     typed_key_cb_to_key_cb);
+}
+
+int
+u1db_get_typed_index_keys(u1database *db, char *index_name,
+                          void *context, u1db_typed_key_callback cb)
 {
     int status = U1DB_OK;
     int num_fields = 0;
     int bind_arg, i;
     const char **key = NULL;
+    int *is_integer = NULL;
     string_list *field_names = NULL;
     string_list_item *field_name = NULL;
     char *query_str = NULL;
@@ -950,15 +1157,18 @@ u1db_get_index_keys(u1database *db, char *index_name,
     }
     status = sqlite3_step(statement);
     key = (const char**)calloc(num_fields, sizeof(char*));
-    if (key == NULL) {
+    is_integer = (int*)calloc(num_fields, sizeof(int));
+    if (key == NULL || is_integer == NULL) {
         status = U1DB_NOMEM;
         goto finish;
     }
     while (status == SQLITE_ROW) {
         for (i = 0; i < num_fields; ++i) {
+            is_integer[i] = (
+                sqlite3_column_type(statement, i) == SQLITE_INTEGER);
             key[i]  = (const char*)sqlite3_column_text(statement, i);
         }
-        if ((status = cb(context, num_fields, key)) != U1DB_OK) {
+        if ((status = cb(context, num_fields, key, is_integer)) != U1DB_OK) {
             goto finish;
         }
         status = sqlite3_step(statement);
@@ -970,6 +1180,9 @@ finish:
     if (key != NULL) {
         free(key);
     }
+    if (is_integer != NULL) {
+        free(is_integer);
+    }
     if (query_str != NULL) {
         free(query_str);
     }
@@ -994,6 +1207,15 @@ add_to_buf(char **buf, int *buf_size, const char *fmt, ...)
 int
 u1db__format_query(int n_fields, const char **values, char **buf,
                    int *wildcard)
+{
+    return format_query(n_fields, values, buf, wildcard, QUERY_DOCS, NULL);
+}
+
+// value_kinds, if not NULL, says which fields have integer values, which
+// globs do not match.
+static int
+format_query(int n_fields, const char **values, char **buf, int *wildcard,
+             int query_type, const int *value_kinds)
 {
     int status = U1DB_OK;
     int buf_size, i;
@@ -1004,22 +1226,33 @@ u1db__format_query(int n_fields, const char **values, char **buf,
     if (n_fields < 1) {
         return U1DB_INVALID_PARAMETER;
     }
-    // 81 for 1 doc, 166 for 2, 251 for 3
-    buf_size = (1 + n_fields) * 100;
+    // 81 for 1 doc, 166 for 2, 251 for 3, and room for the type check of
+    // the one glob a query can have.
+    buf_size = 50 + (1 + n_fields) * 100;
     // The first field is treated specially
     cur = (char*)calloc(buf_size, 1);
     if (cur == NULL) {
         return U1DB_NOMEM;
     }
     *buf = cur;
-    add_to_buf(
-        &cur, &buf_size,
-        "SELECT doc.doc_id, doc.doc_rev, doc.content FROM document_fields d0");
+    if (query_type == QUERY_DOC_IDS) {
+        add_to_buf(&cur, &buf_size,
+                   "SELECT d0.doc_id FROM document_fields d0");
+    } else if (query_type == QUERY_COUNT) {
+        add_to_buf(&cur, &buf_size,
+                   "SELECT count(DISTINCT d0.doc_id) FROM document_fields d0");
+    } else {
+        add_to_buf(&cur, &buf_size,
+                   "SELECT doc.doc_id, doc.doc_rev, doc.content"
+                   " FROM document_fields d0");
+    }
     for (i = 1; i < n_fields; ++i) {
         add_to_buf(&cur, &buf_size, ", document_fields d%d", i);
     }
-    add_to_buf(
-        &cur, &buf_size, " INNER JOIN document doc ON doc.doc_id = d0.doc_id");
+    if (query_type == QUERY_DOCS) {
+        add_to_buf(&cur, &buf_size,
+                   " INNER JOIN document doc ON doc.doc_id = d0.doc_id");
+    }
     add_to_buf(&cur, &buf_size, " WHERE d0.field_name = ?");
     for (i = 0; i < n_fields; ++i) {
         if (i != 0) {
@@ -1047,6 +1280,11 @@ u1db__format_query(int n_fields, const char **values, char **buf,
             }
             have_wildcard = 1;
             add_to_buf(&cur, &buf_size, " AND d%d.value GLOB ?", i);
+            if (value_kinds != NULL && value_kinds[i] != TEXT_VALUES) {
+                // GLOB would match integers by their text.
+                add_to_buf(&cur, &buf_size,
+                           " AND typeof(d%d.value) = 'text'", i);
+            }
         } else {
             wildcard[i] = NO_GLOB;
             if (have_wildcard) {
@@ -1057,6 +1295,12 @@ u1db__format_query(int n_fields, const char **values, char **buf,
             add_to_buf(&cur, &buf_size, " AND d%d.value = ?", i);
         }
     }
+    if (query_type == QUERY_COUNT) {
+        goto finish;
+    }
+    if (query_type == QUERY_DOC_IDS) {
+        add_to_buf(&cur, &buf_size, " GROUP BY d0.doc_id");
+    }
     add_to_buf(&cur, &buf_size, " ORDER BY ");
     for (i = 0; i < n_fields; ++i) {
         if (i != 0) {
@@ -1525,7 +1769,7 @@ struct evaluate_index_context {
 
 static int
 add_to_document_fields(u1database *db, const char *doc_id,
-                       const char *expression, const char *val)
+                       const char *expression, const string_list_item *val)
 {
     int status;
     sqlite3_stmt *statement = NULL;
@@ -1541,7 +1785,12 @@ add_to_document_fields(u1database *db, const char *doc_id,
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_bind_text(statement, 2, expression, -1, SQLITE_TRANSIENT);
     if (status != SQLITE_OK) { goto finish; }
-    status = sqlite3_bind_text(statement, 3, val, -1, SQLITE_TRANSIENT);
+    if (val->is_number) {
+        status = sqlite3_bind_int64(statement, 3, val->number);
+    } else {
+        status = sqlite3_bind_text(statement, 3, val->data, -1,
+                                   SQLITE_TRANSIENT);
+    }
     if (status != SQLITE_OK) { goto finish; }
     status = sqlite3_step(statement);
     if (status == SQLITE_DONE) {
@@ -1574,7 +1823,7 @@ evaluate_index_and_insert_into_db(void *context, const char *expression,
     for (item = values->head; item != NULL; item = item->next)
     {
         if ((status = add_to_document_fields(ctx->db, ctx->doc_id, expression,
-                        item->data)) != U1DB_OK)
+                        item)) != U1DB_OK)
             goto finish;
     }
 finish:
@@ -1746,3 +1995,44 @@ finish:
     sqlite3_finalize(statement);
     return status;
 }
+
+// The u1db_typed_index_value(field, value) SQL function.
+static void
+typed_index_value(sqlite3_context *context, int argc, sqlite3_value **argv)
+{
+    const char *field = NULL, *value = NULL;
+    int status, kind;
+    sqlite3_int64 number;
+    char *end = NULL;
+
+    field = (const char *)sqlite3_value_text(argv[0]);
+    if (field == NULL || sqlite3_value_type(argv[1]) != SQLITE_TEXT) {
+        sqlite3_result_value(context, argv[1]);
+        return;
+    }
+    status = get_expression_value_kind(field, &kind);
+    if (status == U1DB_NOMEM) {
+        sqlite3_result_error_nomem(context);
+        return;
+    } else if (status != U1DB_OK) {
+        sqlite3_result_error(context, "invalid index expression", -1);
+        return;
+    }
+    value = (const char *)sqlite3_value_text(argv[1]);
+    if (kind != TEXT_VALUES && is_integer(value)) {
+        errno = 0;
+        number = strtoll(value, &end, 10);
+        if (*end == '\0' && errno != ERANGE) {
+            sqlite3_result_int64(context, number);
+            return;
+        }
+    }
+    sqlite3_result_value(context, argv[1]);
+}
+
+int
+u1db__create_functions(u1database *db)
+{
+    return sqlite3_create_function(db->sql_handle, "u1db_typed_index_value",
+        2, SQLITE_UTF8, NULL, typed_index_value, NULL, NULL);
+}
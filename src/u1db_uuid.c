@@ -23,6 +23,17 @@
 #if defined(_WIN32) || defined(WIN32)
 #include "Wincrypt.h"
 
+static unsigned long long
+current_millis(void)
+{
+    FILETIME ft;
+    unsigned long long t;
+    // 100ns intervals since 1601-01-01
+    GetSystemTimeAsFileTime(&ft);
+    t = ((unsigned long long)ft.dwHighDateTime << 32) | ft.dwLowDateTime;
+    return (t - 116444736000000000ULL) / 10000;
+}
+
 static HCRYPTPROV crypt_provider = 0;
 
 static HCRYPTPROV get_provider()
@@ -61,7 +72,16 @@ u1db__random_bytes(void *buf, size_t count)
 
 #include <errno.h>
 #include <fcntl.h>
+#include <sys/time.h>
 #include <unistd.h>
+
+static unsigned long long
+current_millis(void)
+{
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return (unsigned long long)tv.tv_sec * 1000 + tv.tv_usec / 1000;
+}
 // We leave the file handle open, and let the process closing close it.
 static int urandom_fd = -1;
 
@@ -107,6 +127,61 @@ u1db__generate_hex_uuid(char *uuid)
     return U1DB_OK;
 }
 
+// The last time ordered id generated.
+static unsigned long long last_millis = 0;
+static unsigned char last_random[10] = {0};
+
+int
+u1db__generate_time_ordered_hex_id(char *id)
+{
+    unsigned char buf[16] = {0};
+    unsigned long long millis;
+    int i, status;
+
+    millis = current_millis();
+    // Note: There is a small potential thread-race condition as last_millis
+    //       is a global, if we adopt a threading lib, consider adding a lock.
+    if (millis <= last_millis) {
+        // Increment the random part of the last id, also when the clock
+        // went back, so ids still sort in order.
+        millis = last_millis;
+        memcpy(&buf[6], last_random, 10);
+        for (i = 15; i >= 6; --i) {
+            if (++buf[i] != 0) {
+                break;
+            }
+        }
+        if (i < 6) {
+            millis++;
+        }
+    } else {
+        status = u1db__random_bytes(&buf[6], 10);
+        if (status != U1DB_OK) {
+            return status;
+        }
+    }
+    last_millis = millis;
+    memcpy(last_random, &buf[6], 10);
+    for (i = 5; i >= 0; --i) {
+        buf[i] = (unsigned char)(millis & 0xFF);
+        millis >>= 8;
+    }
+    u1db__bin_to_hex(buf, 16, id);
+    return U1DB_OK;
+}
+
+int
+u1db_random_id(void *context, char *id)
+{
+    return u1db__generate_hex_uuid(id);
+}
+
+int
+u1db_time_ordered_id(void *context, char *id)
+{
+    return u1db__generate_time_ordered_hex_id(id);
+}
+
 void
 u1db__bin_to_hex(unsigned char *bin_in, int bin_count, char *hex_out)
 {
@@ -16,12 +16,14 @@
 
 """U1DB"""
 
+import hashlib
+
 try:
     import simplejson as json
 except ImportError:
     import json  # noqa
 
-from u1db.errors import InvalidJSON, InvalidContent
+from u1db.errors import InvalidJSON, InvalidContent, InvalidResumeToken
 
 __version_info__ = (99, 12)
 __version__ = '.'.join(map(lambda x: '%02d' % x, __version_info__))
@@ -77,6 +79,34 @@ class Database(object):
         """
         raise NotImplementedError(self.set_document_size_limit)
 
+    def set_id_allocator(self, allocator):
+        """Set how the ids of new documents and transactions are made.
+
+        :param allocator: A callable returning 32 unique hex digits, like
+            u1db.ids.random_id. New databases default to
+            u1db.ids.time_ordered_id, which makes ids that sort in the order
+            they were allocated and keeps inserts local in the database
+            indexes. Databases created before it existed keep random ids.
+        """
+        raise NotImplementedError(self.set_id_allocator)
+
+    def retire_replicas(self, replica_uids):
+        """Declare that replicas will never change documents again.
+
+        Their entries in document revisions are folded into a single
+        'retired' entry whenever a new revision is made, which keeps the
+        revisions small as replicas come and go. Only retire replicas whose
+        changes have reached every replica still in use, and retire the
+        same replicas on all of them. Revisions are compared as they are, so
+        a revision that still carries the entries of retired replicas
+        conflicts with a folded one instead of replacing it or being
+        replaced by it.
+
+        :param replica_uids: A set of replica uids, which can not include
+            this replica.
+        """
+        raise NotImplementedError(self.retire_replicas)
+
     def whats_changed(self, old_generation=0):
         """Return a list of documents that have changed since old_generation.
         This allows APPS to only store a db generation before going
@@ -174,6 +204,32 @@ class Database(object):
         """
         raise NotImplementedError(self.put_doc)
 
+    def create_docs(self, contents):
+        """Create many new documents at once.
+
+        All the documents are stored together, which is much cheaper than
+        calling create_doc for each of them. Nothing is stored if any of the
+        contents is invalid or exceeds the maximum document size.
+
+        :param contents: A list of Python dictionaries.
+        :return: [Document] The new documents, in contents order.
+        """
+        raise NotImplementedError(self.create_docs)
+
+    def put_docs(self, docs):
+        """Update many documents at once.
+
+        Every document is checked the same way put_doc would check it. The
+        documents that pass are all stored together, the others are left
+        untouched.
+
+        :param docs: A list of Documents with new content.
+        :return: A list with, for each document in docs order, either its new
+            revision identifier, or the U1DBError explaining why it was not
+            stored. The stored Document objects are also updated.
+        """
+        raise NotImplementedError(self.put_docs)
+
     def delete_doc(self, doc):
         """Mark a document as deleted.
         Will abort if the current revision doesn't match doc.rev.
@@ -225,6 +281,10 @@ class Database(object):
         (eg 'val', '*', '*' is allowed, but '*', 'val', 'val' is not.)
         It is also possible to append a '*' to the last supplied value (eg
         'val*', '*', '*' or 'val', 'val*', '*', but not 'val*', 'val', '*')
+        A value may also be a list of values, matching any of them (eg
+        ['val1', 'val2'], '*'). Lists can not follow a wildcard.
+        The values of number() and bool() expressions are integers, given as
+        strings of digits (eg '12'); they can not be matched with 'val*'.
 
         :param index_name: The index to query
         :param key_values: values to match. eg, if you have
@@ -234,6 +294,37 @@ class Database(object):
         """
         raise NotImplementedError(self.get_from_index)
 
+    def get_from_index_intersection(self, queries):
+        """Return documents that match all of the queries supplied.
+
+        :param queries: A list of (index_name, val1, val2, ...) tuples, each
+            taking the same values as get_from_index. eg
+            [('by-tag', 'work'), ('by-tag', 'urgent')]
+        :return: List of [Document], each listed once, ordered as the first
+            query would return them.
+        """
+        raise NotImplementedError(self.get_from_index_intersection)
+
+    def get_doc_ids_from_index(self, index_name, *key_values):
+        """Return the ids of the documents that match the keys supplied.
+
+        This takes the same arguments as get_from_index, but does not read
+        the documents themselves.
+
+        :return: List of the matching doc_ids, each listed once, in index
+            order.
+        """
+        raise NotImplementedError(self.get_doc_ids_from_index)
+
+    def count_from_index(self, index_name, *key_values):
+        """Return the number of documents that match the keys supplied.
+
+        This takes the same arguments as get_from_index.
+
+        :return: The number of distinct matching documents.
+        """
+        raise NotImplementedError(self.count_from_index)
+
     def get_range_from_index(self, index_name, start_value, end_value):
         """Return documents that fall within the specified range.
 
@@ -245,7 +336,8 @@ class Database(object):
         a wildcard match. You can only supply '*' to trailing entries, (eg
         'val', '*', '*' is allowed, but '*', 'val', 'val' is not.) It is also
         possible to append a '*' to the last supplied value (eg 'val*', '*',
-        '*' or 'val', 'val*', '*', but not 'val*', 'val', '*')
+        '*' or 'val', 'val*', '*', but not 'val*', 'val', '*') The values of
+        number() and bool() expressions are given as in get_from_index.
 
         :param index_name: The index to query
         :param start_values: tuples of values that define the lower bound of
@@ -266,6 +358,46 @@ class Database(object):
         """
         raise NotImplementedError(self.get_index_keys)
 
+    def iter_from_index(self, index_name, key_values, limit=None,
+                        descending=False, resume_token=None):
+        """Return a cursor over the documents that match the keys supplied.
+
+        key_values is a tuple of values with the same meaning as for
+        get_from_index. Results are ordered by index key and doc_id, and a
+        document is returned once for every key under which it matches.
+
+        :param index_name: The index to query
+        :param key_values: A tuple of values to match.
+        :param limit: The maximum number of documents to return, or None.
+        :param descending: Return the documents in reverse order.
+        :param resume_token: The resume_token of a cursor from the same query,
+            to continue after the last document it returned.
+        :return: An IndexCursor of Documents.
+        """
+        raise NotImplementedError(self.iter_from_index)
+
+    def iter_range_from_index(self, index_name, start_value=None,
+                              end_value=None, limit=None, descending=False,
+                              resume_token=None):
+        """Return a cursor over the documents within the specified range.
+
+        start_value and end_value are as for get_range_from_index, the other
+        parameters are as for iter_from_index.
+
+        :return: An IndexCursor of Documents.
+        """
+        raise NotImplementedError(self.iter_range_from_index)
+
+    def iter_index_keys(self, index_name, limit=None, descending=False,
+                        resume_token=None):
+        """Return a cursor over the keys under which documents are indexed.
+
+        The parameters are as for iter_from_index.
+
+        :return: An IndexCursor of tuples of indexed keys, in key order.
+        """
+        raise NotImplementedError(self.iter_index_keys)
+
     def get_doc_conflicts(self, doc_id):
         """Get the list of conflicts for the given document.
 
@@ -411,6 +543,11 @@ class DocumentBase(object):
     :ivar has_conflicts: Boolean indicating if this document has conflicts
     """
 
+    # Lots of documents are held at once by sync and get_all_docs, so they
+    # don't get a __dict__. Subclasses that don't define __slots__ do.
+    __slots__ = ('doc_id', 'rev', 'has_conflicts', '_json', '_parsed_json',
+                 '_content_digest')
+
     def __init__(self, doc_id, rev, json_string, has_conflicts=False):
         self.doc_id = doc_id
         self.rev = rev
@@ -423,18 +560,59 @@ class DocumentBase(object):
                 raise InvalidJSON
         self._json = json_string
         self.has_conflicts = has_conflicts
+        # (json string, value) caches, only valid while _json is that very
+        # string.
+        self._parsed_json = None
+        self._content_digest = None
+        if json_string is not None:
+            self._parsed_json = (json_string, value)
+
+    def __getstate__(self):
+        # Without a __dict__ pickle needs the values of the slots, those of
+        # subclasses included, and the __dict__ of subclasses without slots.
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        state.update(getattr(self, '__dict__', {}))
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
     def same_content_as(self, other):
         """Compare the content of two documents."""
-        if self._json:
-            c1 = json.loads(self._json)
-        else:
-            c1 = None
-        if other._json:
-            c2 = json.loads(other._json)
-        else:
-            c2 = None
-        return c1 == c2
+        return self.get_content_digest() == other.get_content_digest()
+
+    def get_parsed_json(self):
+        """Return the parsed json of this document, or None for a tombstone.
+
+        The json is only parsed once. The value returned is shared, it must
+        not be modified.
+        """
+        json_string = self._json
+        if json_string is None:
+            return None
+        cached = self._parsed_json
+        if cached is None or cached[0] is not json_string:
+            cached = self._parsed_json = (json_string, json.loads(json_string))
+        return cached[1]
+
+    def get_content_digest(self):
+        """Return the content_digest of this document, None for a tombstone.
+
+        Documents have the same digest when their content is the same.
+        """
+        json_string = self._json
+        if json_string is None:
+            return None
+        cached = self._content_digest
+        if cached is None or cached[0] is not json_string:
+            cached = self._content_digest = (
+                json_string, content_digest(self.get_parsed_json()))
+        return cached[1]
 
     def __repr__(self):
         if self.has_conflicts:
@@ -494,6 +672,7 @@ class DocumentBase(object):
                 raise InvalidJSON
             if not isinstance(value, dict):
                 raise InvalidJSON
+            self._parsed_json = (json_string, value)
         self._json = json_string
 
     def make_tombstone(self):
@@ -520,6 +699,8 @@ class Document(DocumentBase):
     # have it but if the language supports dictionaries/hashtables, it makes
     # Documents a lot more user friendly.
 
+    __slots__ = ('_content',)
+
     def __init__(self, doc_id=None, rev=None, json='{}', has_conflicts=False):
         # TODO: We convert the json in the superclass to check its validity so
         # we might as well set _content here directly since the price is
@@ -527,17 +708,17 @@ class Document(DocumentBase):
         super(Document, self).__init__(doc_id, rev, json, has_conflicts)
         self._content = None
 
-    def same_content_as(self, other):
-        """Compare the content of two documents."""
-        if self._json:
-            c1 = json.loads(self._json)
-        else:
-            c1 = self._content
-        if other._json:
-            c2 = json.loads(other._json)
-        else:
-            c2 = other._content
-        return c1 == c2
+    def get_parsed_json(self):
+        if self._json is None:
+            return self._content
+        return super(Document, self).get_parsed_json()
+
+    def get_content_digest(self):
+        if self._json is None:
+            # The content may have been changed in place, so its digest can
+            # not be cached.
+            return content_digest(self._content)
+        return super(Document, self).get_content_digest()
 
     def get_json(self):
         """Get the json serialization of this document."""
@@ -567,7 +748,8 @@ class Document(DocumentBase):
     def _get_content(self):
         """Get the dictionary representing this document."""
         if self._json is not None:
-            self._content = json.loads(self._json)
+            # Nothing else refers to the cached value once _json is reset.
+            self._content = super(Document, self).get_parsed_json()
             self._json = None
         if self._content is not None:
             return self._content
@@ -594,6 +776,88 @@ class Document(DocumentBase):
     # End of optional part.
 
 
+def content_digest(content):
+    """Return a canonical digest of the parsed content of a document.
+
+    It does not depend on the formatting or the key order of the json, so
+    documents with the same content have the same digest.
+
+    :param content: The parsed content, or None for a tombstone.
+    """
+    if content is None:
+        return None
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical).hexdigest()
+
+
+# The constructors that only validate the json they are given.
+_validating_inits = (DocumentBase.__init__.im_func, Document.__init__.im_func)
+
+
+def make_trusted_document(factory, doc_id, rev, json_string,
+                          digest=None):
+    """Create a document from json that is known to be a valid object.
+
+    This is for content that was validated before it was stored. The
+    json.loads done by DocumentBase.__init__ is skipped when the factory
+    does not override __init__, otherwise the factory is called as usual.
+
+    :param factory: A document factory, as given to set_document_factory.
+    :param digest: The content_digest of json_string, if it is known.
+    """
+    init = getattr(getattr(factory, '__init__', None), 'im_func', None)
+    if json_string is None or init not in _validating_inits:
+        doc = factory(doc_id, rev, json_string)
+    else:
+        doc = factory(doc_id, rev, None)
+        doc._json = json_string
+    if digest is not None and getattr(doc, '_json', None) is json_string:
+        doc._content_digest = (json_string, digest)
+    return doc
+
+
+class IndexCursor(object):
+    """An iterator over the results of an index query.
+
+    :ivar resume_token: An opaque string that continues the same query after
+        the last result returned so far, when passed as its resume_token. It
+        is the resume_token the query started from until a result is returned.
+    """
+
+    def __init__(self, rows, resume_token=None):
+        """Create an IndexCursor.
+
+        :param rows: An iterable of (position, result). position is a list of
+            the index values, and the doc_id when results are documents,
+            giving the place of the result in the index.
+        :param resume_token: The resume_token the query started from.
+        """
+        self._rows = iter(rows)
+        self.resume_token = resume_token
+
+    @staticmethod
+    def decode_resume_token(resume_token, length):
+        """Return the position encoded in resume_token.
+
+        :param length: The number of entries that the position must have.
+        """
+        try:
+            position = json.loads(resume_token)
+        except (TypeError, ValueError):
+            raise InvalidResumeToken(resume_token)
+        if not isinstance(position, list) or len(position) != length:
+            raise InvalidResumeToken(resume_token)
+        return position
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        position, result = self._rows.next()
+        self.resume_token = json.dumps(position)
+        return result
+
+
 class SyncTarget(object):
     """Functionality for using a Database as a synchronization target."""
 
@@ -21,11 +21,11 @@ try:
     import simplejson as json
 except ImportError:
     import json  # noqa
-import uuid
 
 import u1db
 from u1db import (
     errors,
+    ids,
 )
 import u1db.sync
 from u1db.vectorclock import VectorClockRev
@@ -41,18 +41,34 @@ class CommonSyncTarget(u1db.sync.LocalSyncTarget):
 class CommonBackend(u1db.Database):
 
     document_size_limit = 0
+    # Returns the unique part of new ids, see set_id_allocator.
+    _id_allocator = staticmethod(ids.time_ordered_id)
+
+    def set_id_allocator(self, allocator):
+        self._id_allocator = allocator
 
     def _allocate_doc_id(self):
         """Generate a unique identifier for this document."""
-        return 'D-' + uuid.uuid4().hex  # 'D-' stands for document
+        return 'D-' + self._id_allocator()  # 'D-' stands for document
 
     def _allocate_transaction_id(self):
-        return 'T-' + uuid.uuid4().hex  # 'T-' stands for transaction
+        return 'T-' + self._id_allocator()  # 'T-' stands for transaction
 
     def _allocate_doc_rev(self, old_doc_rev):
-        vcr = VectorClockRev(old_doc_rev)
-        vcr.increment(self._replica_uid)
-        return vcr.as_str()
+        return self._ensure_maximal_rev(old_doc_rev, [])
+
+    def _get_retired_replicas(self):
+        """Return the set of replica uids retired by retire_replicas."""
+        raise NotImplementedError(self._get_retired_replicas)
+
+    def _add_retired_replicas(self, replica_uids):
+        """Store more retired replica uids."""
+        raise NotImplementedError(self._add_retired_replicas)
+
+    def retire_replicas(self, replica_uids):
+        if self._replica_uid in replica_uids:
+            raise errors.InvalidReplicaUID()
+        self._add_retired_replicas(replica_uids)
 
     def _check_doc_id(self, doc_id):
         if not check_doc_id_re.match(doc_id):
@@ -100,6 +116,46 @@ class CommonBackend(u1db.Database):
         self.put_doc(doc)
         return doc
 
+    def create_docs(self, contents):
+        docs = []
+        for content in contents:
+            if not isinstance(content, dict):
+                raise errors.InvalidContent
+            doc = self._factory(
+                self._allocate_doc_id(), None, json.dumps(content))
+            self._check_doc_size(doc)
+            docs.append(doc)
+        for result in self.put_docs(docs):
+            if isinstance(result, errors.U1DBError):
+                raise result
+        return docs
+
+    def put_docs(self, docs):
+        results = []
+        for doc in docs:
+            try:
+                results.append(self.put_doc(doc))
+            except errors.U1DBError, e:
+                results.append(e)
+        return results
+
+    def _check_put_doc(self, old_doc, doc):
+        """Check that doc can be put over old_doc.
+
+        :return: The new revision for doc.
+        """
+        if old_doc and old_doc.has_conflicts:
+            raise errors.ConflictedDoc()
+        if old_doc and doc.rev is None and old_doc.is_tombstone():
+            return self._allocate_doc_rev(old_doc.rev)
+        if old_doc is not None:
+            if old_doc.rev != doc.rev:
+                raise errors.RevisionConflict()
+        else:
+            if doc.rev is not None:
+                raise errors.RevisionConflict()
+        return self._allocate_doc_rev(doc.rev)
+
     def _get_transaction_log(self):
         """This is only for the test suite, it is not part of the api."""
         raise NotImplementedError(self._get_transaction_log)
@@ -159,6 +215,9 @@ class CommonBackend(u1db.Database):
     def _put_doc_if_newer(self, doc, save_conflict, replica_uid, replica_gen,
                           replica_trans_id=''):
         cur_doc = self._get_doc(doc.doc_id)
+        # Revs are compared as they are. Folding the counters of retired
+        # replicas loses their order, so a rev that still carries them
+        # conflicts with a folded one rather than replacing it.
         doc_vcr = VectorClockRev(doc.rev)
         if cur_doc is None:
             cur_vcr = VectorClockRev(None)
@@ -184,9 +243,7 @@ class CommonBackend(u1db.Database):
             state = 'superseded'
         elif cur_doc.same_content_as(doc):
             # the documents have been edited to the same thing at both ends
-            doc_vcr.maximize(cur_vcr)
-            doc_vcr.increment(self._replica_uid)
-            doc.rev = doc_vcr.as_str()
+            doc.rev = self._ensure_maximal_rev(cur_doc.rev, [doc.rev])
             self._put_and_update_indexes(cur_doc, doc)
             state = 'superseded'
         else:
@@ -199,11 +256,27 @@ class CommonBackend(u1db.Database):
         return state, self._get_generation()
 
     def _ensure_maximal_rev(self, cur_rev, extra_revs):
-        vcr = VectorClockRev(cur_rev)
-        for rev in extra_revs:
-            vcr.maximize(VectorClockRev(rev))
-        vcr.increment(self._replica_uid)
-        return vcr.as_str()
+        """Return a new rev of this replica, newer than all the given revs.
+
+        The counters of retired replicas are folded in the new rev. The revs
+        that still carry them are maximized before they are folded, so the
+        folded counter is the sum of their largest counters, not the largest
+        of their sums.
+        """
+        folded = VectorClockRev(None)
+        unfolded = VectorClockRev(None)
+        for rev in [cur_rev] + list(extra_revs):
+            vcr = VectorClockRev(rev)
+            if vcr.is_folded():
+                folded.maximize(vcr)
+            else:
+                unfolded.maximize(vcr)
+        retired = self._get_retired_replicas()
+        folded.retire(retired)
+        unfolded.retire(retired)
+        folded.maximize(unfolded)
+        folded.increment(self._replica_uid)
+        return folded.as_str()
 
     def set_document_size_limit(self, limit):
         self.document_size_limit = limit
@@ -4,18 +4,29 @@ CREATE TABLE transaction_log (
     doc_id TEXT NOT NULL,
     transaction_id TEXT NOT NULL
 );
+CREATE TABLE document_changes (
+    doc_id TEXT PRIMARY KEY,
+    last_generation INTEGER NOT NULL,
+    last_trans_id TEXT NOT NULL
+);
+CREATE INDEX document_changes_generation_idx
+    ON document_changes(last_generation);
 CREATE TABLE document (
     doc_id TEXT PRIMARY KEY,
     doc_rev TEXT NOT NULL,
-    content TEXT
+    content TEXT,
+    has_conflicts INTEGER NOT NULL DEFAULT 0,
+    content_digest TEXT
 );
 CREATE TABLE document_fields (
     doc_id TEXT NOT NULL,
     field_name TEXT NOT NULL,
-    value TEXT
+    value
 );
 CREATE INDEX document_fields_field_value_doc_idx
     ON document_fields(field_name, value, doc_id);
+CREATE INDEX document_fields_doc_id_idx
+    ON document_fields(doc_id);
 
 CREATE TABLE sync_log (
     replica_uid TEXT PRIMARY KEY,
@@ -26,6 +37,7 @@ CREATE TABLE conflicts (
     doc_id TEXT,
     doc_rev TEXT,
     content TEXT,
+    content_digest TEXT,
     CONSTRAINT conflicts_pkey PRIMARY KEY (doc_id, doc_rev)
 );
 CREATE TABLE index_definitions (
@@ -35,8 +47,22 @@ CREATE TABLE index_definitions (
     CONSTRAINT index_definitions_pkey PRIMARY KEY (name, offset)
 );
 create index index_definitions_field on index_definitions(field);
+CREATE TABLE index_builds (
+    name TEXT,
+    offset INT,
+    field TEXT,
+    CONSTRAINT index_builds_pkey PRIMARY KEY (name, offset)
+);
+CREATE TABLE replica_dictionary (
+    replica_id INTEGER PRIMARY KEY,
+    replica_uid TEXT NOT NULL UNIQUE
+);
+CREATE TABLE retired_replicas (
+    replica_uid TEXT PRIMARY KEY
+);
 CREATE TABLE u1db_config (
     name TEXT PRIMARY KEY,
     value TEXT
 );
-INSERT INTO u1db_config VALUES ('sql_schema', '0');
+INSERT INTO u1db_config VALUES ('sql_schema', '8');
+INSERT INTO u1db_config VALUES ('id_allocator', 'time_ordered');
@@ -23,16 +23,42 @@ except ImportError:
 
 from u1db import (
     Document,
+    IndexCursor,
     errors,
+    make_trusted_document,
     query_parser,
     vectorclock,
     )
 from u1db.backends import CommonBackend, CommonSyncTarget
 
 
-def get_prefix(value):
-    key_prefix = '\x01'.join(value)
-    return key_prefix.rstrip('*')
+def _key_text(value):
+    """Return the text an index value of a non-numeric expression has."""
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        value = int(value)
+    return unicode(value)
+
+
+def _is_glob(value):
+    return isinstance(value, basestring) and value.endswith('*')
+
+
+def key_matches(key, prefix):
+    """Check whether an index key starts with the values of prefix.
+
+    The last value of prefix may be a glob, matching the text values that
+    start with it. Integers never match a glob.
+    """
+    if not prefix:
+        return True
+    n = len(prefix) - 1
+    if _is_glob(prefix[n]):
+        return (key[:n] == tuple(prefix[:n])
+                and isinstance(key[n], basestring)
+                and key[n].startswith(prefix[n][:-1]))
+    return key[:n + 1] == tuple(prefix)
 
 
 class InMemoryDatabase(CommonBackend):
@@ -45,7 +71,10 @@ class InMemoryDatabase(CommonBackend):
         self._conflicts = {}
         self._other_generations = {}
         self._indexes = {}
+        # A CompiledPlan evaluating the expressions of all indexes at once.
+        self._index_plan = None
         self._replica_uid = replica_uid
+        self._retired_replicas = frozenset()
         self._factory = document_factory or Document
 
     def _set_replica_uid(self, replica_uid):
@@ -55,6 +84,12 @@ class InMemoryDatabase(CommonBackend):
     def set_document_factory(self, factory):
         self._factory = factory
 
+    def _get_retired_replicas(self):
+        return self._retired_replicas
+
+    def _add_retired_replicas(self, replica_uids):
+        self._retired_replicas = self._retired_replicas.union(replica_uids)
+
     def close(self):
         # This is a no-op, We don't want to free the data because one client
         # may be closing it, while another wants to inspect the results.
@@ -104,38 +139,46 @@ class InMemoryDatabase(CommonBackend):
         self._check_doc_id(doc.doc_id)
         self._check_doc_size(doc)
         old_doc = self._get_doc(doc.doc_id, check_for_conflicts=True)
-        if old_doc and old_doc.has_conflicts:
-            raise errors.ConflictedDoc()
-        if old_doc and doc.rev is None and old_doc.is_tombstone():
-            new_rev = self._allocate_doc_rev(old_doc.rev)
-        else:
-            if old_doc is not None:
-                if old_doc.rev != doc.rev:
-                    raise errors.RevisionConflict()
-            else:
-                if doc.rev is not None:
-                    raise errors.RevisionConflict()
-            new_rev = self._allocate_doc_rev(doc.rev)
+        new_rev = self._check_put_doc(old_doc, doc)
         doc.rev = new_rev
         self._put_and_update_indexes(old_doc, doc)
         return new_rev
 
     def _put_and_update_indexes(self, old_doc, doc):
-        for index in self._indexes.itervalues():
+        if self._indexes:
             if old_doc is not None and not old_doc.is_tombstone():
-                index.remove_json(old_doc.doc_id, old_doc.get_json())
+                values = self._evaluate_indexes(old_doc)
+                for index in self._indexes.itervalues():
+                    index.remove_values(old_doc.doc_id, values)
             if not doc.is_tombstone():
-                index.add_json(doc.doc_id, doc.get_json())
+                values = self._evaluate_indexes(doc)
+                for index in self._indexes.itervalues():
+                    index.add_values(doc.doc_id, values)
         trans_id = self._allocate_transaction_id()
         self._docs[doc.doc_id] = (doc.rev, doc.get_json())
         self._transaction_log.append((doc.doc_id, trans_id))
 
+    def _evaluate_indexes(self, doc):
+        """Evaluate every index expression for a document.
+
+        :return: A dict mapping index expressions to their list of values.
+        """
+        if self._index_plan is None:
+            expressions = set()
+            for index in self._indexes.itervalues():
+                expressions.update(index._definition)
+            self._index_plan = query_parser.Parser().compile_plan(
+                sorted(expressions))
+        plan = self._index_plan
+        return dict(zip(plan.expressions,
+                        plan.evaluate(doc.get_parsed_json())))
+
     def _get_doc(self, doc_id, check_for_conflicts=False):
         try:
             doc_rev, content = self._docs[doc_id]
         except KeyError:
             return None
-        doc = self._factory(doc_id, doc_rev, content)
+        doc = make_trusted_document(self._factory, doc_id, doc_rev, content)
         if check_for_conflicts:
             doc.has_conflicts = (doc.doc_id in self._conflicts)
         return doc
@@ -158,7 +201,8 @@ class InMemoryDatabase(CommonBackend):
         for doc_id, (doc_rev, content) in self._docs.items():
             if content is None and not include_deleted:
                 continue
-            doc = self._factory(doc_id, doc_rev, content)
+            doc = make_trusted_document(
+                self._factory, doc_id, doc_rev, content)
             doc.has_conflicts = self._has_conflicts(doc_id)
             results.append(doc)
         return (generation, results)
@@ -168,8 +212,9 @@ class InMemoryDatabase(CommonBackend):
             return []
         result = [self._get_doc(doc_id)]
         result[0].has_conflicts = True
-        result.extend([self._factory(doc_id, rev, content)
-                       for rev, content in self._conflicts[doc_id]])
+        result.extend([
+            make_trusted_document(self._factory, doc_id, rev, content)
+            for rev, content in self._conflicts[doc_id]])
         return result
 
     def _replace_conflicts(self, doc, conflicts):
@@ -181,21 +226,21 @@ class InMemoryDatabase(CommonBackend):
 
     def _prune_conflicts(self, doc, doc_vcr):
         if self._has_conflicts(doc.doc_id):
-            autoresolved = False
+            autoresolved = []
             remaining_conflicts = []
             cur_conflicts = self._conflicts[doc.doc_id]
             for c_rev, c_doc in cur_conflicts:
                 c_vcr = vectorclock.VectorClockRev(c_rev)
                 if doc_vcr.is_newer(c_vcr):
                     continue
-                if doc.same_content_as(Document(doc.doc_id, c_rev, c_doc)):
+                if doc.same_content_as(make_trusted_document(
+                        Document, doc.doc_id, c_rev, c_doc)):
                     doc_vcr.maximize(c_vcr)
-                    autoresolved = True
+                    autoresolved.append(c_rev)
                     continue
                 remaining_conflicts.append((c_rev, c_doc))
             if autoresolved:
-                doc_vcr.increment(self._replica_uid)
-                doc.rev = doc_vcr.as_str()
+                doc.rev = self._ensure_maximal_rev(doc.rev, autoresolved)
             self._replace_conflicts(doc, remaining_conflicts)
 
     def resolve_doc(self, doc, conflicted_doc_revs):
@@ -238,12 +283,14 @@ class InMemoryDatabase(CommonBackend):
             if doc is not None:
                 index.add_json(doc_id, doc)
         self._indexes[index_name] = index
+        self._index_plan = None
 
     def delete_index(self, index_name):
         try:
             del self._indexes[index_name]
         except KeyError:
             pass
+        self._index_plan = None
 
     def list_indexes(self):
         definitions = []
@@ -262,6 +309,46 @@ class InMemoryDatabase(CommonBackend):
             result.append(self._get_doc(doc_id, check_for_conflicts=True))
         return result
 
+    def get_from_index_intersection(self, queries):
+        if not queries:
+            raise errors.InvalidValueForIndex()
+        lookups = []
+        for query in queries:
+            try:
+                index = self._indexes[query[0]]
+            except KeyError:
+                raise errors.IndexDoesNotExist
+            lookups.append(index.lookup(query[1:]))
+        matching = set(lookups[0])
+        for doc_ids in lookups[1:]:
+            matching.intersection_update(doc_ids)
+        result = []
+        for doc_id in lookups[0]:
+            if doc_id in matching:
+                matching.discard(doc_id)
+                result.append(self._get_doc(doc_id, check_for_conflicts=True))
+        return result
+
+    def get_doc_ids_from_index(self, index_name, *key_values):
+        try:
+            index = self._indexes[index_name]
+        except KeyError:
+            raise errors.IndexDoesNotExist
+        doc_ids = []
+        seen = set()
+        for doc_id in index.lookup(key_values):
+            if doc_id not in seen:
+                seen.add(doc_id)
+                doc_ids.append(doc_id)
+        return doc_ids
+
+    def count_from_index(self, index_name, *key_values):
+        try:
+            index = self._indexes[index_name]
+        except KeyError:
+            raise errors.IndexDoesNotExist
+        return len(set(index.lookup(key_values)))
+
     def get_range_from_index(self, index_name, start_value=None,
                              end_value=None):
         """Return all documents with key values in the specified range."""
@@ -284,9 +371,74 @@ class InMemoryDatabase(CommonBackend):
             index = self._indexes[index_name]
         except KeyError:
             raise errors.IndexDoesNotExist
-        keys = index.keys()
-        # XXX inefficiency warning
-        return list(set([tuple(key.split('\x01')) for key in keys]))
+        return index.keys()
+
+    def _make_index_cursor(self, positions, position_length, make_result,
+                           limit, descending, resume_token):
+        """Return an IndexCursor over the sorted positions.
+
+        :param position_length: The number of entries in each position.
+        :param make_result: A function returning the result for a position.
+        """
+        positions = sorted(positions, reverse=descending)
+        if resume_token is not None:
+            resume = IndexCursor.decode_resume_token(
+                resume_token, position_length)
+            if descending:
+                positions = [p for p in positions if p < resume]
+            else:
+                positions = [p for p in positions if p > resume]
+        if limit is not None:
+            positions = positions[:limit]
+        return IndexCursor(
+            ((p, make_result(p)) for p in positions), resume_token)
+
+    def _make_doc_index_cursor(self, index, keys, limit, descending,
+                               resume_token):
+        positions = []
+        for key in keys:
+            positions.extend(
+                [list(key) + [doc_id] for doc_id in index.get_doc_ids(key)])
+        return self._make_index_cursor(
+            positions, len(index._definition) + 1,
+            lambda p: self._get_doc(p[-1], check_for_conflicts=True),
+            limit, descending, resume_token)
+
+    def iter_from_index(self, index_name, key_values, limit=None,
+                        descending=False, resume_token=None):
+        try:
+            index = self._indexes[index_name]
+        except KeyError:
+            raise errors.IndexDoesNotExist
+        keys = index.lookup_keys(key_values)
+        return self._make_doc_index_cursor(
+            index, keys, limit, descending, resume_token)
+
+    def iter_range_from_index(self, index_name, start_value=None,
+                              end_value=None, limit=None, descending=False,
+                              resume_token=None):
+        try:
+            index = self._indexes[index_name]
+        except KeyError:
+            raise errors.IndexDoesNotExist
+        if isinstance(start_value, basestring):
+            start_value = (start_value,)
+        if isinstance(end_value, basestring):
+            end_value = (end_value,)
+        keys = index.lookup_range_keys(start_value, end_value)
+        return self._make_doc_index_cursor(
+            index, keys, limit, descending, resume_token)
+
+    def iter_index_keys(self, index_name, limit=None, descending=False,
+                        resume_token=None):
+        try:
+            index = self._indexes[index_name]
+        except KeyError:
+            raise errors.IndexDoesNotExist
+        positions = [list(key) for key in index.keys()]
+        return self._make_index_cursor(
+            positions, len(index._definition), tuple, limit, descending,
+            resume_token)
 
     def whats_changed(self, old_generation=0):
         changes = []
@@ -326,7 +478,7 @@ class InMemoryIndex(object):
         self._definition = index_definition
         self._values = {}
         parser = query_parser.Parser()
-        self._getters = parser.parse_all(self._definition)
+        self._plan = parser.compile_plan(self._definition)
 
     def evaluate_json(self, doc):
         """Determine the 'key' after applying this index to the doc."""
@@ -335,29 +487,83 @@ class InMemoryIndex(object):
 
     def evaluate(self, obj):
         """Evaluate a dict object, applying this definition."""
-        all_rows = [[]]
-        for getter in self._getters:
-            new_rows = []
-            keys = getter.get(obj)
+        return self._make_keys(self._plan.evaluate(obj))
+
+    def _make_keys(self, field_values):
+        """Return the keys of a document.
+
+        A key is the tuple of the values of each expression. Like the value
+        column of the SQLite backends, the values of numeric expressions are
+        integers, which sort before text, and the other values are text.
+
+        :param field_values: The list of values of each expression of this
+            index.
+        """
+        all_rows = [()]
+        for keys, numeric in zip(field_values, self._plan.numeric):
             if not keys:
                 return []
-            for key in keys:
-                new_rows.extend([row + [key] for row in all_rows])
-            all_rows = new_rows
-        all_rows = ['\x01'.join(row) for row in all_rows]
+            if not numeric:
+                keys = [_key_text(key) for key in keys]
+            all_rows = [row + (key,) for key in keys for row in all_rows]
         return all_rows
 
+    def _typed_values(self, values):
+        """Return the values of a query as they are in the keys."""
+        typed = []
+        for value, numeric, numeric_only in zip(
+                values, self._plan.numeric, self._plan.numeric_only):
+            if numeric_only:
+                value = query_parser.numeric_query_value(value)
+            elif numeric:
+                value = query_parser.numeric_key_value(value)
+            typed.append(value)
+        return tuple(typed)
+
+    @staticmethod
+    def _range_prefix(values):
+        """Return the values of a range bound up to its first wildcard.
+
+        The value with a glob is included, without the *.
+        """
+        prefix = []
+        for value in values:
+            if _is_glob(value):
+                if value != '*':
+                    prefix.append(value[:-1])
+                break
+            prefix.append(value)
+        return tuple(prefix)
+
     def add_json(self, doc_id, doc):
         """Add this json doc to the index."""
-        keys = self.evaluate_json(doc)
-        if not keys:
-            return
+        self._add_keys(doc_id, self.evaluate_json(doc))
+
+    def add_values(self, doc_id, values):
+        """Add a doc to the index, given the values of its expressions.
+
+        :param values: A dict mapping index expressions to their values.
+        """
+        self._add_keys(doc_id, self._make_keys(
+            [values[expression] for expression in self._definition]))
+
+    def _add_keys(self, doc_id, keys):
         for key in keys:
             self._values.setdefault(key, []).append(doc_id)
 
     def remove_json(self, doc_id, doc):
         """Remove this json doc from the index."""
-        keys = self.evaluate_json(doc)
+        self._remove_keys(doc_id, self.evaluate_json(doc))
+
+    def remove_values(self, doc_id, values):
+        """Remove a doc from the index, given the values of its expressions.
+
+        :param values: A dict mapping index expressions to their values.
+        """
+        self._remove_keys(doc_id, self._make_keys(
+            [values[expression] for expression in self._definition]))
+
+    def _remove_keys(self, doc_id, keys):
         if keys:
             for key in keys:
                 doc_ids = self._values[key]
@@ -378,7 +584,7 @@ class InMemoryIndex(object):
         is_wildcard = False
         last = 0
         for idx, val in enumerate(values):
-            if val.endswith('*'):
+            if _is_glob(val):
                 if val != '*':
                     # We have an 'x*' style wildcard
                     if is_wildcard:
@@ -396,58 +602,112 @@ class InMemoryIndex(object):
             return -1
         return last
 
+    def _expand_values(self, values):
+        """Expand the lists of alternatives in values.
+
+        :return: A list of value tuples, one for each combination of the
+            alternatives, in key order.
+        """
+        expanded = [()]
+        for val in values:
+            if isinstance(val, (list, tuple)):
+                alternatives = sorted(set(val))
+            else:
+                alternatives = [val]
+            expanded = [prefix + (alternative,) for prefix in expanded
+                        for alternative in alternatives]
+        return expanded
+
     def lookup(self, values):
         """Find docs that match the values."""
         last = self._find_non_wildcards(values)
-        if last == -1:
-            return self._lookup_exact(values)
-        else:
+        values = self._typed_values(values)
+        expanded = self._expand_values(values)
+        if expanded == [values]:
+            if last == -1:
+                return self._lookup_exact(values)
             return self._lookup_prefix(values[:last])
+        found = []
+        seen = set()
+        for values in expanded:
+            if last == -1:
+                doc_ids = self._lookup_exact(values)
+            else:
+                doc_ids = self._lookup_prefix(values[:last])
+            for doc_id in doc_ids:
+                if doc_id not in seen:
+                    seen.add(doc_id)
+                    found.append(doc_id)
+        return found
+
+    def lookup_keys(self, values):
+        """Find the keys that match the values."""
+        last = self._find_non_wildcards(values)
+        found = []
+        for values in self._expand_values(self._typed_values(values)):
+            if last == -1:
+                if values in self._values:
+                    found.append(values)
+                continue
+            found.extend([key for key in sorted(self._values)
+                          if key_matches(key, values[:last])])
+        return found
 
     def lookup_range(self, start_values, end_values):
         """Find docs within the range."""
+        found = []
+        for key in self.lookup_range_keys(start_values, end_values):
+            found.extend(self._values[key])
+        return found
+
+    def lookup_range_keys(self, start_values, end_values):
+        """Find the keys within the range."""
         # TODO: Wildly inefficient, which is unlikely to be a problem for the
         # inmemory implementation.
         if start_values:
             self._find_non_wildcards(start_values)
-            start_values = get_prefix(start_values)
+            start_values = self._range_prefix(
+                self._typed_values(start_values))
         if end_values:
-            if self._find_non_wildcards(end_values) == -1:
-                exact = True
-            else:
-                exact = False
-            end_values = get_prefix(end_values)
+            last = self._find_non_wildcards(end_values)
+            end_values = self._typed_values(end_values)
+            exact = last == -1
+            end_prefix = end_values[:last]
+            end_values = self._range_prefix(end_values)
         found = []
-        for key, doc_ids in sorted(self._values.iteritems()):
+        for key in sorted(self._values):
             if start_values and start_values > key:
                 continue
             if end_values and end_values < key:
                 if exact:
                     break
                 else:
-                    if not key.startswith(end_values):
+                    if not key_matches(key, end_prefix):
                         break
-            found.extend(doc_ids)
+            found.append(key)
         return found
 
+    def get_doc_ids(self, key):
+        """Return the doc_ids indexed under key."""
+        return self._values.get(key, ())
+
     def keys(self):
         """Find the indexed keys."""
         return self._values.keys()
 
     def _lookup_prefix(self, value):
-        """Find docs that match the prefix string in values."""
+        """Find docs whose keys start with the values in value."""
         # TODO: We need a different data structure to make prefix style fast,
         #       some sort of sorted list would work, but a plain dict doesn't.
-        key_prefix = get_prefix(value)
         all_doc_ids = []
         for key, doc_ids in sorted(self._values.iteritems()):
-            if key.startswith(key_prefix):
+            if key_matches(key, value):
                 all_doc_ids.extend(doc_ids)
         return all_doc_ids
 
     def _lookup_exact(self, value):
         """Find docs that match exactly."""
-        key = '\x01'.join(value)
+        key = tuple(value)
         if key in self._values:
             return self._values[key]
         return ()
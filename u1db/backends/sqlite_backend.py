@@ -16,8 +16,12 @@
 
 """A U1DB implementation that uses SQLite as its persistence layer."""
 
+import binascii
 import errno
+import itertools
+import multiprocessing
 import os
+import re
 try:
     import simplejson as json
 except ImportError:
@@ -32,22 +36,91 @@ import pkg_resources
 from u1db.backends import CommonBackend, CommonSyncTarget
 from u1db import (
     Document,
+    IndexCursor,
+    content_digest,
     errors,
+    ids,
+    make_trusted_document,
     query_parser,
     vectorclock,
     )
 
 
+def _json_content_digest(json_string):
+    """Return the content_digest of a json document, for use from SQL."""
+    if json_string is None:
+        return None
+    return content_digest(json.loads(json_string))
+
+
 class SQLiteDatabase(CommonBackend):
     """A U1DB implementation that uses SQLite as its persistence layer."""
 
     _sqlite_registry = {}
 
+    # The sql_schema version created by dbschema.sql.
+    _sql_schema_version = 8
+    # Statements upgrading an existing database from a given sql_schema
+    # version to the next one.
+    _sql_schema_upgrades = {
+        0: ["CREATE INDEX IF NOT EXISTS document_fields_doc_id_idx"
+            " ON document_fields(doc_id)"],
+        1: ["ALTER TABLE document ADD COLUMN"
+            " has_conflicts INTEGER NOT NULL DEFAULT 0",
+            "UPDATE document SET has_conflicts = 1"
+            " WHERE doc_id IN (SELECT doc_id FROM conflicts)"],
+        2: ["CREATE TABLE document_changes (doc_id TEXT PRIMARY KEY,"
+            " last_generation INTEGER NOT NULL, last_trans_id TEXT NOT NULL)",
+            "CREATE INDEX document_changes_generation_idx"
+            " ON document_changes(last_generation)",
+            "INSERT OR REPLACE INTO document_changes"
+            " SELECT doc_id, generation, transaction_id FROM transaction_log"
+            " ORDER BY generation"],
+        3: ["CREATE TABLE index_builds (name TEXT, offset INT, field TEXT,"
+            " CONSTRAINT index_builds_pkey PRIMARY KEY (name, offset))"],
+        4: ["ALTER TABLE document ADD COLUMN content_digest TEXT",
+            "ALTER TABLE conflicts ADD COLUMN content_digest TEXT",
+            "UPDATE document"
+            " SET content_digest = u1db_content_digest(content)",
+            "UPDATE conflicts"
+            " SET content_digest = u1db_content_digest(content)"],
+        5: ["CREATE TABLE replica_dictionary ("
+            " replica_id INTEGER PRIMARY KEY,"
+            " replica_uid TEXT NOT NULL UNIQUE)"],
+        6: ["CREATE TABLE retired_replicas (replica_uid TEXT PRIMARY KEY)"],
+        7: ["CREATE TABLE typed_document_fields (doc_id TEXT NOT NULL,"
+            " field_name TEXT NOT NULL, value)",
+            "INSERT INTO typed_document_fields SELECT doc_id, field_name,"
+            " u1db_typed_index_value(field_name, value) FROM document_fields",
+            "DROP TABLE document_fields",
+            "ALTER TABLE typed_document_fields RENAME TO document_fields",
+            "CREATE INDEX document_fields_field_value_doc_idx"
+            " ON document_fields(field_name, value, doc_id)",
+            "CREATE INDEX document_fields_doc_id_idx"
+            " ON document_fields(doc_id)"],
+        }
+
+    # The table holding the index rows that index queries join against
+    # document, the column they are joined on, and the condition selecting
+    # the rows of an index expression, given the alias of the table.
+    _fields_table = 'document_fields'
+    _fields_doc_column = 'doc_id'
+    _fields_field_where = '%s.field_name = ?'
+
     def __init__(self, sqlite_file, document_factory=None):
         """Create a new sqlite file."""
         self._db_handle = dbapi2.connect(sqlite_file)
+        self._db_handle.create_function(
+            'u1db_content_digest', 1, _json_content_digest)
+        self._db_handle.create_function(
+            'u1db_typed_index_value', 2, _typed_index_value)
         self._real_replica_uid = None
+        # Map from index expression => the Getter it parses to.
+        self._field_getters = {}
         self._ensure_schema()
+        self._load_rev_storage()
+        self._load_retired_replicas()
+        self._load_id_allocator()
         self._factory = document_factory or Document
 
     def set_document_factory(self, factory):
@@ -139,8 +212,8 @@ class SQLiteDatabase(CommonBackend):
     def close(self):
         self._close_sqlite_handle()
 
-    def _is_initialized(self, c):
-        """Check if this database has been initialized."""
+    def _get_sql_schema_version(self, c):
+        """Return the sql_schema version, or None if not initialized."""
         c.execute("PRAGMA case_sensitive_like=ON")
         try:
             c.execute("SELECT value FROM u1db_config"
@@ -150,9 +223,13 @@ class SQLiteDatabase(CommonBackend):
             val = None
         else:
             val = c.fetchone()
-        if val is not None:
-            return True
-        return False
+        if val is None:
+            return None
+        return int(val[0])
+
+    def _is_initialized(self, c):
+        """Check if this database has been initialized."""
+        return self._get_sql_schema_version(c) is not None
 
     def _initialize(self, c):
         """Create the schema in the database."""
@@ -183,21 +260,37 @@ class SQLiteDatabase(CommonBackend):
         c.execute("INSERT INTO u1db_config VALUES" " ('index_storage', ?)",
                   (self._index_storage_value,))
 
+    def _upgrade_schema(self, c, version):
+        """Bring an older database up to the current sql_schema version."""
+        while version < self._sql_schema_version:
+            for statement in self._sql_schema_upgrades[version]:
+                c.execute(statement)
+            version += 1
+        c.execute("UPDATE u1db_config SET value = ? WHERE name = 'sql_schema'",
+                  (str(version),))
+
     def _ensure_schema(self):
-        """Ensure that the database schema has been created."""
+        """Ensure that the database schema has been created and upgraded."""
         old_isolation_level = self._db_handle.isolation_level
         c = self._db_handle.cursor()
-        if self._is_initialized(c):
+        if (self._is_initialized(c) and
+            self._get_sql_schema_version(c) >= self._sql_schema_version):
             return
         try:
             # autocommit/own mgmt of transactions
             self._db_handle.isolation_level = None
+            # This only has an effect before the first table is created, and
+            # can not be done inside a transaction.
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL")
             with self._db_handle:
                 # only one execution path should initialize the db
                 c.execute("begin exclusive")
-                if self._is_initialized(c):
+                if not self._is_initialized(c):
+                    self._initialize(c)
                     return
-                self._initialize(c)
+                version = self._get_sql_schema_version(c)
+                if version < self._sql_schema_version:
+                    self._upgrade_schema(c, version)
         finally:
             self._db_handle.isolation_level = old_isolation_level
 
@@ -206,15 +299,82 @@ class SQLiteDatabase(CommonBackend):
 
     def _parse_index_definition(self, index_field):
         """Parse a field definition for an index, returning a Getter."""
-        # Note: We may want to keep a Parser object around, and cache the
-        #       Getter objects for a greater length of time. Specifically, if
-        #       you create a bunch of indexes, and then insert 50k docs, you'll
-        #       re-parse the indexes between puts. The time to insert the docs
-        #       is still likely to dominate put_doc time, though.
         parser = query_parser.Parser()
         getter = parser.parse(index_field)
         return getter
 
+    def _is_numeric_field(self, field):
+        """Return whether the values of an index expression are integers.
+
+        The value column has no type affinity, so the integers of number()
+        and bool() are stored, compared and sorted as numbers. The values of
+        other expressions are stored as text, as they always have been, and
+        the integers of a query on a numeric expression have to be given as
+        numbers.
+        """
+        return self._get_field_getter(field).numeric
+
+    def _get_field_getter(self, field):
+        """Return the Getter of an index expression, parsed once."""
+        getter = self._field_getters.get(field)
+        if getter is None:
+            getter = self._parse_index_definition(field)
+            self._field_getters[field] = getter
+        return getter
+
+    def _typed_key_value(self, field, value):
+        """Return a query value for an index expression as it is stored.
+
+        The expressions that only have integer values can only be queried
+        with integers and '*'.
+        """
+        getter = self._get_field_getter(field)
+        if getter.numeric_only:
+            return query_parser.numeric_query_value(value)
+        if getter.numeric:
+            return query_parser.numeric_key_value(value)
+        return value
+
+    def _execute_field_rows(self, c, statement, rows, adapt=None):
+        """Run statement for (doc_id, field_name, value) index rows.
+
+        :param statement: The statement with a %s where the value goes, and
+            ?3 standing for the value.
+        :param adapt: If given, called on each row before it is used.
+        """
+        numeric = []
+        text = []
+        for row in rows:
+            if self._is_numeric_field(row[1]):
+                numeric.append(row)
+            else:
+                text.append(row)
+        for rows, value in [(numeric, '?3'), (text, 'CAST(?3 AS TEXT)')]:
+            if not rows:
+                continue
+            if adapt is not None:
+                rows = map(adapt, rows)
+            c.executemany(statement % (value,), rows)
+
+    def _get_index_schema_version(self, c):
+        """Return the counter bumped every time the indexes change."""
+        c.execute("SELECT value FROM u1db_config"
+                  " WHERE name = 'index_schema_version'")
+        val = c.fetchone()
+        if val is None:
+            return 0
+        return int(val[0])
+
+    def _bump_index_schema_version(self, c):
+        """Tell every connection that its cached index definitions are stale.
+
+        A transaction should already be held.
+        """
+        c.execute("INSERT OR REPLACE INTO u1db_config"
+                  " VALUES ('index_schema_version', COALESCE((SELECT value"
+                  " FROM u1db_config WHERE name = 'index_schema_version'),"
+                  " 0) + 1)")
+
     def _update_indexes(self, doc_id, raw_doc, getters, db_cursor):
         """Update document_fields for a single document.
 
@@ -226,18 +386,42 @@ class SQLiteDatabase(CommonBackend):
         :param db_cursor: An sqlite Cursor.
         :return: None
         """
+        values = self._get_index_rows(doc_id, raw_doc, getters)
+        self._execute_field_rows(
+            db_cursor, "INSERT INTO document_fields VALUES (?1, ?2, %s)",
+            values)
+
+    def _get_index_rows(self, doc_id, raw_doc, getters):
+        """Evaluate the index definitions for a single document.
+
+        :return: A list of (doc_id, field_name, value) document_fields rows.
+        """
         values = []
         for field_name, getter in getters:
             for idx_value in getter.get(raw_doc):
                 values.append((doc_id, field_name, idx_value))
-        if values:
-            db_cursor.executemany(
-                "INSERT INTO document_fields VALUES (?, ?, ?)", values)
+        return values
+
+    def _count_index_rows(self, docs, plan):
+        """Evaluate the index definitions for documents that may be None.
+
+        :param docs: A list of Documents, or None for missing ones.
+        :param plan: A CompiledPlan of the indexed fields.
+        :return: A dict mapping (doc_id, field_name, value) document_fields
+            rows to the number of times they occur.
+        """
+        counts = {}
+        docs = [(doc.doc_id, doc.get_parsed_json()) for doc in docs
+                if doc is not None and not doc.is_tombstone()]
+        for row in plan.evaluate_many(docs):
+            counts[row] = counts.get(row, 0) + 1
+        return counts
 
     def _set_replica_uid(self, replica_uid):
         """Force the replica_uid to be set."""
         with self._db_handle:
             self._set_replica_uid_in_transaction(replica_uid)
+        self._add_rev_replicas([])
 
     def _set_replica_uid_in_transaction(self, replica_uid):
         """Set the replica_uid. A transaction should already be held."""
@@ -260,21 +444,224 @@ class SQLiteDatabase(CommonBackend):
 
     _replica_uid = property(_get_replica_uid)
 
-    def _get_generation(self):
-        c = self._db_handle.cursor()
-        c.execute('SELECT max(generation) FROM transaction_log')
-        val = c.fetchone()[0]
+    # The ways revisions can be stored, see set_rev_storage.
+    _rev_storages = ('text', 'replica dictionary')
+
+    def set_rev_storage(self, storage):
+        """Choose how revisions are stored in the database.
+
+        The revisions of the existing documents and conflicts are converted.
+        Other connections to the database must be reopened afterwards.
+
+        :param storage: 'text' stores the rev strings as they are, this is
+            the default. 'replica dictionary' numbers the replica uids in the
+            replica_dictionary table, and stores the revs as pairs of
+            numbers. This is much smaller once many replicas have edited the
+            same documents. The rev strings are still what the API returns.
+        """
+        if storage not in self._rev_storages:
+            raise ValueError('Unknown rev storage: %r' % (storage,))
+        try:
+            with self._db_handle:
+                c = self._db_handle.cursor()
+                c.execute("SELECT doc_id, doc_rev FROM document")
+                doc_revs = [(doc_id, self._decode_rev(stored))
+                            for doc_id, stored in c.fetchall()]
+                c.execute("SELECT doc_id, doc_rev FROM conflicts")
+                conflict_revs = [(doc_id, stored, self._decode_rev(stored))
+                                 for doc_id, stored in c.fetchall()]
+                if storage == 'text':
+                    self._replica_ids = self._replica_uids = None
+                else:
+                    revs = [rev for _, rev in doc_revs]
+                    revs.extend([rev for _, _, rev in conflict_revs])
+                    revs.append('%s:0' % (self._replica_uid,))
+                    self._load_replica_dictionary(c)
+                    self._insert_rev_replicas(c, revs)
+                    self._load_replica_dictionary(c)
+                c.executemany(
+                    "UPDATE document SET doc_rev = ? WHERE doc_id = ?",
+                    [(self._encode_rev(rev), doc_id)
+                     for doc_id, rev in doc_revs])
+                c.executemany(
+                    "UPDATE conflicts SET doc_rev = ?"
+                    " WHERE doc_id = ? AND doc_rev = ?",
+                    [(self._encode_rev(rev), doc_id, stored)
+                     for doc_id, stored, rev in conflict_revs])
+                c.execute("INSERT OR REPLACE INTO u1db_config"
+                          " VALUES ('rev_storage', ?)", (storage,))
+        except:
+            self._load_rev_storage()
+            raise
+
+    def _get_rev_storage(self, c):
+        c.execute("SELECT value FROM u1db_config WHERE name = 'rev_storage'")
+        val = c.fetchone()
         if val is None:
-            return 0
-        return val
+            return 'text'
+        return val[0]
+
+    def _load_rev_storage(self):
+        """Read how revisions are stored, and the replica dictionary."""
+        c = self._db_handle.cursor()
+        # The replica dictionary maps replica_uid => number and back, or
+        # they are None when revs are stored as text. The numbers are kept
+        # as strings, the way they appear in the stored revs.
+        self._replica_ids = self._replica_uids = None
+        # Numbers assigned by _encode_rev inside a transaction, which might
+        # have been rolled back. They are never cached.
+        self._unsure_replica_numbers = set()
+        if self._get_rev_storage(c) == 'replica dictionary':
+            self._load_replica_dictionary(c)
+            self._add_rev_replicas([])
+
+    def _load_replica_dictionary(self, c):
+        c.execute("SELECT replica_id, replica_uid FROM replica_dictionary")
+        rows = [(str(number), uid) for number, uid in c.fetchall()
+                if str(number) not in self._unsure_replica_numbers]
+        self._replica_uids = dict(rows)
+        self._replica_ids = dict([(uid, number) for number, uid in rows])
+
+    def _add_rev_replicas(self, revs):
+        """Number the replicas of revs that are not in the dictionary yet.
+
+        This is done in its own transaction before revs are written, so
+        that the numbers can be cached: a number assigned in a transaction
+        that is rolled back can be given to another replica later.
+
+        :param revs: Rev strings, this replica is always added.
+        """
+        if self._replica_ids is None:
+            return
+        revs = list(revs) + ['%s:0' % (self._replica_uid,)]
+        if not self._missing_replicas(revs):
+            return
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            self._insert_rev_replicas(c, revs)
+        # Everything is committed now, so the whole dictionary is certain.
+        self._unsure_replica_numbers.clear()
+        self._load_replica_dictionary(c)
+
+    def _missing_replicas(self, revs):
+        """Return the replica uids of revs missing from the dictionary."""
+        missing = set()
+        for rev in revs:
+            if rev is None:
+                continue
+            for replica_info in rev.split('|'):
+                replica_uid = replica_info.split(':')[0]
+                if replica_uid not in self._replica_ids:
+                    missing.add(replica_uid)
+        return missing
+
+    def _insert_rev_replicas(self, c, revs):
+        c.executemany("INSERT OR IGNORE INTO replica_dictionary (replica_uid)"
+                      " VALUES (?)",
+                      [(uid,) for uid in sorted(self._missing_replicas(revs))])
+
+    def _encode_rev(self, rev):
+        """Return the form of a rev string stored in the database."""
+        replica_ids = self._replica_ids
+        if replica_ids is None or rev is None:
+            return rev
+        pairs = []
+        for replica_info in rev.split('|'):
+            replica_uid, counter = replica_info.split(':')
+            number = replica_ids.get(replica_uid)
+            if number is None:
+                number = self._lookup_replica_number(replica_uid)
+                replica_ids = self._replica_ids
+            pairs.append(number + '.' + counter)
+        return ','.join(pairs)
+
+    def _decode_rev(self, stored):
+        """Return the rev string of a stored rev."""
+        replica_uids = self._replica_uids
+        if replica_uids is None or stored is None:
+            return stored
+        # sqlite returns unicode, mixing in str separators would be slower.
+        pairs = [pair.split(u'.') for pair in stored.split(u',')]
+        try:
+            return u'|'.join([replica_uids[number] + u':' + counter
+                              for number, counter in pairs])
+        except KeyError:
+            return u'|'.join([
+                self._lookup_replica_uid(number) + u':' + counter
+                for number, counter in pairs])
+
+    def _lookup_replica_number(self, replica_uid):
+        """Return the number of a replica missing from the cache."""
+        c = self._db_handle.cursor()
+        # It may have been added by another connection.
+        self._load_replica_dictionary(c)
+        number = self._replica_ids.get(replica_uid)
+        if number is not None:
+            return number
+        # Not added beforehand by _add_rev_replicas.
+        self._insert_rev_replicas(c, ['%s:0' % (replica_uid,)])
+        c.execute("SELECT replica_id FROM replica_dictionary"
+                  " WHERE replica_uid = ?", (replica_uid,))
+        number = str(c.fetchone()[0])
+        self._unsure_replica_numbers.add(number)
+        return number
+
+    def _lookup_replica_uid(self, number):
+        """Return the replica_uid of a number, which may not be cached."""
+        replica_uid = self._replica_uids.get(number)
+        if replica_uid is not None:
+            return replica_uid
+        c = self._db_handle.cursor()
+        if number not in self._unsure_replica_numbers:
+            # It may have been added by another connection.
+            self._load_replica_dictionary(c)
+            replica_uid = self._replica_uids.get(number)
+            if replica_uid is not None:
+                return replica_uid
+        c.execute("SELECT replica_uid FROM replica_dictionary"
+                  " WHERE replica_id = ?", (int(number),))
+        return c.fetchone()[0]
+
+    def _load_id_allocator(self):
+        # New databases are created with time ordered ids, the ones created
+        # before those existed keep random ids.
+        c = self._db_handle.cursor()
+        c.execute("SELECT value FROM u1db_config WHERE name = 'id_allocator'")
+        val = c.fetchone()
+        if val is None or val[0] != 'time_ordered':
+            self._id_allocator = ids.random_id
+
+    def _load_retired_replicas(self):
+        c = self._db_handle.cursor()
+        c.execute("SELECT replica_uid FROM retired_replicas")
+        self._retired_replicas = frozenset([row[0] for row in c.fetchall()])
+
+    def _get_retired_replicas(self):
+        # Connections opened before replicas are retired only learn about
+        # them when reopened. Until then, they see conflicts.
+        return self._retired_replicas
+
+    def _add_retired_replicas(self, replica_uids):
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.executemany("INSERT OR IGNORE INTO retired_replicas VALUES (?)",
+                          [(replica_uid,) for replica_uid in replica_uids])
+        self._load_retired_replicas()
+        self._add_rev_replicas(['%s:0' % (vectorclock.RETIRED_REPLICA_UID,)])
+
+    def _get_generation(self):
+        return self._get_generation_info()[0]
 
     def _get_generation_info(self):
+        # The newest entry in document_changes is always the newest
+        # transaction.
         c = self._db_handle.cursor()
-        c.execute(
-            'SELECT max(generation), transaction_id FROM transaction_log ')
+        c.execute("SELECT last_generation, last_trans_id"
+                  " FROM document_changes"
+                  " ORDER BY last_generation DESC LIMIT 1")
         val = c.fetchone()
-        if val[0] is None:
-            return(0, '')
+        if val is None:
+            return (0, '')
         return val
 
     def _get_trans_id_for_gen(self, generation):
@@ -300,20 +687,18 @@ class SQLiteDatabase(CommonBackend):
         c = self._db_handle.cursor()
         if check_for_conflicts:
             c.execute(
-                "SELECT document.doc_rev, document.content, "
-                "count(conflicts.doc_rev) FROM document LEFT OUTER JOIN "
-                "conflicts ON conflicts.doc_id = document.doc_id WHERE "
-                "document.doc_id = ? GROUP BY document.doc_id, "
-                "document.doc_rev, document.content;", (doc_id,))
+                "SELECT doc_rev, content, has_conflicts, content_digest"
+                " FROM document WHERE doc_id = ?", (doc_id,))
         else:
             c.execute(
-                "SELECT doc_rev, content, 0 FROM document WHERE doc_id = ?",
-                (doc_id,))
+                "SELECT doc_rev, content, 0, content_digest FROM document"
+                " WHERE doc_id = ?", (doc_id,))
         val = c.fetchone()
         if val is None:
             return None
-        doc_rev, content, conflicts = val
-        doc = self._factory(doc_id, doc_rev, content)
+        doc_rev, content, conflicts, digest = val
+        doc = make_trusted_document(
+            self._factory, doc_id, self._decode_rev(doc_rev), content, digest)
         doc.has_conflicts = conflicts > 0
         return doc
 
@@ -335,21 +720,39 @@ class SQLiteDatabase(CommonBackend):
             return None
         return doc
 
+    def get_docs(self, doc_ids, check_for_conflicts=True,
+                 include_deleted=False):
+        # Fetch the documents a chunk at a time, rather than one query per
+        # doc_id, while still streaming them in the requested order.
+        doc_ids = iter(doc_ids)
+        while True:
+            chunk = list(itertools.islice(doc_ids, self._max_sql_variables))
+            if not chunk:
+                return
+            docs = self._get_docs_by_id(chunk)
+            for doc_id in chunk:
+                doc = docs.get(doc_id)
+                if doc is None:
+                    continue
+                if doc.is_tombstone() and not include_deleted:
+                    continue
+                if not check_for_conflicts:
+                    doc.has_conflicts = False
+                yield doc
+
     def get_all_docs(self, include_deleted=False):
         """Get all documents from the database."""
         generation = self._get_generation()
         results = []
         c = self._db_handle.cursor()
         c.execute(
-            "SELECT document.doc_id, document.doc_rev, document.content, "
-            "count(conflicts.doc_rev) FROM document LEFT OUTER JOIN conflicts "
-            "ON conflicts.doc_id = document.doc_id GROUP BY document.doc_id, "
-            "document.doc_rev, document.content;")
+            "SELECT doc_id, doc_rev, content, has_conflicts FROM document")
         rows = c.fetchall()
         for doc_id, doc_rev, content, conflicts in rows:
             if content is None and not include_deleted:
                 continue
-            doc = self._factory(doc_id, doc_rev, content)
+            doc = make_trusted_document(
+                self._factory, doc_id, self._decode_rev(doc_rev), content)
             doc.has_conflicts = conflicts > 0
             results.append(doc)
         return (generation, results)
@@ -361,22 +764,63 @@ class SQLiteDatabase(CommonBackend):
         self._check_doc_size(doc)
         with self._db_handle:
             old_doc = self._get_doc(doc.doc_id, check_for_conflicts=True)
-            if old_doc and old_doc.has_conflicts:
-                raise errors.ConflictedDoc()
-            if old_doc and doc.rev is None and old_doc.is_tombstone():
-                new_rev = self._allocate_doc_rev(old_doc.rev)
-            else:
-                if old_doc is not None:
-                        if old_doc.rev != doc.rev:
-                            raise errors.RevisionConflict()
-                else:
-                    if doc.rev is not None:
-                        raise errors.RevisionConflict()
-                new_rev = self._allocate_doc_rev(doc.rev)
+            new_rev = self._check_put_doc(old_doc, doc)
             doc.rev = new_rev
             self._put_and_update_indexes(old_doc, doc)
         return new_rev
 
+    # SQLite refuses statements with more than 999 host parameters.
+    _max_sql_variables = 999
+
+    def _get_docs_by_id(self, doc_ids):
+        """Get the stored documents with their conflict flag set.
+
+        :return: A dict mapping doc_id => Document, for the doc_ids that exist.
+        """
+        c = self._db_handle.cursor()
+        docs = {}
+        doc_ids = list(doc_ids)
+        step = self._max_sql_variables
+        for start in range(0, len(doc_ids), step):
+            chunk = doc_ids[start:start + step]
+            c.execute(
+                "SELECT doc_id, doc_rev, content, has_conflicts FROM document"
+                " WHERE doc_id IN (%s)" % (','.join('?' * len(chunk)),),
+                chunk)
+            for doc_id, doc_rev, content, conflicts in c.fetchall():
+                doc = make_trusted_document(
+                    self._factory, doc_id, self._decode_rev(doc_rev), content)
+                doc.has_conflicts = conflicts > 0
+                docs[doc_id] = doc
+        return docs
+
+    def put_docs(self, docs):
+        results = []
+        with self._db_handle:
+            cur_docs = self._get_docs_by_id(
+                set([doc.doc_id for doc in docs if doc.doc_id is not None]))
+            to_write = []
+            for doc in docs:
+                try:
+                    if doc.doc_id is None:
+                        raise errors.InvalidDocId()
+                    self._check_doc_id(doc.doc_id)
+                    self._check_doc_size(doc)
+                    old_doc = cur_docs.get(doc.doc_id)
+                    new_rev = self._check_put_doc(old_doc, doc)
+                except errors.U1DBError, e:
+                    results.append(e)
+                    continue
+                doc.rev = new_rev
+                to_write.append((old_doc, doc))
+                # Later documents in the batch with the same doc_id must be
+                # checked against this one.
+                cur_docs[doc.doc_id] = doc
+                results.append(new_rev)
+            if to_write:
+                self._put_docs_and_update_indexes(to_write)
+        return results
+
     def _expand_to_fields(self, doc_id, base_field, raw_doc, save_none):
         """Convert a dict representation into named fields.
 
@@ -412,39 +856,96 @@ class SQLiteDatabase(CommonBackend):
         This both updates the existing documents content, and any indexes that
         refer to this document.
         """
-        raise NotImplementedError(self._put_and_update_indexes)
+        self._put_docs_and_update_indexes([(old_doc, doc)])
+
+    def _put_docs_and_update_indexes(self, old_and_new_docs):
+        """Actually insert many documents into the database.
+
+        :param old_and_new_docs: A list of (old_doc, doc) pairs, in the order
+            the changes happened. old_doc is None for new documents. The same
+            doc_id may appear several times, in which case old_doc is the doc
+            of the previous pair.
+        """
+        raise NotImplementedError(self._put_docs_and_update_indexes)
 
     def whats_changed(self, old_generation=0):
         c = self._db_handle.cursor()
-        c.execute("SELECT generation, doc_id, transaction_id"
-                  " FROM transaction_log"
-                  " WHERE generation > ? ORDER BY generation DESC",
+        c.execute("SELECT doc_id, last_generation, last_trans_id"
+                  " FROM document_changes"
+                  " WHERE last_generation > ? ORDER BY last_generation",
                   (old_generation,))
-        results = c.fetchall()
-        cur_gen = old_generation
-        seen = set()
-        changes = []
-        newest_trans_id = ''
-        for generation, doc_id, trans_id in results:
-            if doc_id not in seen:
-                changes.append((doc_id, generation, trans_id))
-                seen.add(doc_id)
+        changes = c.fetchall()
         if changes:
-            cur_gen = changes[0][1]  # max generation
-            newest_trans_id = changes[0][2]
-            changes.reverse()
+            cur_gen, newest_trans_id = changes[-1][1:]
         else:
-            c.execute("SELECT generation, transaction_id"
-                      " FROM transaction_log ORDER BY generation DESC LIMIT 1")
-            results = c.fetchone()
-            if not results:
-                cur_gen = 0
-                newest_trans_id = ''
-            else:
-                cur_gen, newest_trans_id = results
-
+            cur_gen, newest_trans_id = self._get_generation_info()
         return cur_gen, newest_trans_id, changes
 
+    def _get_compacted_generation(self, c):
+        """Return the generation history was last compacted up to."""
+        c.execute("SELECT value FROM u1db_config"
+                  " WHERE name = 'compacted_generation'")
+        val = c.fetchone()
+        if val is None:
+            return 0
+        return int(val[0])
+
+    def validate_gen_and_trans_id(self, generation, trans_id):
+        c = self._db_handle.cursor()
+        if 0 < generation < self._get_compacted_generation(c):
+            raise errors.GenerationCompacted
+        super(SQLiteDatabase, self).validate_gen_and_trans_id(
+            generation, trans_id)
+
+    def compact(self, keep_generations_after):
+        """Drop the history that syncing replicas no longer need.
+
+        Transaction log entries older than the horizon that have been
+        superseded by a later change of the same document are removed, as are
+        unconflicted tombstones deleted before the horizon. Replicas that
+        last synced before the horizon get GenerationCompacted, and have to
+        sync again from scratch.
+
+        :param keep_generations_after: The horizon, the oldest generation
+            that any replica is known to still sync from.
+        :return: The horizon actually used, which is never past the current
+            generation.
+        """
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            horizon = max(0, min(keep_generations_after,
+                                 self._get_generation()))
+            horizon = max(horizon, self._get_compacted_generation(c))
+            c.execute("DELETE FROM transaction_log WHERE generation < ? AND"
+                      " NOT EXISTS (SELECT 1 FROM document_changes"
+                      " WHERE last_generation = transaction_log.generation)",
+                      (horizon,))
+            c.execute("SELECT d.doc_id, dc.last_generation"
+                      " FROM document d, document_changes dc"
+                      " WHERE d.doc_id = dc.doc_id AND d.content IS NULL"
+                      " AND d.has_conflicts = 0 AND dc.last_generation < ?",
+                      (horizon,))
+            purged = c.fetchall()
+            c.executemany("DELETE FROM document WHERE doc_id = ?",
+                          [(doc_id,) for doc_id, _ in purged])
+            c.executemany("DELETE FROM document_changes WHERE doc_id = ?",
+                          [(doc_id,) for doc_id, _ in purged])
+            c.executemany("DELETE FROM transaction_log WHERE generation = ?",
+                          [(generation,) for _, generation in purged])
+            c.execute("INSERT OR REPLACE INTO u1db_config"
+                      " VALUES ('compacted_generation', ?)", (horizon,))
+        c = self._db_handle.cursor()
+        c.execute("PRAGMA auto_vacuum")
+        if c.fetchone()[0] == 2:
+            c.execute("PRAGMA incremental_vacuum")
+            c.fetchall()
+        else:
+            # Databases created before auto_vacuum was enabled need one full
+            # VACUUM to switch it on.
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            c.execute("VACUUM")
+        return horizon
+
     def delete_doc(self, doc):
         with self._db_handle:
             old_doc = self._get_doc(doc.doc_id, check_for_conflicts=True)
@@ -466,7 +967,8 @@ class SQLiteDatabase(CommonBackend):
         c = self._db_handle.cursor()
         c.execute("SELECT doc_rev, content FROM conflicts WHERE doc_id = ?",
                   (doc_id,))
-        return [self._factory(doc_id, doc_rev, content)
+        return [make_trusted_document(self._factory, doc_id,
+                                      self._decode_rev(doc_rev), content)
                 for doc_rev, content in c.fetchall()]
 
     def get_doc_conflicts(self, doc_id):
@@ -508,49 +1010,64 @@ class SQLiteDatabase(CommonBackend):
 
     def _put_doc_if_newer(self, doc, save_conflict, replica_uid=None,
                           replica_gen=None, replica_trans_id=None):
+        self._add_rev_replicas([doc.rev])
         with self._db_handle:
             return super(SQLiteDatabase, self)._put_doc_if_newer(doc,
                 save_conflict=save_conflict,
                 replica_uid=replica_uid, replica_gen=replica_gen,
                 replica_trans_id=replica_trans_id)
 
-    def _add_conflict(self, c, doc_id, my_doc_rev, my_content):
-        c.execute("INSERT INTO conflicts VALUES (?, ?, ?)",
-                  (doc_id, my_doc_rev, my_content))
+    def _add_conflict(self, c, doc_id, my_doc_rev, my_content, my_digest):
+        c.execute("INSERT INTO conflicts VALUES (?, ?, ?, ?)",
+                  (doc_id, self._encode_rev(my_doc_rev), my_content,
+                   my_digest))
+        c.execute("UPDATE document SET has_conflicts = 1 WHERE doc_id = ?",
+                  (doc_id,))
 
     def _delete_conflicts(self, c, doc, conflict_revs):
-        deleting = [(doc.doc_id, c_rev) for c_rev in conflict_revs]
+        deleting = [(doc.doc_id, self._encode_rev(c_rev))
+                    for c_rev in conflict_revs]
         c.executemany("DELETE FROM conflicts"
                       " WHERE doc_id=? AND doc_rev=?", deleting)
         doc.has_conflicts = self._has_conflicts(doc.doc_id)
+        c.execute("UPDATE document SET has_conflicts = ? WHERE doc_id = ?",
+                  (int(doc.has_conflicts), doc.doc_id))
 
     def _prune_conflicts(self, doc, doc_vcr):
         if self._has_conflicts(doc.doc_id):
-            autoresolved = False
+            autoresolved = []
             c_revs_to_prune = []
-            for c_doc in self._get_conflicts(doc.doc_id):
-                c_vcr = vectorclock.VectorClockRev(c_doc.rev)
+            # Only the digests of the conflicts are needed to compare their
+            # content. They are missing from rows written by the C backend.
+            c = self._db_handle.cursor()
+            c.execute("SELECT doc_rev,"
+                      " COALESCE(content_digest, u1db_content_digest(content))"
+                      " FROM conflicts WHERE doc_id = ?", (doc.doc_id,))
+            digest = doc.get_content_digest()
+            for c_rev, c_digest in c.fetchall():
+                c_rev = self._decode_rev(c_rev)
+                c_vcr = vectorclock.VectorClockRev(c_rev)
                 if doc_vcr.is_newer(c_vcr):
-                    c_revs_to_prune.append(c_doc.rev)
-                elif doc.same_content_as(c_doc):
-                    c_revs_to_prune.append(c_doc.rev)
+                    c_revs_to_prune.append(c_rev)
+                elif digest == c_digest:
+                    c_revs_to_prune.append(c_rev)
                     doc_vcr.maximize(c_vcr)
-                    autoresolved = True
+                    autoresolved.append(c_rev)
             if autoresolved:
-                doc_vcr.increment(self._replica_uid)
-                doc.rev = doc_vcr.as_str()
-            c = self._db_handle.cursor()
+                doc.rev = self._ensure_maximal_rev(doc.rev, autoresolved)
             self._delete_conflicts(c, doc, c_revs_to_prune)
 
     def _force_doc_sync_conflict(self, doc):
         my_doc = self._get_doc(doc.doc_id)
         c = self._db_handle.cursor()
         self._prune_conflicts(doc, vectorclock.VectorClockRev(doc.rev))
-        self._add_conflict(c, doc.doc_id, my_doc.rev, my_doc.get_json())
+        self._add_conflict(c, doc.doc_id, my_doc.rev, my_doc.get_json(),
+                           my_doc.get_content_digest())
         doc.has_conflicts = True
         self._put_and_update_indexes(my_doc, doc)
 
     def resolve_doc(self, doc, conflicted_doc_revs):
+        self._add_rev_replicas(conflicted_doc_revs)
         with self._db_handle:
             cur_doc = self._get_doc(doc.doc_id)
             # TODO: https://bugs.launchpad.net/u1db/+bug/928274
@@ -574,7 +1091,8 @@ class SQLiteDatabase(CommonBackend):
             if cur_doc.rev in superseded_revs:
                 self._put_and_update_indexes(cur_doc, doc)
             else:
-                self._add_conflict(c, doc.doc_id, new_rev, doc.get_json())
+                self._add_conflict(c, doc.doc_id, new_rev, doc.get_json(),
+                                   doc.get_content_digest())
             # TODO: Is there some way that we could construct a rev that would
             #       end up in superseded_revs, such that we add a conflict, and
             #       then immediately delete it?
@@ -616,19 +1134,41 @@ class SQLiteDatabase(CommonBackend):
         # against itself, as many times as the 'width' of our definition.
         # We then do a query for each key_value, one-at-a-time.
         # Note: All of these strings are static, we could cache them, etc.
-        tables = ["document_fields d%d" % i for i in range(len(definition))]
-        novalue_where = ["d.doc_id = d%d.doc_id"
-                         " AND d%d.field_name = ?"
-                         % (i, i) for i in range(len(definition))]
-        wildcard_where = [novalue_where[i]
+        tables = ["%s d%d" % (self._fields_table, i)
+                  for i in range(len(definition))]
+        where, args = self._format_query_where(definition, key_values)
+        statement = (
+            "SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM "
+            "document d, %s WHERE %s GROUP BY d.doc_id ORDER BY %s;" % (
+                ', '.join(tables), ' AND '.join(where), ', '.join(
+                    ['d%d.value' % i for i in range(len(definition))])))
+        return statement, args
+
+    def _format_query_where(self, definition, key_values,
+                            doc_id_column=None, first_table=0):
+        """Return the where clauses and arguments matching key_values.
+
+        A key value may also be a list of values, matching any of them.
+
+        :param doc_id_column: The column that every document_fields table is
+            joined against, by default the one of the document table d.
+        :param first_table: The number of the first document_fields table,
+            the tables are named d<first_table>, d<first_table + 1>, ...
+        """
+        if doc_id_column is None:
+            doc_id_column = 'd.' + self._fields_doc_column
+        tables = range(first_table, first_table + len(definition))
+        novalue_where = [self._format_fields_where(i, doc_id_column)
+                         for i in tables]
+        wildcard_where = [novalue_where[idx]
                           + (" AND d%d.value NOT NULL" % (i,))
-                          for i in range(len(definition))]
-        exact_where = [novalue_where[i]
+                          for idx, i in enumerate(tables)]
+        exact_where = [novalue_where[idx]
                        + (" AND d%d.value = ?" % (i,))
-                       for i in range(len(definition))]
-        like_where = [novalue_where[i]
+                       for idx, i in enumerate(tables)]
+        like_where = [novalue_where[idx]
                       + (" AND d%d.value GLOB ?" % (i,))
-                      for i in range(len(definition))]
+                      for idx, i in enumerate(tables)]
         is_wildcard = False
         # Merge the lists together, so that:
         # [field1, field2, field3], [val1, val2, val3]
@@ -638,7 +1178,15 @@ class SQLiteDatabase(CommonBackend):
         where = []
         for idx, (field, value) in enumerate(zip(definition, key_values)):
             args.append(field)
-            if value.endswith('*'):
+            value = self._typed_key_value(field, value)
+            if isinstance(value, (list, tuple)):
+                if is_wildcard:
+                    raise errors.InvalidGlobbing
+                where.append(novalue_where[idx] + (
+                    " AND d%d.value IN (%s)"
+                    % (tables[idx], ', '.join(['?'] * len(value)))))
+                args.extend(value)
+            elif isinstance(value, basestring) and value.endswith('*'):
                 if value == '*':
                     where.append(wildcard_where[idx])
                 else:
@@ -647,7 +1195,14 @@ class SQLiteDatabase(CommonBackend):
                         # We can't have a partial wildcard following
                         # another wildcard
                         raise errors.InvalidGlobbing
-                    where.append(like_where[idx])
+                    if self._is_numeric_field(field):
+                        # GLOB would match integers by their text, but
+                        # globs only match text values.
+                        where.append(
+                            like_where[idx] + " AND typeof(d%d.value) = 'text'"
+                            % (tables[idx],))
+                    else:
+                        where.append(like_where[idx])
                     args.append(value)
                 is_wildcard = True
             else:
@@ -655,13 +1210,21 @@ class SQLiteDatabase(CommonBackend):
                     raise errors.InvalidGlobbing
                 where.append(exact_where[idx])
                 args.append(value)
-        statement = (
-            "SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM "
-            "document d, %s LEFT OUTER JOIN conflicts c ON c.doc_id = "
-            "d.doc_id WHERE %s GROUP BY d.doc_id, d.doc_rev, d.content ORDER "
-            "BY %s;" % (', '.join(tables), ' AND '.join(where), ', '.join(
-                ['d%d.value' % i for i in range(len(definition))])))
-        return statement, args
+        return where, args
+
+    def _format_fields_where(self, table, doc_id_column):
+        """Return the clause selecting the index rows of table d<table>.
+
+        The rows belong to the index expression given as argument, and the
+        document in doc_id_column, unless that is the column of the table
+        itself.
+        """
+        alias = "d%d" % (table,)
+        field_where = self._fields_field_where % (alias,)
+        column = "%s.%s" % (alias, self._fields_doc_column)
+        if doc_id_column == column:
+            return field_where
+        return "%s = %s AND %s" % (doc_id_column, column, field_where)
 
     def get_from_index(self, index_name, *key_values):
         definition = self._get_index_definition(index_name)
@@ -677,16 +1240,93 @@ class SQLiteDatabase(CommonBackend):
         res = c.fetchall()
         results = []
         for row in res:
-            doc = self._factory(row[0], row[1], row[2])
+            doc = make_trusted_document(
+                self._factory, row[0], self._decode_rev(row[1]), row[2])
             doc.has_conflicts = row[3] > 0
             results.append(doc)
         return results
 
-    def _format_range_query(self, definition, start_value, end_value):
+    def get_doc_ids_from_index(self, index_name, *key_values):
+        definition = self._get_index_definition(index_name)
+        if len(key_values) != len(definition):
+            raise errors.InvalidValueForIndex()
+        where, args = self._format_query_where(
+            definition, key_values, doc_id_column='d0.doc_id')
         tables = ["document_fields d%d" % i for i in range(len(definition))]
+        statement = (
+            "SELECT d0.doc_id FROM %s WHERE %s GROUP BY d0.doc_id ORDER BY %s"
+            % (', '.join(tables), ' AND '.join(where), ', '.join(
+                ['d%d.value' % i for i in range(len(definition))])))
+        c = self._db_handle.cursor()
+        c.execute(statement, tuple(args))
+        return [doc_id for doc_id, in c.fetchall()]
+
+    def count_from_index(self, index_name, *key_values):
+        definition = self._get_index_definition(index_name)
+        if len(key_values) != len(definition):
+            raise errors.InvalidValueForIndex()
+        doc_id_column = 'd0.' + self._fields_doc_column
+        where, args = self._format_query_where(
+            definition, key_values, doc_id_column=doc_id_column)
+        tables = ["%s d%d" % (self._fields_table, i)
+                  for i in range(len(definition))]
+        statement = "SELECT count(DISTINCT %s) FROM %s WHERE %s" % (
+            doc_id_column, ', '.join(tables), ' AND '.join(where))
+        c = self._db_handle.cursor()
+        c.execute(statement, tuple(args))
+        return c.fetchone()[0]
+
+    def get_from_index_intersection(self, queries):
+        if not queries:
+            raise errors.InvalidValueForIndex()
+        tables = []
+        where = []
+        args = []
+        order = []
+        for query in queries:
+            index_name, key_values = query[0], query[1:]
+            definition = self._get_index_definition(index_name)
+            if len(key_values) != len(definition):
+                raise errors.InvalidValueForIndex()
+            query_where, query_args = self._format_query_where(
+                definition, key_values, first_table=len(tables))
+            if not order:
+                order = ['d%d.value' % i for i in range(len(definition))]
+            tables.extend(["%s d%d" % (self._fields_table, i) for i in range(
+                len(tables), len(tables) + len(definition))])
+            where.extend(query_where)
+            args.extend(query_args)
+        statement = (
+            "SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM "
+            "document d, %s WHERE %s GROUP BY d.doc_id ORDER BY %s;" % (
+                ', '.join(tables), ' AND '.join(where), ', '.join(order)))
+        c = self._db_handle.cursor()
+        c.execute(statement, tuple(args))
+        results = []
+        for row in c.fetchall():
+            doc = make_trusted_document(
+                self._factory, row[0], self._decode_rev(row[1]), row[2])
+            doc.has_conflicts = row[3] > 0
+            results.append(doc)
+        return results
+
+    def _format_range_query(self, definition, start_value, end_value):
+        tables = ["%s d%d" % (self._fields_table, i)
+                  for i in range(len(definition))]
+        where, args = self._format_range_query_where(
+            definition, start_value, end_value)
+        statement = (
+            "SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM "
+            "document d, %s WHERE %s GROUP BY d.doc_id ORDER BY %s;" % (
+                ', '.join(tables), ' AND '.join(where), ', '.join(
+                    ['d%d.value' % i for i in range(len(definition))])))
+        return statement, args
+
+    def _format_range_query_where(self, definition, start_value, end_value):
+        """Return the where clauses and arguments selecting the range."""
         novalue_where = [
-            "d.doc_id = d%d.doc_id AND d%d.field_name = ?" % (i, i) for i in
-            range(len(definition))]
+            self._format_fields_where(i, 'd.' + self._fields_doc_column)
+            for i in range(len(definition))]
         wildcard_where = [
             novalue_where[i] + (" AND d%d.value NOT NULL" % (i,)) for i in
             range(len(definition))]
@@ -710,7 +1350,8 @@ class SQLiteDatabase(CommonBackend):
             is_wildcard = False
             for idx, (field, value) in enumerate(zip(definition, start_value)):
                 args.append(field)
-                if value.endswith('*'):
+                value = self._typed_key_value(field, value)
+                if isinstance(value, basestring) and value.endswith('*'):
                     if value == '*':
                         where.append(wildcard_where[idx])
                     else:
@@ -735,7 +1376,8 @@ class SQLiteDatabase(CommonBackend):
             is_wildcard = False
             for idx, (field, value) in enumerate(zip(definition, end_value)):
                 args.append(field)
-                if value.endswith('*'):
+                value = self._typed_key_value(field, value)
+                if isinstance(value, basestring) and value.endswith('*'):
                     if value == '*':
                         where.append(wildcard_where[idx])
                     else:
@@ -753,13 +1395,7 @@ class SQLiteDatabase(CommonBackend):
                         raise errors.InvalidGlobbing
                     where.append(range_where_upper[idx])
                     args.append(value)
-        statement = (
-            "SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM "
-            "document d, %s LEFT OUTER JOIN conflicts c ON c.doc_id = "
-            "d.doc_id WHERE %s GROUP BY d.doc_id, d.doc_rev, d.content ORDER "
-            "BY %s;" % (', '.join(tables), ' AND '.join(where), ', '.join(
-                ['d%d.value' % i for i in range(len(definition))])))
-        return statement, args
+        return where, args
 
     def get_range_from_index(self, index_name, start_value=None,
                              end_value=None):
@@ -776,7 +1412,8 @@ class SQLiteDatabase(CommonBackend):
         res = c.fetchall()
         results = []
         for row in res:
-            doc = self._factory(row[0], row[1], row[2])
+            doc = make_trusted_document(
+                self._factory, row[0], self._decode_rev(row[1]), row[2])
             doc.has_conflicts = row[3] > 0
             results.append(doc)
         return results
@@ -786,10 +1423,11 @@ class SQLiteDatabase(CommonBackend):
         definition = self._get_index_definition(index_name)
         value_fields = ', '.join([
             'd%d.value' % i for i in range(len(definition))])
-        tables = ["document_fields d%d" % i for i in range(len(definition))]
+        tables = ["%s d%d" % (self._fields_table, i)
+                  for i in range(len(definition))]
         novalue_where = [
-            "d.doc_id = d%d.doc_id AND d%d.field_name = ?" % (i, i) for i in
-            range(len(definition))]
+            self._format_fields_where(i, 'd.' + self._fields_doc_column)
+            for i in range(len(definition))]
         where = [
             novalue_where[i] + (" AND d%d.value NOT NULL" % (i,)) for i in
             range(len(definition))]
@@ -804,14 +1442,144 @@ class SQLiteDatabase(CommonBackend):
                 '\nstatement: %s\nargs: %s\n' % (statement, tuple(definition)))
         return c.fetchall()
 
+    @staticmethod
+    def _format_resume_where(columns, position, descending):
+        """Return a where clause selecting the rows sorted after position.
+
+        Rows are sorted on columns, which are compared in turn with the
+        entries of position.
+        """
+        op = descending and '<' or '>'
+        alternatives = []
+        # The redundant bound on the first column lets sqlite use an index.
+        args = [position[0]]
+        for i, column in enumerate(columns):
+            alternatives.append('(%s)' % ' AND '.join(
+                ['%s = ?' % prev for prev in columns[:i]]
+                + ['%s %s ?' % (column, op)]))
+            args.extend(position[:i + 1])
+        clause = '%s %s= ? AND (%s)' % (
+            columns[0], op, ' OR '.join(alternatives))
+        return clause, args
+
+    def _iter_index_query(self, columns, extra_columns, tables, where, args,
+                          make_result, limit, descending, resume_token,
+                          distinct=False):
+        """Run an index query, returning an IndexCursor over its rows.
+
+        :param columns: The columns giving the position of each row, in the
+            order the rows are sorted in.
+        :param extra_columns: The other columns to select.
+        :param make_result: A function called with the values of columns and
+            of extra_columns for a row, returning the result for that row.
+        """
+        where = list(where)
+        args = list(args)
+        if resume_token is not None:
+            position = IndexCursor.decode_resume_token(
+                resume_token, len(columns))
+            clause, clause_args = self._format_resume_where(
+                columns, self._row_from_position(position), descending)
+            where.append(clause)
+            args.extend(clause_args)
+        order = descending and ' DESC' or ''
+        statement = "SELECT %s%s FROM %s WHERE %s ORDER BY %s" % (
+            distinct and 'DISTINCT ' or '', ', '.join(columns + extra_columns),
+            ', '.join(tables), ' AND '.join(where),
+            ', '.join([column + order for column in columns]))
+        if limit is not None:
+            statement += " LIMIT ?"
+            args.append(limit)
+        c = self._db_handle.cursor()
+        c.execute(statement, tuple(args))
+
+        def iter_rows():
+            n_columns = len(columns)
+            while True:
+                next_rows = c.fetchmany()
+                if not next_rows:
+                    break
+                for row in next_rows:
+                    yield (self._position_from_row(row[:n_columns]),
+                           make_result(row[:n_columns], row[n_columns:]))
+        return IndexCursor(iter_rows(), resume_token)
+
+    def _position_from_row(self, row):
+        """Return the resume position for the sorted columns of a row."""
+        return list(row)
+
+    def _row_from_position(self, position):
+        """Return the values of the sorted columns at a resume position."""
+        return position
+
+    def _make_index_doc(self, row, extra):
+        doc_rev, content, n_conflicts = extra
+        doc = make_trusted_document(
+            self._factory, row[-1], self._decode_rev(doc_rev), content)
+        doc.has_conflicts = n_conflicts > 0
+        return doc
+
+    def _iter_index_docs(self, definition, where, args, limit, descending,
+                         resume_token):
+        """Return an IndexCursor of the documents matching where."""
+        tables = ["document d"] + [
+            "%s d%d" % (self._fields_table, i)
+            for i in range(len(definition))]
+        columns = ['d%d.value' % i for i in range(len(definition))]
+        columns.append('d.doc_id')
+        extra_columns = ['d.doc_rev', 'd.content', 'd.has_conflicts']
+        return self._iter_index_query(
+            columns, extra_columns, tables, where, args, self._make_index_doc,
+            limit, descending, resume_token)
+
+    def iter_from_index(self, index_name, key_values, limit=None,
+                        descending=False, resume_token=None):
+        definition = self._get_index_definition(index_name)
+        if len(key_values) != len(definition):
+            raise errors.InvalidValueForIndex()
+        where, args = self._format_query_where(definition, key_values)
+        return self._iter_index_docs(
+            definition, where, args, limit, descending, resume_token)
+
+    def iter_range_from_index(self, index_name, start_value=None,
+                              end_value=None, limit=None, descending=False,
+                              resume_token=None):
+        definition = self._get_index_definition(index_name)
+        if start_value or end_value:
+            where, args = self._format_range_query_where(
+                definition, start_value, end_value)
+        else:
+            where, args = self._format_query_where(
+                definition, ['*'] * len(definition))
+        return self._iter_index_docs(
+            definition, where, args, limit, descending, resume_token)
+
+    def iter_index_keys(self, index_name, limit=None, descending=False,
+                        resume_token=None):
+        definition = self._get_index_definition(index_name)
+        where, args = self._format_query_where(
+            definition, ['*'] * len(definition))
+        tables = ["document d"] + [
+            "%s d%d" % (self._fields_table, i)
+            for i in range(len(definition))]
+        columns = ['d%d.value' % i for i in range(len(definition))]
+        return self._iter_index_query(
+            columns, [], tables, where, args,
+            lambda row, extra: tuple(row), limit, descending,
+            resume_token, distinct=True)
+
     def delete_index(self, index_name):
         with self._db_handle:
             c = self._db_handle.cursor()
             c.execute("DELETE FROM index_definitions WHERE name = ?",
                       (index_name,))
+            c.execute("DELETE FROM index_builds WHERE name = ?",
+                      (index_name,))
+            self._bump_index_schema_version(c)
             c.execute(
                 "DELETE FROM document_fields WHERE document_fields.field_name "
-                " NOT IN (SELECT field from index_definitions)")
+                " NOT IN (SELECT field from index_definitions"
+                " UNION SELECT field FROM index_builds)")
 
 
 class SQLiteSyncTarget(CommonSyncTarget):
@@ -842,85 +1610,1154 @@ class SQLitePartialExpandDatabase(SQLiteDatabase):
 
     _index_storage_value = 'expand referenced'
 
+    # Building an index over at least this many documents evaluates them in
+    # a pool of worker processes.
+    _parallel_index_build_threshold = 10000
+    # The number of documents read and evaluated at a time.
+    _index_build_chunk_size = 1000
+    # The number of documents indexed per transaction by create_index_online.
+    _online_index_build_batch_size = 100
+    # The statements adding and removing (doc_id, field, value) index rows,
+    # for _execute_field_rows.
+    _insert_field_row = "INSERT INTO document_fields VALUES (?1, ?2, %s)"
+    _delete_field_row = ("DELETE FROM document_fields WHERE doc_id = ?1"
+                         " AND field_name = ?2 AND value IS %s")
+
+    def __init__(self, sqlite_file, document_factory=None):
+        super(SQLitePartialExpandDatabase, self).__init__(
+            sqlite_file, document_factory=document_factory)
+        # Map from index expression => Getter, for all indexed fields. It is
+        # valid as long as the stored index_schema_version does not change.
+        self._index_getters = None
+        self._index_getters_version = None
+        # A CompiledPlan evaluating all the indexed fields at once.
+        self._index_plan = None
+        self._index_build_processes = None
+        self._index_build_progress = None
+
+    def set_index_build_options(self, processes=None, progress=None):
+        """Set how create_index evaluates existing documents.
+
+        :param processes: The number of worker processes for large databases,
+            1 to always build in this process. Defaults to the number of CPUs.
+        :param progress: A callable, called as progress(done, total) with the
+            number of documents evaluated so far and the total number.
+        """
+        self._index_build_processes = processes
+        self._index_build_progress = progress
+
+    def _get_index_getters(self):
+        """Return a dict mapping every indexed field to its Getter.
+
+        The Getters are only parsed again when the index definitions have
+        been changed, possibly by another connection.
+        """
+        c = self._db_handle.cursor()
+        version = self._get_index_schema_version(c)
+        if (self._index_getters is None
+                or version != self._index_getters_version):
+            self._load_index_getters(c)
+            self._index_getters_version = version
+        return self._index_getters
+
+    def _load_index_getters(self, c):
+        """(Re)build the cached Getters from index_definitions."""
+        c.execute("SELECT DISTINCT field FROM index_definitions"
+                  " ORDER BY field")
+        fields = [row[0] for row in c.fetchall()]
+        parser = query_parser.Parser()
+        self._index_getters = dict(
+            (field, parser.compile(field)) for field in fields)
+        self._index_plan = parser.compile_plan(fields)
+
+    def _get_index_plan(self):
+        """Return a CompiledPlan evaluating all the indexed fields."""
+        self._get_index_getters()
+        return self._index_plan
+
     def _get_indexed_fields(self):
         """Determine what fields are indexed."""
+        return set(self._get_index_getters())
+
+    def _put_docs_and_update_indexes(self, old_and_new_docs):
         c = self._db_handle.cursor()
-        c.execute("SELECT field FROM index_definitions")
-        return set([x[0] for x in c.fetchall()])
+        # Only the first old_doc and the last doc of each doc_id matter for
+        # the document and document_fields tables.
+        first_old_docs = {}
+        last_docs = {}
+        log_entries = []
+        for old_doc, doc in old_and_new_docs:
+            first_old_docs.setdefault(doc.doc_id, old_doc)
+            last_docs[doc.doc_id] = doc
+            log_entries.append((doc.doc_id, self._allocate_transaction_id()))
+        inserts = []
+        updates = []
+        for doc_id, doc in last_docs.iteritems():
+            digest = doc.get_content_digest()
+            rev = self._encode_rev(doc.rev)
+            if first_old_docs[doc_id] is None:
+                inserts.append((doc_id, rev, doc.get_json(), digest))
+            else:
+                updates.append((rev, doc.get_json(), digest, doc_id))
+        if inserts:
+            c.executemany("INSERT INTO document"
+                          " (doc_id, doc_rev, content, content_digest)"
+                          " VALUES (?, ?, ?, ?)", inserts)
+        if updates:
+            c.executemany("UPDATE document SET doc_rev=?, content=?,"
+                          " content_digest=? WHERE doc_id = ?", updates)
+        self._update_docs_indexes(c, first_old_docs, last_docs)
+        old_generation = self._get_generation()
+        c.executemany("INSERT INTO transaction_log(doc_id, transaction_id)"
+                      " VALUES (?, ?)", log_entries)
+        c.execute("INSERT OR REPLACE INTO document_changes"
+                  " SELECT doc_id, generation, transaction_id"
+                  " FROM transaction_log WHERE generation > ?"
+                  " ORDER BY generation", (old_generation,))
+
+    def _update_docs_indexes(self, c, old_docs, new_docs):
+        """Bring the index storage up to date with changed documents.
+
+        :param c: An sqlite Cursor.
+        :param old_docs: A dict mapping doc_id => the Document currently
+            indexed, or None if it is a new document.
+        :param new_docs: A dict mapping doc_id => the Document to index.
+        """
+        plan = self._get_index_plan()
+        if not plan.expressions:
+            return
+        # document_fields holds the index rows of the old content, so
+        # only the rows that differ from the new content are touched.
+        # The rows hold the doc_id, so all the documents are evaluated in
+        # one batch.
+        old_rows = self._count_index_rows(
+            [old_docs[doc_id] for doc_id in new_docs], plan)
+        new_rows = self._count_index_rows(new_docs.values(), plan)
+        removed = []
+        added = []
+        for row in set(old_rows).union(new_rows):
+            old_count = old_rows.get(row, 0)
+            new_count = new_rows.get(row, 0)
+            if old_count == new_count:
+                continue
+            if old_count:
+                removed.append(row)
+            added.extend([row] * new_count)
+        self._execute_field_rows(c, self._delete_field_row, removed)
+        self._execute_field_rows(c, self._insert_field_row, added)
 
-    def _evaluate_index(self, raw_doc, field):
-        parser = query_parser.Parser()
-        getter = parser.parse(field)
-        return getter.get(raw_doc)
+    def _add_index_definition(self, c, index_name, index_expressions):
+        """Store the definition of a new index.
 
-    def _put_and_update_indexes(self, old_doc, doc):
-        c = self._db_handle.cursor()
-        if doc and not doc.is_tombstone():
-            raw_doc = json.loads(doc.get_json())
-        else:
-            raw_doc = {}
-        if old_doc is not None:
-            c.execute("UPDATE document SET doc_rev=?, content=?"
-                      " WHERE doc_id = ?",
-                      (doc.rev, doc.get_json(), doc.doc_id))
-            c.execute("DELETE FROM document_fields WHERE doc_id = ?",
-                      (doc.doc_id,))
-        else:
-            c.execute("INSERT INTO document (doc_id, doc_rev, content)"
-                      " VALUES (?, ?, ?)",
-                      (doc.doc_id, doc.rev, doc.get_json()))
-        indexed_fields = self._get_indexed_fields()
-        if indexed_fields:
-            # It is expected that len(indexed_fields) is shorter than
-            # len(raw_doc)
-            getters = [(field, self._parse_index_definition(field))
-                       for field in indexed_fields]
-            self._update_indexes(doc.doc_id, raw_doc, getters, c)
-        trans_id = self._allocate_transaction_id()
-        c.execute("INSERT INTO transaction_log(doc_id, transaction_id)"
-                  " VALUES (?, ?)", (doc.doc_id, trans_id))
+        :return: False if an identical index already exists, True otherwise.
+        """
+        definition = [(index_name, idx, field)
+                      for idx, field in enumerate(index_expressions)]
+        try:
+            c.executemany("INSERT INTO index_definitions VALUES (?, ?, ?)",
+                          definition)
+        except dbapi2.IntegrityError as e:
+            stored_def = self._get_index_definition(index_name)
+            if stored_def == [x[-1] for x in definition]:
+                return False
+            raise errors.IndexNameTakenError, e, sys.exc_info()[2]
+        self._bump_index_schema_version(c)
+        return True
 
     def create_index(self, index_name, *index_expressions):
+        c = self._db_handle.cursor()
+        self._create_index_build_table(c, self._fields_table)
+        pool = self._start_index_build_pool(index_name, index_expressions)
+        try:
+            with self._db_handle:
+                cur_fields = self._get_indexed_fields()
+                new_fields = set(
+                    [f for f in index_expressions if f not in cur_fields])
+                self._check_index_builds(c, index_name, new_fields)
+                if not self._add_index_definition(c, index_name,
+                                                  index_expressions):
+                    return
+                if new_fields:
+                    self._update_all_indexes(new_fields, pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            c.execute("DROP TABLE temp.index_build")
+
+    def _check_index_builds(self, c, index_name, fields):
+        """Refuse to touch an index, or fields, that are being built online.
+
+        The document_fields rows of a field are incomplete until the online
+        build that added it is done, so no other index may use them yet.
+        """
+        c.execute("SELECT name, field FROM index_builds")
+        for name, field in c.fetchall():
+            if name == index_name or field in fields:
+                raise errors.IndexBuildInProgress
+
+    def create_index_online(self, index_name, *index_expressions):
+        """Create an index without holding the write lock for the whole build.
+
+        The existing documents are indexed in small transactions, then the
+        documents changed in the meantime are indexed again, found through
+        the transaction log. The index only becomes visible once it is
+        consistent, in the same transaction as the last of those batches.
+        Calling this again restarts a build that was interrupted, and
+        delete_index cancels it.
+        """
         with self._db_handle:
             c = self._db_handle.cursor()
-            cur_fields = self._get_indexed_fields()
-            definition = [(index_name, idx, field)
-                          for idx, field in enumerate(index_expressions)]
-            try:
-                c.executemany("INSERT INTO index_definitions VALUES (?, ?, ?)",
-                              definition)
-            except dbapi2.IntegrityError as e:
-                stored_def = self._get_index_definition(index_name)
-                if stored_def == [x[-1] for x in definition]:
+            build = self._start_index_build(c, index_name, index_expressions)
+            if build is False:
+                return
+            generation = self._get_generation()
+        if build is not None:
+            self._backfill_index_build(index_name, build)
+        batch_size = self._online_index_build_batch_size
+        while True:
+            with self._db_handle:
+                c = self._db_handle.cursor()
+                self._lock_index_build(c, index_name)
+                new_generation = self._get_generation()
+                c.execute("SELECT doc_id FROM document_changes"
+                          " WHERE last_generation > ?", (generation,))
+                doc_ids = [row[0] for row in c.fetchall()]
+                if build is not None and doc_ids:
+                    self._clear_index_build_rows(c, build, doc_ids)
+                    docs = [(doc.doc_id, doc.get_json())
+                            for doc in
+                            self._get_docs_by_id(doc_ids).itervalues()
+                            if not doc.is_tombstone()]
+                    self._insert_index_build_rows(c, build, docs)
+                if len(doc_ids) <= batch_size:
+                    self._rebuild_unshared_index_build_fields(
+                        c, build, index_expressions)
+                    c.execute("DELETE FROM index_builds WHERE name = ?",
+                              (index_name,))
+                    self._add_index_definition(
+                        c, index_name, index_expressions)
                     return
-                raise errors.IndexNameTakenError, e, sys.exc_info()[2]
-            new_fields = set(
-                [f for f in index_expressions if f not in cur_fields])
-            if new_fields:
-                self._update_all_indexes(new_fields)
+            generation = new_generation
+
+    def _start_index_build(self, c, index_name, index_expressions):
+        """Record an online index build, or restart an interrupted one.
+
+        A transaction should already be held.
 
-    def _iter_all_docs(self):
+        :return: False if an identical index already exists, otherwise the
+            argument to pass to the other _*_index_build_* methods.
+        """
+        expressions = list(index_expressions)
+        c.execute("SELECT field FROM index_definitions WHERE name = ?"
+                  " ORDER BY offset", (index_name,))
+        stored_def = [row[0] for row in c.fetchall()]
+        if stored_def:
+            if stored_def == expressions:
+                return False
+            raise errors.IndexNameTakenError
+        build = self._get_index_build(index_name, index_expressions)
+        c.execute("SELECT field FROM index_builds WHERE name = ?"
+                  " ORDER BY offset", (index_name,))
+        stored_def = [row[0] for row in c.fetchall()]
+        if stored_def:
+            if stored_def != expressions:
+                raise errors.IndexNameTakenError
+        else:
+            self._check_index_builds(
+                c, index_name, self._get_index_build_fields(build))
+            c.executemany("INSERT INTO index_builds VALUES (?, ?, ?)",
+                          [(index_name, idx, field)
+                           for idx, field in enumerate(expressions)])
+        self._lock_index_build(c, index_name)
+        if build is not None:
+            self._clear_index_build_rows(c, build)
+        return build
+
+    def _lock_index_build(self, c, index_name):
+        """Take the write lock for a batch of an online index build.
+
+        The sqlite3 module only begins a transaction before a data changing
+        statement, so this no-op UPDATE makes sure nothing is read before
+        the lock is held. Raises IndexDoesNotExist if the build was
+        cancelled.
+        """
+        c.execute("UPDATE index_builds SET offset = offset WHERE name = ?",
+                  (index_name,))
+        if c.rowcount == 0:
+            raise errors.IndexDoesNotExist
+
+    def _backfill_index_build(self, index_name, build):
+        """Index the existing documents, in one transaction per batch."""
+        c = self._db_handle.cursor()
+        c.execute("SELECT count(*) FROM document WHERE content IS NOT NULL")
+        total = c.fetchone()[0]
+        done = 0
+        last_doc_id = ''
+        while True:
+            with self._db_handle:
+                self._lock_index_build(c, index_name)
+                c.execute("SELECT doc_id, content FROM document"
+                          " WHERE doc_id > ? AND content IS NOT NULL"
+                          " ORDER BY doc_id LIMIT ?",
+                          (last_doc_id, self._online_index_build_batch_size))
+                docs = c.fetchall()
+                if not docs:
+                    return
+                self._insert_index_build_rows(c, build, docs)
+            last_doc_id = docs[-1][0]
+            done += len(docs)
+            if self._index_build_progress is not None:
+                self._index_build_progress(done, total)
+
+    def _get_index_build(self, index_name, index_expressions):
+        """Return what an online build of this index has to add.
+
+        :return: A CompiledPlan of the fields not indexed yet, or None if
+            there are none.
+        """
+        cur_fields = self._get_indexed_fields()
+        fields = sorted(set(index_expressions) - cur_fields)
+        if not fields:
+            return None
+        return query_parser.Parser().compile_plan(fields)
+
+    def _get_index_build_fields(self, build):
+        """Return the fields an online build adds document_fields rows for."""
+        if build is None:
+            return set()
+        return set(build.expressions)
+
+    def _rebuild_unshared_index_build_fields(self, c, build,
+                                             index_expressions):
+        """Index again the fields a build shared with deleted indexes.
+
+        An online build only adds rows for the fields no other index had
+        when it started. Those rows are only kept up to date while another
+        index has the field, so if that index was deleted during the build
+        they are indexed again here, in the transaction that makes the
+        index visible.
+        """
+        fields = (set(index_expressions)
+                  - self._get_index_build_fields(build)
+                  - self._get_indexed_fields())
+        if not fields:
+            return
+        plan = query_parser.Parser().compile_plan(sorted(fields))
+        self._clear_index_build_rows(c, plan)
+        docs_c = self._db_handle.cursor()
+        docs_c.execute("SELECT doc_id, content FROM document"
+                       " WHERE content IS NOT NULL")
+        while True:
+            docs = docs_c.fetchmany(self._index_build_chunk_size)
+            if not docs:
+                break
+            self._insert_index_build_rows(c, plan, docs)
+
+    def _clear_index_build_rows(self, c, build, doc_ids=None):
+        """Delete the rows added by an online build, for doc_ids or all."""
+        fields = build.expressions
+        field_where = "field_name IN (%s)" % (','.join('?' * len(fields)),)
+        if doc_ids is None:
+            c.execute("DELETE FROM document_fields WHERE " + field_where,
+                      fields)
+        else:
+            c.executemany(
+                "DELETE FROM document_fields WHERE doc_id = ? AND "
+                + field_where, [[doc_id] + fields for doc_id in doc_ids])
+
+    def _insert_index_build_rows(self, c, build, docs):
+        """Add the rows of an online build for a list of (doc_id, content)."""
+        self._execute_field_rows(
+            c, self._insert_field_row, _evaluate_field_rows(docs, build))
+
+    def _iter_doc_chunks(self):
+        """Yield lists of (doc_id, content) for all undeleted documents."""
+        c = self._db_handle.cursor()
+        c.execute("SELECT doc_id, content FROM document"
+                  " WHERE content IS NOT NULL")
+        while True:
+            rows = c.fetchmany(self._index_build_chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    def _create_index_build_table(self, c, table):
+        """Create the temporary table that index rows are built up in.
+
+        This must be called outside of a transaction, as the sqlite3 module
+        commits before running any DDL.
+        """
+        c.execute("CREATE TEMP TABLE index_build AS SELECT * FROM %s"
+                  " WHERE 0" % (table,))
+
+    def _start_index_build_pool(self, index_name, index_expressions):
+        """Start the worker processes create_index evaluates documents in.
+
+        This must be called before the build transaction is opened, so that
+        the forked workers do not inherit a connection holding the write
+        lock. The caller terminates the pool.
+
+        :return: A multiprocessing.Pool, or None if the documents should be
+            evaluated in this process.
+        """
+        processes = (self._index_build_processes
+                     or multiprocessing.cpu_count())
+        if processes <= 1:
+            return None
         c = self._db_handle.cursor()
-        c.execute("SELECT doc_id, content FROM document")
+        c.execute("SELECT field FROM index_definitions WHERE name = ?"
+                  " ORDER BY offset", (index_name,))
+        if [row[0] for row in c.fetchall()] == list(index_expressions):
+            # Creating an existing index is cheap, it builds nothing.
+            return None
+        c.execute("SELECT count(*) FROM document WHERE content IS NOT NULL")
+        if c.fetchone()[0] < self._parallel_index_build_threshold:
+            return None
+        return multiprocessing.Pool(processes)
+
+    def _build_index_rows(self, c, table, order, evaluate, arg, adapt=None,
+                          pool=None):
+        """Evaluate every document and bulk load the rows into table.
+
+        The rows are gathered in temp.index_build, then inserted into table
+        in one statement, in order.
+
+        :param evaluate: A module level function, called as
+            evaluate(docs, arg) with a list of (doc_id, content). It returns
+            the rows for those documents.
+        :param order: The ORDER BY clause matching the index on table.
+        :param adapt: If given, called on each row before it is stored.
+        :param pool: If given, the multiprocessing.Pool from
+            _start_index_build_pool to evaluate the documents in.
+        """
+        c.execute("SELECT count(*) FROM document WHERE content IS NOT NULL")
+        total = c.fetchone()[0]
+        processes = (self._index_build_processes
+                     or multiprocessing.cpu_count())
+        done = 0
+        chunks = self._iter_doc_chunks()
         while True:
-            next_rows = c.fetchmany()
-            if not next_rows:
+            # The pool is fed from this thread, as the sqlite connection can
+            # not be used from another one.
+            batch = list(itertools.islice(chunks, processes))
+            if not batch:
                 break
-            for row in next_rows:
-                yield row
+            if pool is None:
+                results = [evaluate(docs, arg) for docs in batch]
+            else:
+                results = pool.map(
+                    _evaluate_docs, [(evaluate, docs, arg)
+                                     for docs in batch])
+            for docs, rows in zip(batch, results):
+                self._insert_built_rows(c, rows, adapt)
+                done += len(docs)
+            if self._index_build_progress is not None:
+                self._index_build_progress(done, total)
+        c.execute("INSERT INTO %s SELECT * FROM temp.index_build ORDER BY %s"
+                  % (table, order))
+
+    def _insert_built_rows(self, c, rows, adapt):
+        """Add rows returned by the evaluate function of _build_index_rows.
+
+        :param adapt: If given, called on each row before it is stored.
+        """
+        self._execute_field_rows(
+            c, "INSERT INTO temp.index_build VALUES (?1, ?2, %s)", rows,
+            adapt)
 
-    def _update_all_indexes(self, new_fields):
+    def _update_all_indexes(self, new_fields, pool=None):
         """Iterate all the documents, and add content to document_fields.
 
         :param new_fields: The index definitions that need to be added.
+        :param pool: See _build_index_rows.
         """
-        getters = [(field, self._parse_index_definition(field))
-                   for field in new_fields]
+        plan = query_parser.Parser().compile_plan(sorted(new_fields))
         c = self._db_handle.cursor()
-        for doc_id, doc in self._iter_all_docs():
-            if doc is None:
-                continue
-            raw_doc = json.loads(doc)
-            self._update_indexes(doc_id, raw_doc, getters, c)
+        self._build_index_rows(
+            c, 'document_fields', 'field_name, value, doc_id',
+            _evaluate_field_rows, plan, pool=pool)
+
+
+def _evaluate_docs(task):
+    """Run evaluate(docs, arg) in an index build worker process."""
+    evaluate, docs, arg = task
+    return evaluate(docs, arg)
+
+
+def _evaluate_field_rows(docs, plan):
+    """Return the document_fields rows for a list of (doc_id, content).
+
+    :param plan: A CompiledPlan of the fields to evaluate.
+    """
+    return plan.evaluate_many(
+        [(doc_id, json.loads(content)) for doc_id, content in docs])
 
 SQLiteDatabase.register_implementation(SQLitePartialExpandDatabase)
+
+
+def _escape_key_component(value):
+    """Escape a utf-8 string so that it contains no \\x00 bytes.
+
+    \\x00 and \\x01 become \\x01\\x01 and \\x01\\x02, which keeps the byte
+    order of the escaped strings the same as the order of the originals.
+    """
+    return value.replace('\x01', '\x01\x02').replace('\x00', '\x01\x01')
+
+
+def _unescape_key_component(value):
+    return _key_escape_re.sub(
+        lambda match: chr(ord(match.group(1)) - 1), value)
+
+
+_key_escape_re = re.compile('\x01([\x01\x02])')
+
+
+def _typed_index_value(field, value):
+    """Return an index value stored as text by sql_schema 7, as stored now.
+
+    The values of number() and bool() expressions become integers again.
+    """
+    if query_parser.Parser().parse(field).numeric:
+        return query_parser.numeric_key_value(value)
+    return value
+
+
+def _key_text(value):
+    """Return the utf-8 text that SQLite would store for an index value."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, bool):
+        value = int(value)
+    return str(value)
+
+
+class SQLiteCompositeKeyDatabase(SQLitePartialExpandDatabase):
+    """An SQLite Backend that stores one row per index key in index_keys.
+
+    Each row holds the index name, the values of all the index columns encoded
+    as a single binary key, and the doc_id. Every component of the key is
+    escaped and terminated by \\x00, so comparing keys byte-wise gives the
+    same order as comparing the tuples of values. Exact, prefix and range
+    queries are then a single range scan of the index_keys primary key.
+
+    The integers of numeric expressions are encoded as \\x01\\x03 and the
+    16 hex digits of the integer plus 2**63, which sort in numeric order and
+    never occur in escaped text.
+    """
+
+    _index_storage_value = 'composite key'
+
+    def _extra_schema_init(self, c):
+        c.execute(
+            "CREATE TABLE index_keys ("
+            " index_name TEXT NOT NULL,"
+            " key BLOB NOT NULL,"
+            " doc_id TEXT NOT NULL,"
+            " CONSTRAINT index_keys_pkey PRIMARY KEY (index_name, key, doc_id)"
+            ")")
+        c.execute("CREATE INDEX index_keys_doc_id_idx ON index_keys(doc_id)")
+
+    def _upgrade_schema(self, c, version):
+        super(SQLiteCompositeKeyDatabase, self)._upgrade_schema(c, version)
+        if version < 8:
+            # The integers of numeric expressions used to be encoded as
+            # text, so the keys of the indexes that have any are encoded
+            # again.
+            c.execute("SELECT name, offset, field FROM index_definitions"
+                      " UNION SELECT name, offset, field FROM index_builds")
+            index_numeric = {}
+            for name, offset, field in c.fetchall():
+                index_numeric.setdefault(name, {})[offset] = (
+                    self._is_numeric_field(field))
+            for name, numeric in index_numeric.iteritems():
+                numeric = [numeric[offset] for offset in sorted(numeric)]
+                if not any(numeric):
+                    continue
+                c.execute("SELECT key, doc_id FROM index_keys"
+                          " WHERE index_name = ?", (name,))
+                rows = []
+                for key, doc_id in c.fetchall():
+                    values = [[query_parser.numeric_key_value(value)]
+                              if is_numeric else [value]
+                              for value, is_numeric
+                              in zip(self._decode_key(key), numeric)]
+                    for new_key in self._encode_index_keys(values, numeric):
+                        rows.append((name, buffer(new_key), doc_id))
+                c.execute("DELETE FROM index_keys WHERE index_name = ?",
+                          (name,))
+                c.executemany("INSERT INTO index_keys VALUES (?, ?, ?)",
+                              rows)
+
+    def _load_index_getters(self, c):
+        super(SQLiteCompositeKeyDatabase, self)._load_index_getters(c)
+        c.execute("SELECT name, field FROM index_definitions"
+                  " ORDER BY name, offset")
+        self._index_key_fields = {}
+        for name, field in c.fetchall():
+            self._index_key_fields.setdefault(name, []).append(field)
+
+    def _get_index_key_fields(self):
+        """Return a dict mapping index names to their list of fields."""
+        self._get_index_getters()
+        return self._index_key_fields
+
+    @staticmethod
+    def _encode_key_component(value, numeric=False):
+        if value is None:
+            return None
+        if numeric and isinstance(value, int) and not isinstance(value, bool):
+            return '\x01\x03%016x\x00' % (value + 2 ** 63,)
+        return _escape_key_component(_key_text(value)) + '\x00'
+
+    @staticmethod
+    def _decode_key_component(component):
+        if component.startswith('\x01\x03'):
+            return int(int(component[2:], 16) - 2 ** 63)
+        return _unescape_key_component(component).decode('utf-8')
+
+    @classmethod
+    def _encode_index_keys(cls, field_values, numeric):
+        """Return the set of encoded keys for a document in one index.
+
+        :param field_values: The list of values of each field of the index.
+        :param numeric: Whether each field of the index is numeric.
+        """
+        keys = ['']
+        for values, is_numeric in zip(field_values, numeric):
+            components = [cls._encode_key_component(value, is_numeric)
+                          for value in values]
+            components = [x for x in components if x is not None]
+            if not components:
+                return set()
+            keys = [key + component for key in keys
+                    for component in components]
+        return set(keys)
+
+    def _get_doc_index_keys(self, doc, key_fields):
+        """Return the set of (index_name, key, doc_id) rows for a document."""
+        rows = set()
+        if doc is None or doc.is_tombstone():
+            return rows
+        plan = self._get_index_plan()
+        values = dict(zip(plan.expressions,
+                          plan.evaluate(doc.get_parsed_json())))
+        for index_name, fields in key_fields.iteritems():
+            for key in self._encode_index_keys(
+                    [values[field] for field in fields],
+                    [self._is_numeric_field(field) for field in fields]):
+                rows.add((index_name, key, doc.doc_id))
+        return rows
+
+    def _update_docs_indexes(self, c, old_docs, new_docs):
+        key_fields = self._get_index_key_fields()
+        if not key_fields:
+            return
+        removed = []
+        added = []
+        for doc_id, doc in new_docs.iteritems():
+            old_rows = self._get_doc_index_keys(old_docs[doc_id], key_fields)
+            new_rows = self._get_doc_index_keys(doc, key_fields)
+            removed.extend(old_rows - new_rows)
+            added.extend(new_rows - old_rows)
+        if removed:
+            c.executemany(
+                "DELETE FROM index_keys WHERE index_name = ? AND key = ?"
+                " AND doc_id = ?",
+                [(name, buffer(key), doc_id) for name, key, doc_id in removed])
+        if added:
+            c.executemany(
+                "INSERT INTO index_keys VALUES (?, ?, ?)",
+                [(name, buffer(key), doc_id) for name, key, doc_id in added])
+
+    def create_index(self, index_name, *index_expressions):
+        c = self._db_handle.cursor()
+        self._create_index_build_table(c, 'index_keys')
+        pool = self._start_index_build_pool(index_name, index_expressions)
+        try:
+            with self._db_handle:
+                self._check_index_builds(c, index_name, ())
+                if not self._add_index_definition(c, index_name,
+                                                  index_expressions):
+                    return
+                plan = query_parser.Parser().compile_plan(index_expressions)
+                self._build_index_rows(
+                    c, 'index_keys', 'index_name, key, doc_id',
+                    _evaluate_key_rows, (index_name, plan),
+                    lambda row: (row[0], buffer(row[1]), row[2]), pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            c.execute("DROP TABLE temp.index_build")
+
+    def _insert_built_rows(self, c, rows, adapt):
+        if adapt is not None:
+            rows = map(adapt, rows)
+        c.executemany("INSERT INTO temp.index_build VALUES (?, ?, ?)", rows)
+
+    def delete_index(self, index_name):
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute("DELETE FROM index_definitions WHERE name = ?",
+                      (index_name,))
+            c.execute("DELETE FROM index_builds WHERE name = ?",
+                      (index_name,))
+            self._bump_index_schema_version(c)
+            c.execute("DELETE FROM index_keys WHERE index_name = ?",
+                      (index_name,))
+
+    def _get_index_build(self, index_name, index_expressions):
+        return (index_name,
+                query_parser.Parser().compile_plan(index_expressions))
+
+    def _get_index_build_fields(self, build):
+        # index_keys rows belong to a single index, so builds never share
+        # them.
+        return set()
+
+    def _rebuild_unshared_index_build_fields(self, c, build,
+                                             index_expressions):
+        # The build adds all the index_keys rows of its index.
+        pass
+
+    def _clear_index_build_rows(self, c, build, doc_ids=None):
+        index_name = build[0]
+        if doc_ids is None:
+            c.execute("DELETE FROM index_keys WHERE index_name = ?",
+                      (index_name,))
+        else:
+            c.executemany(
+                "DELETE FROM index_keys WHERE index_name = ? AND doc_id = ?",
+                [(index_name, doc_id) for doc_id in doc_ids])
+
+    def _insert_index_build_rows(self, c, build, docs):
+        c.executemany(
+            "INSERT INTO index_keys VALUES (?, ?, ?)",
+            [(name, buffer(key), doc_id)
+             for name, key, doc_id in _evaluate_key_rows(docs, build)])
+
+    def _encode_key_prefix(self, definition, key_values):
+        """Encode the values of a query into a key prefix.
+
+        :return: (prefix, is_wildcard). When is_wildcard is False the prefix
+            is a complete key, otherwise it is a prefix of all matching keys.
+        """
+        prefixes, is_wildcard = self._encode_key_prefixes(
+            definition, key_values)
+        if len(prefixes) != 1:
+            raise errors.InvalidValueForIndex()
+        return prefixes[0], is_wildcard
+
+    def _encode_key_prefixes(self, definition, key_values):
+        """Encode the values of a query into key prefixes.
+
+        A key value may be a list of values, in which case there is one
+        prefix for each combination of values.
+
+        :return: (prefixes, is_wildcard), see _encode_key_prefix.
+        """
+        if len(key_values) != len(definition):
+            raise errors.InvalidValueForIndex()
+        prefixes = ['']
+        is_wildcard = False
+        for field, value in zip(definition, key_values):
+            numeric = self._is_numeric_field(field)
+            value = self._typed_key_value(field, value)
+            if isinstance(value, (list, tuple)):
+                if is_wildcard:
+                    raise errors.InvalidGlobbing
+                components = [
+                    self._encode_key_component(alternative, numeric)
+                    for alternative in value]
+                prefixes = [prefix + component for prefix in prefixes
+                            for component in components]
+            elif isinstance(value, basestring) and value.endswith('*'):
+                if value != '*':
+                    # This is a glob match
+                    if is_wildcard:
+                        # We can't have a partial wildcard following
+                        # another wildcard
+                        raise errors.InvalidGlobbing
+                    component = _escape_key_component(
+                        _key_text(self._strip_glob(value)))
+                    prefixes = [prefix + component for prefix in prefixes]
+                is_wildcard = True
+            else:
+                if is_wildcard:
+                    raise errors.InvalidGlobbing
+                component = self._encode_key_component(value, numeric)
+                prefixes = [prefix + component for prefix in prefixes]
+        return prefixes, is_wildcard
+
+    def _get_docs_in_key_range(self, index_name, where, args):
+        """Return the documents whose keys match the where clauses.
+
+        Documents are sorted by their lowest matching key, and only returned
+        once.
+        """
+        statement = (
+            "SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM"
+            " index_keys k, document d WHERE %s ORDER BY k.key, k.doc_id"
+            % (' AND '.join(["k.index_name = ?", "d.doc_id = k.doc_id"]
+                            + where),))
+        c = self._db_handle.cursor()
+        c.execute(statement, tuple([index_name] + args))
+        results = []
+        seen = set()
+        for doc_id, doc_rev, content, n_conflicts in c.fetchall():
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            doc = make_trusted_document(
+                self._factory, doc_id, self._decode_rev(doc_rev), content)
+            doc.has_conflicts = n_conflicts > 0
+            results.append(doc)
+        return results
+
+    def _format_key_where(self, definition, key_values, column='k.key'):
+        """Return the where clauses and arguments matching key_values.
+
+        The arguments are already wrapped as buffers, ready to be compared
+        with column.
+        """
+        prefixes, is_wildcard = self._encode_key_prefixes(
+            definition, key_values)
+        if not prefixes:
+            # An empty list of alternatives matches nothing.
+            return ["0"], []
+        args = []
+        if is_wildcard:
+            # No byte of an encoded key is \xff, so every key starting with
+            # prefix sorts before prefix + \xff.
+            clause = "(%s >= ? AND %s < ?)" % (column, column)
+            for prefix in prefixes:
+                args.extend([buffer(prefix), buffer(prefix + '\xff')])
+        else:
+            clause = "%s = ?" % (column,)
+            args = [buffer(prefix) for prefix in prefixes]
+        if len(prefixes) == 1:
+            return [clause], args
+        return ["(%s)" % (' OR '.join([clause] * len(prefixes)),)], args
+
+    def get_from_index(self, index_name, *key_values):
+        definition = self._get_index_definition(index_name)
+        where, args = self._format_key_where(definition, key_values)
+        return self._get_docs_in_key_range(index_name, where, args)
+
+    def get_from_index_intersection(self, queries):
+        if not queries:
+            raise errors.InvalidValueForIndex()
+        index_name, key_values = queries[0][0], queries[0][1:]
+        definition = self._get_index_definition(index_name)
+        where, args = self._format_key_where(definition, key_values)
+        for i, query in enumerate(queries[1:]):
+            other_name, key_values = query[0], query[1:]
+            definition = self._get_index_definition(other_name)
+            column = 'k%d' % (i,)
+            query_where, query_args = self._format_key_where(
+                definition, key_values, column='%s.key' % (column,))
+            where.append(
+                "EXISTS (SELECT 1 FROM index_keys %s WHERE %s)" % (
+                    column, ' AND '.join([
+                        "%s.index_name = ?" % (column,),
+                        "%s.doc_id = k.doc_id" % (column,)] + query_where)))
+            args.extend([other_name] + query_args)
+        return self._get_docs_in_key_range(index_name, where, args)
+
+    def get_doc_ids_from_index(self, index_name, *key_values):
+        definition = self._get_index_definition(index_name)
+        where, args = self._format_key_where(definition, key_values)
+        c = self._db_handle.cursor()
+        c.execute(
+            "SELECT k.doc_id FROM index_keys k WHERE %s"
+            " ORDER BY k.key, k.doc_id" % (
+                ' AND '.join(["k.index_name = ?"] + where),),
+            tuple([index_name] + args))
+        doc_ids = []
+        seen = set()
+        for doc_id, in c.fetchall():
+            if doc_id not in seen:
+                seen.add(doc_id)
+                doc_ids.append(doc_id)
+        return doc_ids
+
+    def count_from_index(self, index_name, *key_values):
+        definition = self._get_index_definition(index_name)
+        where, args = self._format_key_where(definition, key_values)
+        c = self._db_handle.cursor()
+        c.execute(
+            "SELECT count(DISTINCT k.doc_id) FROM index_keys k WHERE %s" % (
+                ' AND '.join(["k.index_name = ?"] + where),),
+            tuple([index_name] + args))
+        return c.fetchone()[0]
+
+    def _format_key_range_where(self, definition, start_value, end_value):
+        """Return the where clauses and arguments selecting the range."""
+        where = []
+        args = []
+        if start_value:
+            if isinstance(start_value, basestring):
+                start_value = (start_value,)
+            prefix, _ = self._encode_key_prefix(definition, start_value)
+            where.append("k.key >= ?")
+            args.append(buffer(prefix))
+        if end_value:
+            if isinstance(end_value, basestring):
+                end_value = (end_value,)
+            prefix, is_wildcard = self._encode_key_prefix(
+                definition, end_value)
+            if is_wildcard:
+                where.append("k.key < ?")
+                args.append(buffer(prefix + '\xff'))
+            else:
+                where.append("k.key <= ?")
+                args.append(buffer(prefix))
+        return where, args
+
+    def get_range_from_index(self, index_name, start_value=None,
+                             end_value=None):
+        """Return all documents with key values in the specified range."""
+        definition = self._get_index_definition(index_name)
+        where, args = self._format_key_range_where(
+            definition, start_value, end_value)
+        return self._get_docs_in_key_range(index_name, where, args)
+
+    @classmethod
+    def _decode_key(cls, key):
+        """Return the tuple of index values stored in a key."""
+        return tuple([cls._decode_key_component(component)
+                      for component in str(key).split('\x00')[:-1]])
+
+    def get_index_keys(self, index_name):
+        self._get_index_definition(index_name)
+        c = self._db_handle.cursor()
+        c.execute("SELECT DISTINCT key FROM index_keys WHERE index_name = ?"
+                  " ORDER BY key", (index_name,))
+        return [self._decode_key(key) for key, in c.fetchall()]
+
+    def _position_from_row(self, row):
+        return [binascii.hexlify(row[0])] + list(row[1:])
+
+    def _row_from_position(self, position):
+        try:
+            key = binascii.unhexlify(position[0])
+        except TypeError:
+            raise errors.InvalidResumeToken()
+        return [buffer(key)] + position[1:]
+
+    def _iter_key_docs(self, index_name, where, args, limit, descending,
+                         resume_token):
+        """Return an IndexCursor of the documents matching where."""
+        extra_columns = ['d.doc_rev', 'd.content', 'd.has_conflicts']
+        return self._iter_index_query(
+            ['k.key', 'k.doc_id'], extra_columns,
+            ['index_keys k', 'document d'],
+            ["k.index_name = ?", "d.doc_id = k.doc_id"] + where,
+            [index_name] + args,
+            self._make_index_doc, limit, descending, resume_token)
+
+    def iter_from_index(self, index_name, key_values, limit=None,
+                        descending=False, resume_token=None):
+        definition = self._get_index_definition(index_name)
+        where, args = self._format_key_where(definition, key_values)
+        return self._iter_key_docs(
+            index_name, where, args, limit, descending, resume_token)
+
+    def iter_range_from_index(self, index_name, start_value=None,
+                              end_value=None, limit=None, descending=False,
+                              resume_token=None):
+        definition = self._get_index_definition(index_name)
+        where, args = self._format_key_range_where(
+            definition, start_value, end_value)
+        return self._iter_key_docs(
+            index_name, where, args, limit, descending, resume_token)
+
+    def iter_index_keys(self, index_name, limit=None, descending=False,
+                        resume_token=None):
+        self._get_index_definition(index_name)
+        return self._iter_index_query(
+            ['k.key'], [], ['index_keys k'], ["k.index_name = ?"],
+            [index_name], lambda row, extra: self._decode_key(row[0]),
+            limit, descending, resume_token, distinct=True)
+
+SQLiteDatabase.register_implementation(SQLiteCompositeKeyDatabase)
+
+
+def _evaluate_key_rows(docs, arg):
+    """Return the index_keys rows for a list of (doc_id, content)."""
+    index_name, plan = arg
+    rows = []
+    for doc_id, content in docs:
+        raw_doc = json.loads(content)
+        for key in SQLiteCompositeKeyDatabase._encode_index_keys(
+                plan.evaluate(raw_doc), plan.numeric):
+            rows.append((index_name, key, doc_id))
+    return rows
+
+
+class SQLiteSurrogateKeyDatabase(SQLitePartialExpandDatabase):
+    """An SQLite Backend that expands documents into integer keyed rows.
+
+    This is SQLitePartialExpandDatabase, except that the index rows in
+    document_values refer to their document by doc_key, the rowid of the
+    document table, and to their index expression by its field_id in the
+    small index_fields table. The (field_id, value, doc_key) index then
+    holds two integers next to each value rather than two strings, and
+    joining it against document is a rowid lookup.
+    """
+
+    _index_storage_value = 'expand surrogate keys'
+
+    _fields_table = 'document_values'
+    _fields_doc_column = 'doc_key'
+    _fields_field_where = (
+        '%s.field_id = (SELECT field_id FROM index_fields WHERE field = ?)')
+    _insert_field_row = (
+        "INSERT INTO document_values SELECT d.doc_key, f.field_id, %s"
+        " FROM document d, index_fields f WHERE d.doc_id = ?1"
+        " AND f.field = ?2")
+    _delete_field_row = (
+        "DELETE FROM document_values"
+        " WHERE doc_key = (SELECT doc_key FROM document WHERE doc_id = ?1)"
+        " AND field_id = (SELECT field_id FROM index_fields WHERE field = ?2)"
+        " AND value IS %s")
+
+    def _extra_schema_init(self, c):
+        # VACUUM may renumber the rowids of a table that has no INTEGER
+        # PRIMARY KEY, so document is created again, while still empty,
+        # with doc_key naming its rowid.
+        c.execute("DROP TABLE document")
+        c.execute(
+            "CREATE TABLE document ("
+            " doc_key INTEGER PRIMARY KEY,"
+            " doc_id TEXT NOT NULL UNIQUE,"
+            " doc_rev TEXT NOT NULL,"
+            " content TEXT,"
+            " has_conflicts INTEGER NOT NULL DEFAULT 0,"
+            " content_digest TEXT"
+            ")")
+        c.execute(
+            "CREATE TABLE index_fields ("
+            " field_id INTEGER PRIMARY KEY,"
+            " field TEXT NOT NULL UNIQUE"
+            ")")
+        c.execute(
+            "CREATE TABLE document_values ("
+            " doc_key INTEGER NOT NULL,"
+            " field_id INTEGER NOT NULL,"
+            " value"
+            ")")
+        c.execute("CREATE INDEX document_values_field_value_doc_idx"
+                  " ON document_values(field_id, value, doc_key)")
+        c.execute("CREATE INDEX document_values_doc_key_idx"
+                  " ON document_values(doc_key)")
+
+    def _upgrade_schema(self, c, version):
+        super(SQLiteSurrogateKeyDatabase, self)._upgrade_schema(c, version)
+        if version < 8:
+            # Like document_fields, document_values had a TEXT value.
+            c.execute("CREATE TABLE typed_document_values ("
+                      " doc_key INTEGER NOT NULL,"
+                      " field_id INTEGER NOT NULL,"
+                      " value)")
+            c.execute("INSERT INTO typed_document_values"
+                      " SELECT v.doc_key, v.field_id,"
+                      " u1db_typed_index_value(f.field, v.value)"
+                      " FROM document_values v, index_fields f"
+                      " WHERE f.field_id = v.field_id")
+            c.execute("DROP TABLE document_values")
+            c.execute("ALTER TABLE typed_document_values"
+                      " RENAME TO document_values")
+            c.execute("CREATE INDEX document_values_field_value_doc_idx"
+                      " ON document_values(field_id, value, doc_key)")
+            c.execute("CREATE INDEX document_values_doc_key_idx"
+                      " ON document_values(doc_key)")
+
+    def _intern_fields(self, c, fields):
+        """Return a dict mapping index expressions to their field_id.
+
+        The expressions that have no field_id yet are added to index_fields,
+        so a transaction should already be held.
+        """
+        fields = list(fields)
+        c.executemany("INSERT OR IGNORE INTO index_fields (field) VALUES (?)",
+                      [(field,) for field in fields])
+        c.execute("SELECT field, field_id FROM index_fields"
+                  " WHERE field IN (%s)" % (','.join('?' * len(fields)),),
+                  fields)
+        return dict(c.fetchall())
+
+    def get_doc_ids_from_index(self, index_name, *key_values):
+        definition = self._get_index_definition(index_name)
+        if len(key_values) != len(definition):
+            raise errors.InvalidValueForIndex()
+        where, args = self._format_query_where(definition, key_values)
+        tables = ["document d"] + [
+            "document_values d%d" % i for i in range(len(definition))]
+        statement = (
+            "SELECT d.doc_id FROM %s WHERE %s GROUP BY d.doc_key ORDER BY %s"
+            % (', '.join(tables), ' AND '.join(where), ', '.join(
+                ['d%d.value' % i for i in range(len(definition))])))
+        c = self._db_handle.cursor()
+        c.execute(statement, tuple(args))
+        return [doc_id for doc_id, in c.fetchall()]
+
+    def delete_index(self, index_name):
+        with self._db_handle:
+            c = self._db_handle.cursor()
+            c.execute("DELETE FROM index_definitions WHERE name = ?",
+                      (index_name,))
+            c.execute("DELETE FROM index_builds WHERE name = ?",
+                      (index_name,))
+            self._bump_index_schema_version(c)
+            c.execute(
+                "SELECT field_id FROM index_fields WHERE field NOT IN"
+                " (SELECT field from index_definitions"
+                " UNION SELECT field FROM index_builds)")
+            unused = c.fetchall()
+            c.executemany("DELETE FROM document_values WHERE field_id = ?",
+                          unused)
+            c.executemany("DELETE FROM index_fields WHERE field_id = ?",
+                          unused)
+
+    def _get_index_build(self, index_name, index_expressions):
+        build = super(SQLiteSurrogateKeyDatabase, self)._get_index_build(
+            index_name, index_expressions)
+        if build is not None:
+            self._intern_fields(self._db_handle.cursor(), build.expressions)
+        return build
+
+    def _clear_index_build_rows(self, c, build, doc_ids=None):
+        field_ids = self._intern_fields(c, build.expressions).values()
+        field_where = "field_id IN (%s)" % (','.join('?' * len(field_ids)),)
+        if doc_ids is None:
+            c.execute("DELETE FROM document_values WHERE " + field_where,
+                      field_ids)
+        else:
+            c.executemany(
+                "DELETE FROM document_values WHERE doc_key ="
+                " (SELECT doc_key FROM document WHERE doc_id = ?) AND "
+                + field_where, [[doc_id] + field_ids for doc_id in doc_ids])
+
+    def _iter_doc_chunks(self):
+        """Yield lists of (doc_key, content) for all undeleted documents."""
+        c = self._db_handle.cursor()
+        c.execute("SELECT doc_key, content FROM document"
+                  " WHERE content IS NOT NULL")
+        while True:
+            rows = c.fetchmany(self._index_build_chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    def _update_all_indexes(self, new_fields, pool=None):
+        plan = query_parser.Parser().compile_plan(sorted(new_fields))
+        c = self._db_handle.cursor()
+        field_ids = self._intern_fields(c, plan.expressions)
+        # The rows are evaluated for the (doc_key, content) chunks of
+        # _iter_doc_chunks, so only the field is left to map.
+        self._build_index_rows(
+            c, 'document_values', 'field_id, value, doc_key',
+            _evaluate_field_rows, plan,
+            lambda row: (row[0], field_ids[row[1]], row[2]), pool)
+
+SQLiteDatabase.register_implementation(SQLiteSurrogateKeyDatabase)
@@ -83,6 +83,16 @@ class InvalidGeneration(U1DBError):
     wire_description = "invalid generation"
 
 
+class GenerationCompacted(InvalidGeneration):
+    """The history since this generation was compacted away.
+
+    The replica has to forget what it knows of this database and sync again
+    from scratch.
+    """
+
+    wire_description = "generation compacted"
+
+
 class InvalidReplicaUID(U1DBError):
     """Attempting to sync a database with itself."""
 
@@ -102,6 +112,10 @@ class InvalidGlobbing(U1DBError):
     """
 
 
+class InvalidResumeToken(U1DBError):
+    """The resume token does not belong to this kind of index query."""
+
+
 class DocumentDoesNotExist(U1DBError):
     """The document does not exist."""
 
@@ -132,6 +146,10 @@ class IndexDoesNotExist(U1DBError):
     """No index of that name exists."""
 
 
+class IndexBuildInProgress(U1DBError):
+    """An index of that name, or on those fields, is still being built."""
+
+
 class Unauthorized(U1DBError):
     """Request wasn't authorized properly."""
 
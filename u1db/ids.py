@@ -0,0 +1,60 @@
+# Copyright 2011 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Id allocators for new document and transaction ids.
+
+An id allocator is a callable returning the unique part of an id, 32 hex
+digits that follow the 'D-' or 'T-' prefix.
+"""
+
+import os
+import threading
+import time
+import uuid
+
+
+def random_id():
+    """Return the hex digits of a random uuid."""
+    return uuid.uuid4().hex
+
+
+_RANDOM_BITS = 80
+_time_ordered_lock = threading.Lock()
+_last_time_ordered = [0, 0]
+
+
+def time_ordered_id():
+    """Return hex digits that sort in the order they were allocated.
+
+    Like a ULID: 12 hex digits of milliseconds since the epoch, then 20
+    random ones. Ids allocated close together are next to each other in
+    the document and transaction_log B-trees, instead of anywhere. Within
+    the same millisecond the random part of the previous id is
+    incremented, so ids allocated by one process always increase.
+    """
+    millis = int(time.time() * 1000)
+    random_part = int(os.urandom(_RANDOM_BITS // 8).encode('hex'), 16)
+    with _time_ordered_lock:
+        last_millis, last_random_part = _last_time_ordered
+        if millis <= last_millis:
+            # Also when the clock goes back.
+            millis = last_millis
+            random_part = last_random_part + 1
+            if random_part >> _RANDOM_BITS:
+                millis += 1
+                random_part = 0
+        _last_time_ordered[:] = [millis, random_part]
+    return '%012x%020x' % (millis, random_part)
@@ -23,7 +23,16 @@ from u1db import (
 
 
 class Getter(object):
-    """Get values from a document based on a specification."""
+    """Get values from a document based on a specification.
+
+    :cvar numeric: True if the values are integers, which are indexed and
+        compared as numbers rather than as text.
+    :cvar numeric_only: True if the values are never text, so that queries
+        can only match them with integers.
+    """
+
+    numeric = False
+    numeric_only = False
 
     def get(self, raw_doc):
         """Get a value from the document.
@@ -33,6 +42,37 @@ class Getter(object):
         """
         raise NotImplementedError(self.get)
 
+    def get_many(self, docs, field):
+        """Get the values of a batch of documents.
+
+        :param docs: A list of (doc_id, raw_doc).
+        :param field: The field name to put in the rows.
+        :return: A list of (doc_id, field, value) rows, ready for
+            executemany.
+        """
+        rows = []
+        for doc_id, raw_doc in docs:
+            for value in self.get(raw_doc):
+                rows.append((doc_id, field, value))
+        return rows
+
+    def compile(self, compiler):
+        """Generate the code computing the values of this Getter.
+
+        Getters that do not know better are called from the generated code.
+
+        :param compiler: The _Compiler generating the function.
+        :return: The name of the local variable holding the list of values.
+        """
+        return compiler.assign('%s.get(raw_doc)' % (compiler.constant(self),))
+
+    def compile_key(self):
+        """Return a key identifying what this Getter computes, or None.
+
+        Getters with equal keys are only computed once by a CompiledPlan.
+        """
+        return None
+
 
 class StaticGetter(Getter):
     """A getter that returns a defined value (independent of the doc)."""
@@ -52,6 +92,9 @@ class StaticGetter(Getter):
     def get(self, raw_doc):
         return self.value
 
+    def compile(self, compiler):
+        return compiler.constant(self.value)
+
 
 def extract_field(raw_doc, subfields, index=0):
     if not isinstance(raw_doc, dict):
@@ -97,6 +140,37 @@ class ExtractField(Getter):
     def get(self, raw_doc):
         return extract_field(raw_doc, self.field)
 
+    def compile_key(self):
+        return (ExtractField,) + tuple(self.field)
+
+    def compile(self, compiler):
+        # This unrolls extract_field for the known number of subfields.
+        result = compiler.assign('[]')
+        indent = compiler.indent
+        doc = 'raw_doc'
+        for subfield in self.field[:-1]:
+            compiler.emit('if isinstance(%s, dict):' % (doc,))
+            compiler.indent += 1
+            val = compiler.assign('%s.get(%r)' % (doc, subfield))
+            compiler.emit('if isinstance(%s, dict):' % (val,))
+            compiler.emit('    %s = (%s,)' % (val, val))
+            compiler.emit('elif not isinstance(%s, list):' % (val,))
+            compiler.emit('    %s = ()' % (val,))
+            doc = compiler.new_name()
+            compiler.emit('for %s in %s:' % (doc, val))
+            compiler.indent += 1
+        compiler.emit('if isinstance(%s, dict):' % (doc,))
+        compiler.indent += 1
+        val = compiler.assign('%s.get(%r)' % (doc, self.field[-1]))
+        compiler.emit('if isinstance(%s, list):' % (val,))
+        compiler.emit('    %s.extend([v for v in %s' % (result, val))
+        compiler.emit('        if not isinstance(v, (dict, list))])')
+        compiler.emit('elif %s is not None and not isinstance(%s, dict):'
+                      % (val, val))
+        compiler.emit('    %s.append(%s)' % (result, val))
+        compiler.indent = indent
+        return result
+
 
 class Transformation(Getter):
     """A transformation on a value from another Getter."""
@@ -129,6 +203,34 @@ class Transformation(Getter):
         """
         raise NotImplementedError(self.transform)
 
+    def compile(self, compiler):
+        values = compiler.compile_getter(self.inner)
+        return compiler.assign(self.compile_transform(compiler, values))
+
+    def compile_key(self):
+        """See Getter.compile_key.
+
+        Transformations are not shared by default, as only the subclass
+        knows whether its arguments change its values. Those whose values
+        only depend on their inner Getter return _inner_compile_key().
+        """
+        return None
+
+    def _inner_compile_key(self):
+        """Return a key made of the class and the key of the inner Getter."""
+        inner = self.inner.compile_key()
+        if inner is None:
+            return None
+        return (type(self), inner)
+
+    def compile_transform(self, compiler, values):
+        """Return a Python expression transforming a list of values.
+
+        :param values: The name of the variable holding the values from the
+            other Getter.
+        """
+        return '%s.transform(%s)' % (compiler.constant(self), values)
+
 
 class Lower(Transformation):
     """Lowercase a string.
@@ -148,47 +250,77 @@ class Lower(Transformation):
             return []
         return [val.lower() for val in values if self._can_transform(val)]
 
+    def compile_key(self):
+        return self._inner_compile_key()
+
+    def compile_transform(self, compiler, values):
+        return ('[v.lower() for v in %s if isinstance(v, basestring)]'
+                % (values,))
+
 
 class Number(Transformation):
-    """Convert an integer to a zero padded string.
+    """Index integers as numbers.
 
     This transformation will return None for non-integer inputs. However, it
-    will transform any integers in a list, dropping any elements that are not
+    will keep any integers in a list, dropping any elements that are not
     integers.
+
+    The second argument used to be the width integers were zero padded to,
+    so that they sorted as text. The values are now stored as integers, and
+    it is only accepted for the index definitions that have it.
     """
 
     name = 'number'
     arity = 2
     args = ['expression', int]
+    numeric = True
+    numeric_only = True
 
     def __init__(self, inner, number):
         super(Number, self).__init__(inner)
-        self.padding = "%%0%sd" % number
+        self.number = number
 
     def _can_transform(self, val):
         return isinstance(val, int) and not isinstance(val, bool)
 
     def transform(self, values):
-        """Transform any integers in values into zero padded strings."""
+        """Keep the integers in values."""
         if not values:
             return []
-        return [self.padding % (v,) for v in values if self._can_transform(v)]
+        return [v for v in values if self._can_transform(v)]
+
+    def compile_key(self):
+        # The padding does not change the values.
+        return self._inner_compile_key()
+
+    def compile_transform(self, compiler, values):
+        return ('[v for v in %s'
+                ' if isinstance(v, int) and not isinstance(v, bool)]'
+                % (values,))
 
 
 class Bool(Transformation):
-    """Convert bool to string."""
+    """Convert bool to the integer 1 or 0."""
 
     name = "bool"
     args = ['expression']
+    numeric = True
+    numeric_only = True
 
     def _can_transform(self, val):
         return isinstance(val, bool)
 
     def transform(self, values):
-        """Transform any booleans in values into strings."""
+        """Transform any booleans in values into integers."""
         if not values:
             return []
-        return [('1' if v else '0') for v in values if self._can_transform(v)]
+        return [int(v) for v in values if self._can_transform(v)]
+
+    def compile_key(self):
+        return self._inner_compile_key()
+
+    def compile_transform(self, compiler, values):
+        return "[int(v) for v in %s if isinstance(v, bool)]" % (values,)
 
 
 class SplitWords(Transformation):
@@ -214,6 +346,18 @@ class SplitWords(Transformation):
                     result.add(word)
         return list(result)
 
+    def compile_key(self):
+        return self._inner_compile_key()
+
+    def compile(self, compiler):
+        values = compiler.compile_getter(self.inner)
+        result = compiler.assign('set()')
+        compiler.emit('for v in %s:' % (values,))
+        compiler.emit('    if isinstance(v, basestring):')
+        compiler.emit('        %s.update(v.split())' % (result,))
+        compiler.emit('%s = list(%s)' % (result, result))
+        return result
+
 
 class Combine(Transformation):
     """Combine multiple expressions into a single index."""
@@ -224,6 +368,8 @@ class Combine(Transformation):
 
     def __init__(self, *inner):
         super(Combine, self).__init__(inner)
+        self.numeric = any([getter.numeric for getter in inner])
+        self.numeric_only = all([getter.numeric_only for getter in inner])
 
     def get(self, raw_doc):
         inner_values = []
@@ -234,6 +380,18 @@ class Combine(Transformation):
     def transform(self, values):
         return values
 
+    def compile_key(self):
+        keys = tuple([inner.compile_key() for inner in self.inner])
+        if None in keys:
+            return None
+        return (Combine,) + keys
+
+    def compile(self, compiler):
+        values = [compiler.compile_getter(inner) for inner in self.inner]
+        if len(values) == 1:
+            return compiler.assign('list(%s)' % (values[0],))
+        return compiler.assign(' + '.join(values))
+
 
 class IsNull(Transformation):
     """Indicate whether the input is None.
@@ -246,6 +404,193 @@ class IsNull(Transformation):
     def transform(self, values):
         return [len(values) == 0]
 
+    def compile_key(self):
+        return self._inner_compile_key()
+
+    def compile_transform(self, compiler, values):
+        return '[not %s]' % (values,)
+
+
+class CompiledGetter(Getter):
+    """A Getter evaluated by a Python function generated for an expression.
+
+    It gives the same results as the Getter tree the expression parses to,
+    without walking the tree for every document.
+    """
+
+    def __init__(self, expression, getter):
+        """Create a CompiledGetter.
+
+        :param expression: The index expression, kept for pickling.
+        :param getter: The Getter the expression parses to.
+        """
+        self.expression = expression
+        self.numeric = getter.numeric
+        self.numeric_only = getter.numeric_only
+        compiler = _Compiler()
+        # The generated function replaces the get method.
+        self.get = compiler.build(compiler.compile_getter(getter), expression)
+        self.source = compiler.source
+        self._getter = getter
+        self._get_many = None
+
+    def get_many(self, docs, field):
+        if self._get_many is None:
+            # The batch function is only generated once it is needed.
+            compiler = _Compiler(indent=2)
+            self._get_many = compiler.build_many(
+                [compiler.compile_getter(self._getter)], ['field'],
+                'get_many(docs, field)', self.expression)
+        return self._get_many(docs, field)
+
+    def __reduce__(self):
+        return (_compile_expression, (self.expression,))
+
+
+def _compile_expression(expression):
+    return Parser().compile(expression)
+
+
+class CompiledPlan(object):
+    """Evaluate several index expressions with one generated function.
+
+    The field paths and transformations the expressions have in common are
+    only computed once per document.
+    """
+
+    def __init__(self, expressions, getters):
+        """Create a CompiledPlan.
+
+        :param expressions: The index expressions, kept for pickling.
+        :param getters: The Getters the expressions parse to.
+        """
+        self.expressions = list(expressions)
+        # Whether the values of each expression are numeric.
+        self.numeric = [getter.numeric for getter in getters]
+        self.numeric_only = [getter.numeric_only for getter in getters]
+        compiler = _Compiler()
+        # evaluate(raw_doc) returns a tuple holding the list of values of
+        # each expression.
+        results = [compiler.compile_getter(getter) for getter in getters]
+        self.evaluate = compiler.build(
+            '(%s)' % (''.join([name + ', ' for name in results]),),
+            ', '.join(self.expressions))
+        self.source = compiler.source
+        self._getters = getters
+        self._evaluate_many = None
+
+    def evaluate_many(self, docs):
+        """Evaluate all the expressions for a batch of documents.
+
+        :param docs: A list of (doc_id, raw_doc).
+        :return: A list of (doc_id, expression, value) rows, ready for
+            executemany.
+        """
+        if self._evaluate_many is None:
+            compiler = _Compiler(indent=2)
+            results = [compiler.compile_getter(getter)
+                       for getter in self._getters]
+            self._evaluate_many = compiler.build_many(
+                results, [compiler.constant(expression)
+                          for expression in self.expressions],
+                'evaluate_many(docs)', ', '.join(self.expressions))
+        return self._evaluate_many(docs)
+
+    def __reduce__(self):
+        return (_compile_plan, (self.expressions,))
+
+
+def _compile_plan(expressions):
+    return Parser().compile_plan(expressions)
+
+
+class _Compiler(object):
+    """Generate the source of a function computing the values of a Getter.
+
+    Getters add statements to the function body, assigning their values to
+    new local variables.
+    """
+
+    def __init__(self, indent=1):
+        self.indent = indent
+        self.namespace = {}
+        self.source = None
+        self._lines = []
+        self._names = 0
+        # Map from Getter.compile_key() => the variable holding its values.
+        self._shared = {}
+
+    def new_name(self):
+        """Return the name of a new local variable."""
+        self._names += 1
+        return '_v%d' % (self._names,)
+
+    def emit(self, line):
+        """Add a line of code at the current indentation."""
+        self._lines.append('    ' * self.indent + line)
+
+    def assign(self, expression):
+        """Assign expression to a new local variable and return its name."""
+        name = self.new_name()
+        self.emit('%s = %s' % (name, expression))
+        return name
+
+    def constant(self, value):
+        """Return a name referring to value from the generated code."""
+        name = '_c%d' % (len(self.namespace),)
+        self.namespace[name] = value
+        return name
+
+    def compile_getter(self, getter):
+        """Generate the code of getter, unless it was already generated.
+
+        :return: The name of the local variable holding the list of values.
+        """
+        key = getter.compile_key()
+        if key is None:
+            return getter.compile(self)
+        name = self._shared.get(key)
+        if name is None:
+            name = self._shared[key] = getter.compile(self)
+        return name
+
+    def build(self, result, expression):
+        """Return the generated function.
+
+        :param result: The Python expression the function returns.
+        """
+        self.emit('return %s' % (result,))
+        return self._define('get(raw_doc)', expression)
+
+    def build_many(self, results, fields, signature, expression):
+        """Return a generated function evaluating a batch of documents.
+
+        The function loops over a list of (doc_id, raw_doc) and returns the
+        (doc_id, field, value) rows. The code of the Getters has to be
+        generated with an indent of 2, inside that loop.
+
+        :param results: The variables holding the values of each Getter.
+        :param fields: The Python expressions of their field names.
+        :param signature: The name and arguments of the function.
+        """
+        for result, field in zip(results, fields):
+            self.emit('for _value in %s:' % (result,))
+            self.emit('    _append((doc_id, %s, _value))' % (field,))
+        if not results:
+            self.emit('pass')
+        self._lines[:0] = ['    _rows = []',
+                           '    _append = _rows.append',
+                           '    for doc_id, raw_doc in docs:']
+        self._lines.append('    return _rows')
+        return self._define(signature, expression)
+
+    def _define(self, signature, expression):
+        """Compile the function from the generated lines and return it."""
+        self.source = 'def %s:\n%s\n' % (signature, '\n'.join(self._lines))
+        code = compile(self.source, '<index %r>' % (expression,), 'exec')
+        exec code in self.namespace
+        return self.namespace[signature.split('(')[0]]
+
 
 def check_fieldname(fieldname):
     if fieldname.endswith('.'):
@@ -253,6 +598,42 @@ def check_fieldname(fieldname):
             "Fieldname cannot end in '.':%s^" % (fieldname,))
 
 
+_integer_re = re.compile(r'-?[0-9]+$')
+
+
+def numeric_key_value(value):
+    """Return the value a query gives for a numeric expression, as stored.
+
+    Queries give index values as strings, so the integers of number() and
+    bool() expressions are given as strings of digits, possibly zero padded.
+    They are returned as ints; globs and other values are returned as is.
+    A list or tuple of alternatives is converted value by value.
+    """
+    if isinstance(value, (list, tuple)):
+        return [numeric_key_value(alternative) for alternative in value]
+    if isinstance(value, basestring) and _integer_re.match(value):
+        number = int(value)
+        # Integers that do not fit in 64 bits are never indexed.
+        if isinstance(number, int):
+            return number
+    return value
+
+
+def numeric_query_value(value):
+    """Return a query value for an expression that is numeric_only.
+
+    Like numeric_key_value, but the only text accepted is integers and the
+    '*' wildcard: those expressions have no text values, so any other text,
+    including a glob such as '1*', raises InvalidValueForIndex.
+    """
+    if isinstance(value, (list, tuple)):
+        return [numeric_query_value(alternative) for alternative in value]
+    if (isinstance(value, basestring) and value != '*'
+            and not _integer_re.match(value)):
+        raise errors.InvalidValueForIndex()
+    return numeric_key_value(value)
+
+
 class Parser(object):
     """Parse an index expression into a sequence of transformations."""
 
@@ -354,6 +735,17 @@ class Parser(object):
     def parse_all(self, fields):
         return [self.parse(field) for field in fields]
 
+    def compile(self, expression):
+        """Parse an expression into a CompiledGetter."""
+        return CompiledGetter(expression, self.parse(expression))
+
+    def compile_all(self, fields):
+        return [self.compile(field) for field in fields]
+
+    def compile_plan(self, fields):
+        """Parse expressions into a CompiledPlan evaluating all of them."""
+        return CompiledPlan(fields, self.parse_all(fields))
+
     @classmethod
     def register_transormation(cls, transform):
         assert transform.name not in cls._transformations, (
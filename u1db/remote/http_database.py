@@ -20,12 +20,12 @@ try:
     import simplejson as json
 except ImportError:
     import json  # noqa
-import uuid
 
 from u1db import (
     Database,
     Document,
     errors,
+    ids,
     )
 from u1db.remote import (
     http_client,
@@ -41,6 +41,8 @@ DOCUMENT_DELETED_STATUS = http_errors.wire_description_to_status[
 class HTTPDatabase(http_client.HTTPClientBase, Database):
     """Implement the Database API to a remote HTTP server."""
 
+    _id_allocator = staticmethod(ids.time_ordered_id)
+
     def __init__(self, url, document_factory=None, creds=None):
         super(HTTPDatabase, self).__init__(url, creds=creds)
         self._factory = document_factory or Document
@@ -48,6 +50,9 @@ class HTTPDatabase(http_client.HTTPClientBase, Database):
     def set_document_factory(self, factory):
         self._factory = factory
 
+    def set_id_allocator(self, allocator):
+        self._id_allocator = allocator
+
     @staticmethod
     def open_database(url, create):
         db = HTTPDatabase(url)
@@ -132,7 +137,7 @@ class HTTPDatabase(http_client.HTTPClientBase, Database):
         return gen, list(self._build_docs(res))
 
     def _allocate_doc_id(self):
-        return 'D-%s' % (uuid.uuid4().hex,)
+        return 'D-%s' % (self._id_allocator(),)
 
     def create_doc(self, content, doc_id=None):
         if not isinstance(content, dict):
@@ -145,6 +145,7 @@ def copy_memory_database_for_test(test, db):
     new_db._docs = copy.deepcopy(db._docs)
     new_db._conflicts = copy.deepcopy(db._conflicts)
     new_db._indexes = copy.deepcopy(db._indexes)
+    new_db._retired_replicas = db._retired_replicas
     new_db._factory = db._factory
     return new_db
 
@@ -155,13 +156,32 @@ def make_sqlite_partial_expanded_for_test(test, replica_uid):
     return db
 
 
+def make_sqlite_composite_key_for_test(test, replica_uid):
+    db = sqlite_backend.SQLiteCompositeKeyDatabase(':memory:')
+    db._set_replica_uid(replica_uid)
+    return db
+
+
+def make_sqlite_surrogate_key_for_test(test, replica_uid):
+    db = sqlite_backend.SQLiteSurrogateKeyDatabase(':memory:')
+    db._set_replica_uid(replica_uid)
+    return db
+
+
+def make_sqlite_replica_dictionary_for_test(test, replica_uid):
+    db = sqlite_backend.SQLitePartialExpandDatabase(':memory:')
+    db.set_rev_storage('replica dictionary')
+    db._set_replica_uid(replica_uid)
+    return db
+
+
 def copy_sqlite_partial_expanded_for_test(test, db):
     # DO NOT COPY OR REUSE THIS CODE OUTSIDE TESTS: COPYING U1DB DATABASES IS
     # THE WRONG THING TO DO, THE ONLY REASON WE DO SO HERE IS TO TEST THAT WE
     # CORRECTLY DETECT IT HAPPENING SO THAT WE CAN RAISE ERRORS RATHER THAN
     # CORRUPT USER DATA. USE SYNC INSTEAD, OR WE WILL SEND NINJA TO YOUR
     # HOUSE.
-    new_db = sqlite_backend.SQLitePartialExpandDatabase(':memory:')
+    new_db = db.__class__(':memory:')
     tmpfile = StringIO()
     for line in db._db_handle.iterdump():
         if not 'sqlite_sequence' in line:  # work around bug in iterdump
@@ -170,6 +190,8 @@ def copy_sqlite_partial_expanded_for_test(test, db):
     new_db._db_handle = dbapi2.connect(':memory:')
     new_db._db_handle.cursor().executescript(tmpfile.read())
     new_db._db_handle.commit()
+    new_db._load_rev_storage()
+    new_db._load_retired_replicas()
     new_db._set_replica_uid(db._replica_uid)
     new_db._factory = db._factory
     return new_db
@@ -215,6 +237,20 @@ LOCAL_DATABASES_SCENARIOS = [
                  'copy_database_for_test':
                  copy_sqlite_partial_expanded_for_test,
                  'make_document_for_test': make_document_for_test}),
+        ('sql_composite', {'make_database_for_test':
+                           make_sqlite_composite_key_for_test,
+                           'copy_database_for_test':
+                           copy_sqlite_partial_expanded_for_test,
+                           'make_document_for_test': make_document_for_test}),
+        ('sql_surrogate', {'make_database_for_test':
+                           make_sqlite_surrogate_key_for_test,
+                           'copy_database_for_test':
+                           copy_sqlite_partial_expanded_for_test,
+                           'make_document_for_test': make_document_for_test}),
+        ('sql_replica_dictionary', {
+            'make_database_for_test': make_sqlite_replica_dictionary_for_test,
+            'copy_database_for_test': copy_sqlite_partial_expanded_for_test,
+            'make_document_for_test': make_document_for_test}),
         ]
 
 
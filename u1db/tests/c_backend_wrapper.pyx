@@ -30,6 +30,7 @@ cdef extern from "Python.h":
     fprintf(FILE *, char *, ...)
     FILE *stderr
     size_t strlen(char *)
+    void *memcpy(void *, void *, size_t)
 
 cdef extern from "stdarg.h":
     ctypedef struct va_list:
@@ -67,18 +68,28 @@ cdef extern from "u1db/u1db.h":
     ctypedef u1db_creds* const_u1db_creds_ptr "const u1db_creds *"
 
     ctypedef char* const_char_ptr "const char*"
+    ctypedef int* const_int_ptr "const int*"
     ctypedef int (*u1db_doc_callback)(void *context, u1db_document *doc)
+    ctypedef int (*u1db_doc_id_callback)(void *context, const_char_ptr doc_id)
     ctypedef int (*u1db_key_callback)(void *context, int num_fields,
                                       const_char_ptr *key)
+    ctypedef int (*u1db_typed_key_callback)(void *context, int num_fields,
+                                            const_char_ptr *key,
+                                            const_int_ptr is_integer)
     ctypedef int (*u1db_doc_gen_callback)(void *context,
         u1db_document *doc, int gen, const_char_ptr trans_id)
     ctypedef int (*u1db_trans_info_callback)(void *context,
         const_char_ptr doc_id, int gen, const_char_ptr trans_id)
+    ctypedef int (*u1db_id_allocator)(void *context, char *id)
 
     u1database * u1db_open(char *fname)
     void u1db_free(u1database **)
     int u1db_set_replica_uid(u1database *, char *replica_uid)
     int u1db_set_document_size_limit(u1database *, int limit)
+    int u1db_set_id_allocator(u1database *db, void *context,
+                              u1db_id_allocator allocator)
+    int u1db_random_id(void *context, char *id)
+    int u1db_time_ordered_id(void *context, char *id)
     int u1db_get_replica_uid(u1database *, const_char_ptr *replica_uid)
     int u1db_create_doc_from_json(u1database *db, char *json, char *doc_id,
                                   u1db_document **doc)
@@ -91,6 +102,10 @@ cdef extern from "u1db/u1db.h":
     int u1db_get_all_docs(u1database *db, int include_deleted, int *generation,
                           void *context, u1db_doc_callback cb)
     int u1db_put_doc(u1database *db, u1db_document *doc)
+    int u1db_put_docs(u1database *db, int n_docs, u1db_document **docs,
+                      int *statuses)
+    int u1db_create_docs(u1database *db, int n_docs, const_char_ptr *jsons,
+                         u1db_document **docs)
     int u1db__validate_source(u1database *db, const_char_ptr replica_uid,
                               int replica_gen, const_char_ptr replica_trans_id)
     int u1db__put_doc_if_newer(u1database *db, u1db_document *doc,
@@ -118,6 +133,13 @@ cdef extern from "u1db/u1db.h":
     int u1db_get_from_index(u1database *db, u1query *query, void *context,
                              u1db_doc_callback cb, int n_values, char *val0,
                              ...)
+    int u1db_get_doc_ids_from_index_list(u1database *db, u1query *query,
+                                         void *context,
+                                         u1db_doc_id_callback cb,
+                                         int n_values, const_char_ptr *values)
+    int u1db_count_from_index_list(u1database *db, u1query *query,
+                                   int n_values, const_char_ptr *values,
+                                   int *count)
     int u1db_get_range_from_index(u1database *db, u1query *query,
                                   void *context, u1db_doc_callback cb,
                                   int n_values, const_char_ptr *start_values,
@@ -128,6 +150,8 @@ cdef extern from "u1db/u1db.h":
                             int n_expressions, const_char_ptr *expressions))
     int u1db_get_index_keys(u1database *db, char *index_name, void *context,
                             u1db_key_callback cb)
+    int u1db_get_typed_index_keys(u1database *db, char *index_name,
+                                  void *context, u1db_typed_key_callback cb)
     int u1db_simple_lookup1(u1database *db, char *index_name, char *val1,
                             void *context, u1db_doc_callback cb)
     int u1db_query_init(u1database *db, char *index_name, u1query **query)
@@ -303,7 +327,11 @@ cdef extern from "u1db/u1db_vectorclock.h":
     int u1db__vectorclock_is_newer(u1db_vectorclock *maybe_newer,
                                    u1db_vectorclock *older)
 
-from u1db import errors
+try:
+    import simplejson as json
+except ImportError:
+    import json  # noqa
+from u1db import errors, ids
 from sqlite3 import dbapi2
 
 
@@ -316,6 +344,30 @@ cdef int _append_trans_info_to_list(void *context, const_char_ptr doc_id,
     return 0
 
 
+cdef int _append_doc_id_to_list(void *context,
+                                const_char_ptr doc_id) with gil:
+    a_list = <object>(context)
+    doc = doc_id
+    a_list.append(doc)
+    return 0
+
+
+cdef int _call_id_allocator(void *context, char *id) with gil:
+    allocator = <object>context
+    try:
+        new_id = allocator()
+        if isinstance(new_id, unicode):
+            new_id = new_id.encode('ascii')
+        if not isinstance(new_id, str) or len(new_id) != 32:
+            return U1DB_INVALID_PARAMETER
+    except:
+        # Like _trace_hook, the exception can not get through the C layer,
+        # so the id is not allocated.
+        return U1DB_INVALID_PARAMETER
+    memcpy(id, PyString_AsString(new_id), 32)
+    return U1DB_OK
+
+
 cdef int _append_doc_to_list(void *context, u1db_document *doc) with gil:
     a_list = <object>context
     pydoc = CDocument()
@@ -324,12 +376,16 @@ cdef int _append_doc_to_list(void *context, u1db_document *doc) with gil:
     return 0
 
 cdef int _append_key_to_list(void *context, int num_fields,
-                             const_char_ptr *key) with gil:
+                             const_char_ptr *key,
+                             const_int_ptr is_integer) with gil:
     a_list = <object>(context)
     field_list = []
     for i from 0 <= i < num_fields:
         field = key[i]
-        field_list.append(field.decode('utf-8'))
+        if is_integer[i]:
+            field_list.append(int(field))
+        else:
+            field_list.append(field.decode('utf-8'))
     a_list.append(tuple(field_list))
     return 0
 
@@ -903,11 +959,15 @@ cdef class CDatabase(object):
     cdef public object _filename
     cdef u1database *_db
     cdef public object _supports_indexes
+    # Keeps the Python id allocator alive while the C side refers to it.
+    cdef object _id_allocator
 
     def __init__(self, filename):
         self._supports_indexes = False
         self._filename = filename
         self._db = u1db_open(self._filename)
+        if self._db == NULL:
+            raise RuntimeError("Failed to open %s" % (self._filename,))
 
     def __dealloc__(self):
         u1db_free(&self._db)
@@ -969,6 +1029,20 @@ cdef class CDatabase(object):
                 "document_size_limit could not be set to %d, error: %d",
                 (limit, status))
 
+    def set_id_allocator(self, allocator):
+        cdef int status
+
+        if allocator is ids.random_id:
+            status = u1db_set_id_allocator(self._db, NULL, u1db_random_id)
+        elif allocator is ids.time_ordered_id:
+            status = u1db_set_id_allocator(
+                self._db, NULL, u1db_time_ordered_id)
+        else:
+            status = u1db_set_id_allocator(
+                self._db, <void*>allocator, _call_id_allocator)
+        handle_status("set_id_allocator", status)
+        self._id_allocator = allocator
+
     def _allocate_doc_id(self):
         cdef char *val
         val = u1db__allocate_doc_id(self._db)
@@ -1025,6 +1099,61 @@ cdef class CDatabase(object):
             u1db_put_doc(self._db, doc._doc))
         return doc.rev
 
+    def put_docs(self, docs):
+        cdef u1db_document **c_docs
+        cdef int *statuses
+        cdef int n_docs, i
+        cdef CDocument doc
+
+        n_docs = len(docs)
+        c_docs = <u1db_document **>calloc(n_docs, sizeof(u1db_document *))
+        statuses = <int *>calloc(n_docs, sizeof(int))
+        try:
+            for i from 0 <= i < n_docs:
+                doc = docs[i]
+                c_docs[i] = doc._doc
+            handle_status("Failed to put_docs",
+                u1db_put_docs(self._db, n_docs, c_docs, statuses))
+            results = []
+            for i from 0 <= i < n_docs:
+                try:
+                    handle_status("Failed to put_docs", statuses[i])
+                except errors.U1DBError, e:
+                    results.append(e)
+                else:
+                    results.append(docs[i].rev)
+            return results
+        finally:
+            free(<void*>c_docs)
+            free(<void*>statuses)
+
+    def create_docs(self, contents):
+        cdef u1db_document **c_docs
+        cdef const_char_ptr *jsons
+        cdef int n_docs, i
+        cdef CDocument pydoc
+
+        for content in contents:
+            if not isinstance(content, dict):
+                raise errors.InvalidContent
+        # keep a reference to json_strs so that the pointers in jsons remain
+        # valid.
+        json_strs = [json.dumps(content) for content in contents]
+        _list_to_array(json_strs, &jsons, &n_docs)
+        c_docs = <u1db_document **>calloc(n_docs, sizeof(u1db_document *))
+        try:
+            handle_status("Failed to create_docs",
+                u1db_create_docs(self._db, n_docs, jsons, c_docs))
+            docs = []
+            for i from 0 <= i < n_docs:
+                pydoc = CDocument()
+                pydoc._doc = c_docs[i]
+                docs.append(pydoc)
+            return docs
+        finally:
+            free(<void*>jsons)
+            free(<void*>c_docs)
+
     def _validate_source(self, replica_uid, replica_gen, replica_trans_id):
         cdef const_char_ptr c_uid, c_trans_id
         cdef int c_gen = 0
@@ -1335,6 +1464,42 @@ cdef class CDatabase(object):
         handle_status("get_from_index", status)
         return res
 
+    def get_doc_ids_from_index(self, index_name, *key_values):
+        cdef const_char_ptr *values
+        cdef int n_values
+        cdef CQuery query
+
+        query = self._query_init(index_name)
+        res = []
+        # keep a reference to new_objs so that the pointers in expressions
+        # remain valid.
+        new_objs = _list_to_str_array(key_values, &values, &n_values)
+        try:
+            handle_status(
+                "get_doc_ids_from_index", u1db_get_doc_ids_from_index_list(
+                    self._db, query._query, <void*>res,
+                    _append_doc_id_to_list, n_values, values))
+        finally:
+            free(<void*>values)
+        return res
+
+    def count_from_index(self, index_name, *key_values):
+        cdef const_char_ptr *values
+        cdef int n_values
+        cdef int count
+        cdef CQuery query
+
+        query = self._query_init(index_name)
+        count = 0
+        new_objs = _list_to_str_array(key_values, &values, &n_values)
+        try:
+            handle_status(
+                "count_from_index", u1db_count_from_index_list(
+                    self._db, query._query, n_values, values, &count))
+        finally:
+            free(<void*>values)
+        return count
+
     def get_range_from_index(self, index_name, start_value=None,
                              end_value=None):
         cdef CQuery query
@@ -1375,7 +1540,7 @@ cdef class CDatabase(object):
         cdef int status
         keys = []
         status = U1DB_OK
-        status = u1db_get_index_keys(
+        status = u1db_get_typed_index_keys(
             self._db, index_name, <void*>keys, _append_key_to_list)
         handle_status("get_index_keys", status)
         return keys
@@ -622,6 +622,47 @@ class LocalDatabaseTests(tests.DatabaseBaseTests):
         self.assertEqual((2, last_trans_id, [(doc.doc_id, 2, last_trans_id)]),
                          self.db.whats_changed(db_gen))
 
+    def test_put_docs(self):
+        doc1 = self.make_document('doc-1', None, simple_doc)
+        doc2 = self.make_document('doc-2', None, nested_doc)
+        self.assertEqual(['test:1', 'test:1'],
+                         self.db.put_docs([doc1, doc2]))
+        self.assertGetDoc(self.db, 'doc-1', 'test:1', simple_doc, False)
+        self.assertGetDoc(self.db, 'doc-2', 'test:1', nested_doc, False)
+        self.assertTransactionLog(['doc-1', 'doc-2'], self.db)
+
+    def test_put_docs_updates(self):
+        doc = self.db.create_doc_from_json(simple_doc, doc_id='doc-1')
+        doc.set_json(nested_doc)
+        self.assertEqual(['test:2'], self.db.put_docs([doc]))
+        self.assertEqual('test:2', doc.rev)
+        self.assertGetDoc(self.db, 'doc-1', 'test:2', nested_doc, False)
+
+    def test_put_docs_reports_errors(self):
+        self.db.create_doc_from_json(simple_doc, doc_id='doc-1')
+        conflicting = self.make_document('doc-1', None, nested_doc)
+        bad_id = self.make_document('/a', None, simple_doc)
+        good = self.make_document('doc-2', None, simple_doc)
+        results = self.db.put_docs([conflicting, bad_id, good])
+        self.assertIsInstance(results[0], errors.RevisionConflict)
+        self.assertIsInstance(results[1], errors.InvalidDocId)
+        self.assertEqual('test:1', results[2])
+        self.assertGetDoc(self.db, 'doc-1', 'test:1', simple_doc, False)
+        self.assertGetDoc(self.db, 'doc-2', 'test:1', simple_doc, False)
+        self.assertTransactionLog(['doc-1', 'doc-2'], self.db)
+
+    def test_put_docs_same_doc_twice(self):
+        doc = self.make_document('doc-1', None, simple_doc)
+        doc2 = self.make_document('doc-1', 'test:1', nested_doc)
+        self.assertEqual(['test:1', 'test:2'],
+                         self.db.put_docs([doc, doc2]))
+        self.assertGetDoc(self.db, 'doc-1', 'test:2', nested_doc, False)
+        self.assertTransactionLog(['doc-1', 'doc-1'], self.db)
+
+    def test_put_docs_empty_list(self):
+        self.assertEqual([], self.db.put_docs([]))
+        self.assertEqual(0, self.db._get_generation())
+
     def test_whats_changed_initial_database(self):
         self.assertEqual((0, '', []), self.db.whats_changed())
 
@@ -1513,6 +1554,50 @@ class DatabaseIndexTests(tests.DatabaseBaseTests):
         self.assertRaises(
             errors.IndexDoesNotExist, self.db.get_from_index, 'foo')
 
+    def test_get_doc_ids_from_index(self):
+        docs = {}
+        for v in ('a', 'b', 'b1', 'c'):
+            docs[v] = self.db.create_doc_from_json(json.dumps({"key": v}))
+        self.db.create_index('test-idx', 'key')
+        self.assertEqual(
+            [docs['b'].doc_id],
+            self.db.get_doc_ids_from_index('test-idx', 'b'))
+        self.assertEqual(
+            [docs['b'].doc_id, docs['b1'].doc_id],
+            self.db.get_doc_ids_from_index('test-idx', 'b*'))
+        self.assertEqual(
+            [], self.db.get_doc_ids_from_index('test-idx', 'd'))
+
+    def test_get_doc_ids_from_index_lists_doc_once(self):
+        doc = self.db.create_doc_from_json('{"key": ["value1", "value2"]}')
+        self.db.create_index('test-idx', 'key')
+        self.assertEqual(
+            [doc.doc_id], self.db.get_doc_ids_from_index('test-idx', '*'))
+
+    def test_get_doc_ids_from_index_fails_if_no_index(self):
+        self.assertRaises(
+            errors.IndexDoesNotExist, self.db.get_doc_ids_from_index, 'foo')
+
+    def test_count_from_index(self):
+        self.db.create_doc_from_json('{"key": "value", "key2": "a"}')
+        self.db.create_doc_from_json('{"key": "value", "key2": ["a", "b"]}')
+        self.db.create_doc_from_json('{"key": "other", "key2": "a"}')
+        self.db.create_index('test-idx', 'key', 'key2')
+        self.assertEqual(2, self.db.count_from_index('test-idx', 'value', '*'))
+        self.assertEqual(1, self.db.count_from_index('test-idx', 'value', 'b'))
+        self.assertEqual(3, self.db.count_from_index('test-idx', '*', '*'))
+        self.assertEqual(0, self.db.count_from_index('test-idx', 'x', '*'))
+
+    def test_count_from_index_illegal_number_of_entries(self):
+        self.db.create_index('test-idx', 'k1', 'k2')
+        self.assertRaises(
+            errors.InvalidValueForIndex,
+            self.db.count_from_index, 'test-idx', 'v1')
+
+    def test_count_from_index_fails_if_no_index(self):
+        self.assertRaises(
+            errors.IndexDoesNotExist, self.db.count_from_index, 'foo')
+
     def test_get_index_keys_fails_if_no_index(self):
         self.assertRaises(errors.IndexDoesNotExist,
                           self.db.get_index_keys,
@@ -1870,6 +1955,87 @@ class DatabaseIndexTests(tests.DatabaseBaseTests):
         rows = self.db.get_from_index("index", "something")
         self.assertEqual([doc2], rows)
 
+    def test_get_from_index_with_negative_number(self):
+        self.db.create_index("index", "number(foo, 5)")
+        doc = self.db.create_doc_from_json('{"foo": -12}')
+        self.assertEqual([doc], self.db.get_from_index("index", "-12"))
+
+    def test_get_range_from_index_with_numbers(self):
+        self.db.create_index("index", "number(foo, 2)")
+        docs = dict((n, self.db.create_doc_from_json('{"foo": %d}' % (n,)))
+                    for n in [-100, -5, 0, 7, 10, 300])
+        self.assertEqual(
+            [docs[-5], docs[0], docs[7], docs[10]],
+            self.db.get_range_from_index("index", "-5", "10"))
+        self.assertEqual(
+            [docs[7], docs[10], docs[300]],
+            self.db.get_range_from_index("index", "7"))
+        self.assertEqual(
+            [docs[-100], docs[-5]],
+            self.db.get_range_from_index("index", None, "-1"))
+
+    def test_get_range_from_index_with_bool(self):
+        self.db.create_index("index", "bool(foo)", "bar")
+        doc1 = self.db.create_doc_from_json('{"foo": true, "bar": "a"}')
+        doc2 = self.db.create_doc_from_json('{"foo": false, "bar": "b"}')
+        self.assertEqual(
+            [doc2, doc1], self.db.get_range_from_index("index", ("0", "*")))
+        self.assertEqual(
+            [doc1], self.db.get_range_from_index("index", ("1", "*")))
+
+    def test_number_and_text_values_are_apart(self):
+        self.db.create_index("index", "combine(number(foo, 1), bar)")
+        doc1 = self.db.create_doc_from_json('{"foo": 12}')
+        doc2 = self.db.create_doc_from_json('{"bar": "12"}')
+        self.assertEqual([doc1], self.db.get_from_index("index", "12"))
+        # Numbers sort before text.
+        self.assertEqual([doc1, doc2], self.db.get_from_index("index", "*"))
+
+    def test_get_index_keys_from_number_index(self):
+        self.db.create_index("index", "number(foo, 5)", "bool(bar)")
+        self.db.create_doc_from_json('{"foo": 12, "bar": true}')
+        self.db.create_doc_from_json('{"foo": -3, "bar": false}')
+        self.assertEqual(
+            [(-3, 0), (12, 1)], sorted(self.db.get_index_keys("index")))
+
+    def test_get_from_index_rejects_number_globs(self):
+        self.db.create_index("index", "number(foo, 1)")
+        self.db.create_doc_from_json('{"foo": 12}')
+        self.db.create_doc_from_json('{"foo": 130}')
+        self.assertRaises(
+            errors.InvalidValueForIndex, self.db.get_from_index, "index",
+            "1*")
+        self.assertRaises(
+            errors.InvalidValueForIndex, self.db.count_from_index, "index",
+            "1*")
+        self.assertRaises(
+            errors.InvalidValueForIndex, self.db.get_from_index, "index",
+            "abc")
+
+    def test_get_from_index_rejects_number_globs_in_composite_keys(self):
+        self.db.create_index("index", "bool(foo)", "bar")
+        doc = self.db.create_doc_from_json('{"foo": true, "bar": "a"}')
+        self.assertRaises(
+            errors.InvalidValueForIndex, self.db.get_from_index, "index",
+            "1*", "*")
+        self.assertEqual([doc], self.db.get_from_index("index", "1", "a*"))
+        self.assertEqual([doc], self.db.get_from_index("index", "*", "*"))
+
+    def test_globs_only_match_text_values(self):
+        self.db.create_index("index", "combine(number(foo, 1), bar)")
+        self.db.create_doc_from_json('{"foo": 12}')
+        doc = self.db.create_doc_from_json('{"bar": "13"}')
+        self.assertEqual([doc], self.db.get_from_index("index", "1*"))
+
+    def test_get_range_from_index_rejects_non_integers(self):
+        self.db.create_index("index", "number(foo, 1)")
+        self.db.create_doc_from_json('{"foo": 12}')
+        for start_value, end_value in [
+                ("100", "13*"), (None, "1*"), (None, "abc"), ("1.5", None)]:
+            self.assertRaises(
+                errors.InvalidValueForIndex, self.db.get_range_from_index,
+                "index", start_value, end_value)
+
     def test_get_index_keys_from_index(self):
         self.db.create_index('test-idx', 'key')
         content1 = '{"key": "value1"}'
@@ -1956,6 +2122,222 @@ class DatabaseIndexTests(tests.DatabaseBaseTests):
         self.assertParseError('combine(lower(x)x,foo)')
 
 
+class DatabaseIndexCursorTests(tests.DatabaseBaseTests):
+
+    def setUp(self):
+        super(DatabaseIndexCursorTests, self).setUp()
+        self.db.create_index('test-idx', 'key', 'sub')
+        self.doc1 = self.db.create_doc_from_json(
+            '{"key": "a", "sub": "x"}', doc_id='doc1')
+        self.doc2 = self.db.create_doc_from_json(
+            '{"key": "a", "sub": "x"}', doc_id='doc2')
+        self.doc3 = self.db.create_doc_from_json(
+            '{"key": "a", "sub": "y"}', doc_id='doc3')
+        self.doc4 = self.db.create_doc_from_json(
+            '{"key": "b", "sub": "x"}', doc_id='doc4')
+
+    def test_iter_from_index(self):
+        self.assertEqual(
+            [self.doc1, self.doc2, self.doc3],
+            list(self.db.iter_from_index('test-idx', ('a', '*'))))
+
+    def test_iter_from_index_exact(self):
+        self.assertEqual(
+            [self.doc1, self.doc2],
+            list(self.db.iter_from_index('test-idx', ('a', 'x'))))
+
+    def test_iter_from_index_descending(self):
+        self.assertEqual(
+            [self.doc3, self.doc2, self.doc1],
+            list(self.db.iter_from_index(
+                'test-idx', ('a', '*'), descending=True)))
+
+    def test_iter_from_index_pages(self):
+        cursor = self.db.iter_from_index('test-idx', ('*', '*'), limit=3)
+        self.assertEqual([self.doc1, self.doc2, self.doc3], list(cursor))
+        cursor = self.db.iter_from_index(
+            'test-idx', ('*', '*'), limit=3, resume_token=cursor.resume_token)
+        self.assertEqual([self.doc4], list(cursor))
+        token = cursor.resume_token
+        cursor = self.db.iter_from_index(
+            'test-idx', ('*', '*'), limit=3, resume_token=token)
+        self.assertEqual([], list(cursor))
+        self.assertEqual(token, cursor.resume_token)
+
+    def test_iter_from_index_pages_descending(self):
+        cursor = self.db.iter_from_index(
+            'test-idx', ('a*', '*'), limit=2, descending=True)
+        self.assertEqual([self.doc3, self.doc2], list(cursor))
+        cursor = self.db.iter_from_index(
+            'test-idx', ('a*', '*'), limit=2, descending=True,
+            resume_token=cursor.resume_token)
+        self.assertEqual([self.doc1], list(cursor))
+
+    def test_iter_from_index_stop_early(self):
+        cursor = self.db.iter_from_index('test-idx', ('*', '*'))
+        self.assertEqual(self.doc1, cursor.next())
+        cursor = self.db.iter_from_index(
+            'test-idx', ('*', '*'), resume_token=cursor.resume_token)
+        self.assertEqual([self.doc2, self.doc3, self.doc4], list(cursor))
+
+    def test_iter_from_index_doc_under_several_keys(self):
+        doc = self.db.create_doc_from_json(
+            '{"key": ["a", "b"], "sub": "z"}', doc_id='doc5')
+        self.assertEqual(
+            [self.doc1, self.doc2, self.doc3, doc, self.doc4, doc],
+            list(self.db.iter_from_index('test-idx', ('*', '*'))))
+
+    def test_iter_from_index_invalid_resume_token(self):
+        self.assertRaises(
+            errors.InvalidResumeToken, self.db.iter_from_index, 'test-idx',
+            ('*', '*'), resume_token='["a"]')
+
+    def test_iter_range_from_index(self):
+        cursor = self.db.iter_range_from_index(
+            'test-idx', ('a', 'x'), ('a', 'y'), limit=2)
+        self.assertEqual([self.doc1, self.doc2], list(cursor))
+        cursor = self.db.iter_range_from_index(
+            'test-idx', ('a', 'x'), ('a', 'y'),
+            resume_token=cursor.resume_token)
+        self.assertEqual([self.doc3], list(cursor))
+
+    def test_iter_range_from_index_unbounded(self):
+        self.assertEqual(
+            [self.doc4, self.doc3],
+            list(self.db.iter_range_from_index(
+                'test-idx', descending=True, limit=2)))
+
+    def test_iter_index_keys(self):
+        cursor = self.db.iter_index_keys('test-idx', limit=2)
+        self.assertEqual([('a', 'x'), ('a', 'y')], list(cursor))
+        cursor = self.db.iter_index_keys(
+            'test-idx', resume_token=cursor.resume_token)
+        self.assertEqual([('b', 'x')], list(cursor))
+
+    def test_iter_index_keys_descending(self):
+        self.assertEqual(
+            [('b', 'x'), ('a', 'y'), ('a', 'x')],
+            list(self.db.iter_index_keys('test-idx', descending=True)))
+
+    def test_iter_index_keys_no_such_index(self):
+        self.assertRaises(
+            errors.IndexDoesNotExist, self.db.iter_index_keys, 'foo')
+
+    def test_iter_index_keys_sorts_numbers(self):
+        self.db.create_index("index", "number(foo, 1)")
+        for n in [20, -3, 100, 9]:
+            self.db.create_doc_from_json('{"foo": %d}' % (n,))
+        self.assertEqual([(-3,), (9,), (20,), (100,)],
+                         list(self.db.iter_index_keys("index")))
+        cursor = self.db.iter_index_keys("index", limit=2)
+        self.assertEqual([(-3,), (9,)], list(cursor))
+        self.assertEqual(
+            [(20,), (100,)],
+            list(self.db.iter_index_keys(
+                "index", resume_token=cursor.resume_token)))
+
+
+class DatabaseIndexIntersectionTests(tests.DatabaseBaseTests):
+
+    def setUp(self):
+        super(DatabaseIndexIntersectionTests, self).setUp()
+        self.db.create_index('by-tag', 'tags')
+        self.db.create_index('by-key', 'key', 'sub')
+        self.doc1 = self.db.create_doc_from_json(
+            '{"key": "a", "sub": "x", "tags": ["work", "urgent"]}',
+            doc_id='doc1')
+        self.doc2 = self.db.create_doc_from_json(
+            '{"key": "b", "sub": "x", "tags": ["work"]}', doc_id='doc2')
+        self.doc3 = self.db.create_doc_from_json(
+            '{"key": "c", "sub": "y", "tags": ["urgent", "work", "home"]}',
+            doc_id='doc3')
+
+    def test_get_from_index_list(self):
+        self.assertEqual(
+            [self.doc1, self.doc3],
+            self.db.get_from_index('by-key', ['c', 'a'], '*'))
+
+    def test_get_from_index_list_exact(self):
+        self.assertEqual(
+            [self.doc1, self.doc3],
+            self.db.get_from_index('by-key', ['a', 'c'], ['y', 'x']))
+
+    def test_get_from_index_list_no_match(self):
+        self.assertEqual(
+            [], self.db.get_from_index('by-key', ['d', 'e'], '*'))
+
+    def test_get_from_index_list_returns_doc_once(self):
+        self.assertEqual(
+            ['doc1', 'doc3'],
+            sorted(doc.doc_id for doc in self.db.get_from_index(
+                'by-tag', ['home', 'urgent'])))
+
+    def test_get_from_index_list_rejects_non_integers(self):
+        self.db.create_index('by-number', 'number(number, 1)')
+        self.assertRaises(
+            errors.InvalidValueForIndex, self.db.get_from_index, 'by-number',
+            ['12', '1.5'])
+
+    def test_get_from_index_list_after_wildcard(self):
+        self.assertRaises(
+            errors.InvalidGlobbing,
+            self.db.get_from_index, 'by-key', '*', ['x', 'y'])
+
+    def test_get_doc_ids_from_index_list(self):
+        self.assertEqual(
+            ['doc1', 'doc2'],
+            self.db.get_doc_ids_from_index('by-key', ['a', 'b'], 'x'))
+
+    def test_count_from_index_list(self):
+        self.assertEqual(
+            3, self.db.count_from_index('by-tag', ['home', 'work']))
+
+    def test_get_from_index_intersection(self):
+        self.assertEqual(
+            [self.doc1, self.doc3],
+            self.db.get_from_index_intersection(
+                [('by-tag', 'urgent'), ('by-tag', 'work')]))
+
+    def test_get_from_index_intersection_ordered_by_first_query(self):
+        self.assertEqual(
+            [self.doc1, self.doc2],
+            self.db.get_from_index_intersection(
+                [('by-key', ['a', 'b'], '*'), ('by-tag', 'work')]))
+
+    def test_get_from_index_intersection_single_query(self):
+        self.assertEqual(
+            self.db.get_from_index('by-tag', 'work'),
+            self.db.get_from_index_intersection([('by-tag', 'work')]))
+
+    def test_get_from_index_intersection_wildcards(self):
+        self.assertEqual(
+            [self.doc3],
+            self.db.get_from_index_intersection(
+                [('by-tag', 'h*'), ('by-key', 'c', '*')]))
+
+    def test_get_from_index_intersection_no_match(self):
+        self.assertEqual(
+            [], self.db.get_from_index_intersection(
+                [('by-tag', 'home'), ('by-key', 'a', '*')]))
+
+    def test_get_from_index_intersection_no_queries(self):
+        self.assertRaises(
+            errors.InvalidValueForIndex,
+            self.db.get_from_index_intersection, [])
+
+    def test_get_from_index_intersection_wrong_number_of_values(self):
+        self.assertRaises(
+            errors.InvalidValueForIndex,
+            self.db.get_from_index_intersection,
+            [('by-tag', 'work'), ('by-key', 'a')])
+
+    def test_get_from_index_intersection_no_such_index(self):
+        self.assertRaises(
+            errors.IndexDoesNotExist,
+            self.db.get_from_index_intersection,
+            [('by-tag', 'work'), ('foo', 'a')])
+
+
 class PythonBackendTests(tests.DatabaseBaseTests):
 
     def setUp(self):
@@ -2011,6 +2393,110 @@ class PythonBackendTests(tests.DatabaseBaseTests):
                 self.db.get_from_index('test-idx', 'value')[0],
                 TestAlternativeDocument))
 
+    def put_retired_doc(self):
+        doc = self.db.create_doc_from_json(simple_doc, doc_id='doc-id')
+        self.db._put_doc_if_newer(
+            self.make_document('doc-id', 'other:2|test:1', simple_doc),
+            save_conflict=False, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-1')
+        self.db.retire_replicas(['other'])
+        doc = self.db.get_doc('doc-id')
+        self.db.put_doc(doc)
+        return doc
+
+    def test_retire_replicas_folds_new_revs(self):
+        doc = self.put_retired_doc()
+        self.assertEqual('retired:2|test:2', doc.rev)
+        self.assertGetDoc(self.db, 'doc-id', 'retired:2|test:2', simple_doc,
+                          False)
+
+    def test_retire_replicas_newer_folded_rev(self):
+        self.put_retired_doc()
+        doc = self.make_document('doc-id', 'retired:2|test:2|third:1',
+                                 nested_doc)
+        state, _ = self.db._put_doc_if_newer(
+            doc, save_conflict=False, replica_uid='third', replica_gen=1,
+            replica_trans_id='T-2')
+        self.assertEqual('inserted', state)
+
+    def test_retire_replicas_unfolded_revs_conflict(self):
+        # Once folded, the order of the retired counters is lost, so revs
+        # that still carry them are neither newer nor older.
+        self.put_retired_doc()
+        for rev in ['other:2|test:2|third:1', 'other:1|test:1']:
+            doc = self.make_document('doc-id', rev, nested_doc)
+            state, _ = self.db._put_doc_if_newer(
+                doc, save_conflict=False, replica_uid='third',
+                replica_gen=1, replica_trans_id='T-2')
+            self.assertEqual('conflicted', state)
+
+    def test_retire_replicas_keeps_conflicts_of_retired_revs(self):
+        self.db._put_doc_if_newer(
+            self.make_document('doc-id', 'r1:3|r2:1', simple_doc),
+            save_conflict=False, replica_uid='r1', replica_gen=1,
+            replica_trans_id='T-1')
+        self.db.retire_replicas(['r1', 'r2'])
+        doc = self.make_document('doc-id', 'r1:1|r2:4', nested_doc)
+        state, _ = self.db._put_doc_if_newer(
+            doc, save_conflict=True, replica_uid='r2', replica_gen=1,
+            replica_trans_id='T-2')
+        self.assertEqual('conflicted', state)
+        # As with any sync conflict, the local document is kept as a
+        # conflict of the incoming one.
+        self.assertGetDoc(self.db, 'doc-id', 'r1:1|r2:4', nested_doc, True)
+        self.assertEqual(
+            ['r1:1|r2:4', 'r1:3|r2:1'],
+            sorted([c.rev for c in self.db.get_doc_conflicts('doc-id')]))
+        doc = self.db.get_doc('doc-id')
+        self.db.resolve_doc(doc, ['r1:1|r2:4', 'r1:3|r2:1'])
+        # The largest counters are folded: 3 + 4.
+        self.assertEqual('retired:7|test:1', doc.rev)
+
+    def test_retire_replicas_conflict(self):
+        self.put_retired_doc()
+        doc = self.make_document('doc-id', 'other:2|test:1|third:1',
+                                 nested_doc)
+        state, _ = self.db._put_doc_if_newer(
+            doc, save_conflict=True, replica_uid='third', replica_gen=1,
+            replica_trans_id='T-2')
+        self.assertEqual('conflicted', state)
+        doc = self.db.get_doc('doc-id')
+        self.db.resolve_doc(doc, [c.rev for c in
+                                  self.db.get_doc_conflicts('doc-id')])
+        self.assertEqual('retired:2|test:3|third:1', doc.rev)
+
+    def test_retire_own_replica(self):
+        self.assertRaises(errors.InvalidReplicaUID,
+                          self.db.retire_replicas, ['other', 'test'])
+
+    def test_create_docs(self):
+        docs = self.db.create_docs([self.simple_doc, {'key': 'other'}])
+        self.assertEqual(2, len(docs))
+        self.assertNotEqual(docs[0].doc_id, docs[1].doc_id)
+        self.assertGetDoc(self.db, docs[0].doc_id, 'test:1', simple_doc,
+                          False)
+        self.assertGetDoc(self.db, docs[1].doc_id, 'test:1',
+                          '{"key": "other"}', False)
+
+    def test_create_docs_with_invalid_content(self):
+        self.assertRaises(errors.InvalidContent, self.db.create_docs,
+                          [self.simple_doc, "{}"])
+        self.assertEqual(0, self.db._get_generation())
+
+    def test_create_docs_refuses_oversized_documents(self):
+        self.db.set_document_size_limit(1)
+        self.assertRaises(errors.DocumentTooBig, self.db.create_docs,
+                          [self.simple_doc])
+        self.assertEqual(0, self.db._get_generation())
+
+    def test_create_docs_updates_indexes(self):
+        self.db.create_index('test-idx', 'key')
+        docs = self.db.create_docs([self.simple_doc, {'key': 'other'}])
+        self.assertEqual(
+            [docs[0]], self.db.get_from_index('test-idx', 'value'))
+        self.assertEqual(
+            [docs[1]], self.db.get_from_index('test-idx', 'other'))
+
     def test_sync_exchange_updates_indexes(self):
         doc = self.db.create_doc(self.simple_doc)
         self.db.create_index('test-idx', 'key')
@@ -21,9 +21,12 @@ except ImportError:
 from u1db import (
     Document,
     errors,
+    ids,
     tests,
     )
+from u1db.backends import sqlite_backend
 from u1db.tests import c_backend_wrapper, c_backend_error
+from u1db.tests.test_sqlite_backend import make_old_schema
 from u1db.tests.test_remote_sync_target import (
     make_http_app,
     make_oauth_http_app
@@ -70,6 +73,85 @@ class TestCDatabase(BackendTests):
         self.assertEqual([], db._run_sql('INSERT INTO test VALUES (1)'))
         self.assertEqual([('1',)], db._run_sql('SELECT * FROM test'))
 
+    def test_creates_sql_schema_8(self):
+        db = c_backend_wrapper.CDatabase(':memory:')
+        self.assertEqual(
+            [('8',)], db._run_sql(
+                "SELECT value FROM u1db_config WHERE name = 'sql_schema'"))
+
+    def test_refuses_newer_database(self):
+        path = self.createTempDir(prefix='u1db-test-') + '/newer.db'
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=True)
+        db._get_sqlite_handle().execute(
+            "UPDATE u1db_config SET value = '9' WHERE name = 'sql_schema'")
+        db._get_sqlite_handle().commit()
+        db.close()
+        self.assertRaises(RuntimeError, c_backend_wrapper.CDatabase, path)
+
+    def test_upgrades_old_database(self):
+        path = self.createTempDir(prefix='u1db-test-') + '/old.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        db.create_index('by-key', 'key')
+        doc = db.create_doc_from_json(tests.simple_doc)
+        c = db._get_sqlite_handle().cursor()
+        make_old_schema(c, 0)
+        c.execute("INSERT INTO conflicts VALUES (?, ?, ?)",
+                  (doc.doc_id, 'other:1', '{"x": 1}'))
+        db._get_sqlite_handle().commit()
+        db.close()
+        self.db = c_backend_wrapper.CDatabase(path)
+        self.assertEqual(
+            [('8',)], self.db._run_sql(
+                "SELECT value FROM u1db_config WHERE name = 'sql_schema'"))
+        self.assertTrue(self.db.get_doc(doc.doc_id).has_conflicts)
+        self.assertEqual(
+            [(doc.doc_id, '1')], self.db._run_sql(
+                "SELECT doc_id, last_generation FROM document_changes"))
+        self.db.create_doc_from_json(tests.simple_doc)
+        self.assertEqual(2, len(self.db.get_from_index('by-key', 'value')))
+        self.assertEqual(2, self.db._get_generation())
+
+    def test_upgrade_types_index_values(self):
+        path = self.createTempDir(prefix='u1db-test-') + '/old.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        db.create_index('by-n', 'n')
+        db.create_index('by-number', 'number(n, 3)')
+        doc = db.create_doc_from_json('{"n": 12}')
+        c = db._get_sqlite_handle().cursor()
+        make_old_schema(c, 7)
+        # Numbers used to be zero padded text.
+        c.execute("UPDATE document_fields SET value = '012'"
+                  " WHERE field_name = 'number(n, 3)'")
+        db._get_sqlite_handle().commit()
+        db.close()
+        self.db = c_backend_wrapper.CDatabase(path)
+        self.assertEqual(
+            [('n', '12', 'text'), ('number(n, 3)', '12', 'integer')],
+            self.db._run_sql(
+                "SELECT field_name, value, typeof(value)"
+                " FROM document_fields ORDER BY field_name"))
+        for index_name in ['by-number', 'by-n']:
+            self.assertEqual(
+                [doc.doc_id],
+                [d.doc_id for d in self.db.get_from_index(index_name, '12')])
+
+    def test_shares_databases_with_python_backend(self):
+        path = self.createTempDir(prefix='u1db-test-') + '/c.db'
+        self.db = c_backend_wrapper.CDatabase(path)
+        self.db.create_index('by-number', 'number(n, 3)')
+        doc = self.db.create_doc_from_json('{"n": 12}')
+        self.db.close()
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        self.assertEqual(
+            [doc.doc_id],
+            [d.doc_id for d in db.get_from_index('by-number', '12')])
+        self.assertEqual([(12,)], db.get_index_keys('by-number'))
+        db.close()
+        self.db = c_backend_wrapper.CDatabase(path)
+        self.assertEqual(
+            [doc.doc_id],
+            [d.doc_id for d in self.db.get_from_index('by-number', '012')])
+
     def test__get_generation(self):
         db = c_backend_wrapper.CDatabase(':memory:')
         self.assertEqual(0, db._get_generation())
@@ -102,10 +184,88 @@ class TestCDatabase(BackendTests):
         self.db = c_backend_wrapper.CDatabase(':memory:')
         # We add an entry to conflicts, but not to documents, which is an
         # invalid situation
-        self.db._run_sql("INSERT INTO conflicts"
+        self.db._run_sql("INSERT INTO conflicts (doc_id, doc_rev, content)"
                          " VALUES ('doc-id', 'doc-rev', '{}')")
         self.assertRaises(Exception, self.db.get_doc_conflicts, 'doc-id')
 
+    def test_allocate_time_ordered_doc_ids(self):
+        self.db = c_backend_wrapper.CDatabase(':memory:')
+        doc_ids = [self.db._allocate_doc_id() for i in range(100)]
+        self.assertEqual(sorted(doc_ids), doc_ids)
+
+    def test_old_database_keeps_random_ids(self):
+        path = self.createTempDir(prefix='u1db-test-') + '/old.db'
+        self.db = c_backend_wrapper.CDatabase(path)
+        self.db._run_sql("DELETE FROM u1db_config WHERE name = 'id_allocator'")
+        self.db.close()
+        self.db = c_backend_wrapper.CDatabase(path)
+        doc_ids = [self.db._allocate_doc_id() for i in range(100)]
+        self.assertNotEqual(sorted(doc_ids), doc_ids)
+
+    def test_set_id_allocator(self):
+        self.db = c_backend_wrapper.CDatabase(':memory:')
+        self.db.set_id_allocator(lambda: 'f' * 32)
+        self.assertEqual('D-' + 'f' * 32, self.db._allocate_doc_id())
+        self.db.set_id_allocator(ids.random_id)
+        doc_ids = [self.db._allocate_doc_id() for i in range(100)]
+        self.assertNotEqual(sorted(doc_ids), doc_ids)
+        self.db.set_id_allocator(ids.time_ordered_id)
+        doc_ids = [self.db._allocate_doc_id() for i in range(100)]
+        self.assertEqual(sorted(doc_ids), doc_ids)
+
+    def test_set_id_allocator_unicode(self):
+        self.db = c_backend_wrapper.CDatabase(':memory:')
+        self.db.set_id_allocator(lambda: u'e' * 32)
+        self.assertEqual('D-' + 'e' * 32, self.db._allocate_doc_id())
+
+    def test_failing_id_allocator(self):
+        self.db = c_backend_wrapper.CDatabase(':memory:')
+
+        def allocator():
+            raise ValueError('no more ids')
+        self.db.set_id_allocator(allocator)
+        self.assertRaises(RuntimeError, self.db._allocate_doc_id)
+        self.assertRaises(
+            errors.InvalidDocId, self.db.create_doc_from_json,
+            tests.simple_doc)
+        self.db.set_id_allocator(lambda: 'x' * 31)
+        self.assertRaises(RuntimeError, self.db._allocate_doc_id)
+
+    def test_create_docs(self):
+        self.db = c_backend_wrapper.CDatabase(':memory:')
+        docs = self.db.create_docs([{'key': 'value'}, {'key': 'other'}])
+        self.assertEqual(
+            ['{"key": "value"}', '{"key": "other"}'],
+            [doc.get_json() for doc in docs])
+        self.assertEqual(
+            docs, self.db.get_docs([doc.doc_id for doc in docs]))
+
+    def test_create_docs_stores_nothing_on_error(self):
+        self.db = c_backend_wrapper.CDatabase(':memory:')
+        self.db.set_document_size_limit(100)
+        self.assertRaises(
+            errors.DocumentTooBig, self.db.create_docs,
+            [{'key': 'value'}, {'key': 'x' * 100}])
+        self.assertEqual(0, self.db._get_generation())
+
+    def test_put_docs_restores_revs_on_failure(self):
+        self.db = c_backend_wrapper.CDatabase(':memory:')
+        doc = self.db.create_doc_from_json(tests.simple_doc)
+        rev = doc.rev
+        # Make the second document fail with an sqlite error, after the
+        # first one was written.
+        self.db._run_sql(
+            "CREATE TRIGGER refuse BEFORE INSERT ON document"
+            " WHEN NEW.doc_id = 'refused'"
+            " BEGIN SELECT RAISE(ABORT, 'refused'); END")
+        refused = c_backend_wrapper.make_document(
+            'refused', None, tests.simple_doc)
+        doc.set_json(tests.nested_doc)
+        self.assertRaises(RuntimeError, self.db.put_docs, [doc, refused])
+        self.assertEqual(rev, doc.rev)
+        self.assertEqual(None, refused.rev)
+        self.assertEqual(rev, self.db.get_doc(doc.doc_id).rev)
+
     def test_create_index_list(self):
         # We manually poke data into the DB, so that we test just the "get_doc"
         # code, rather than also testing the index management code.
@@ -18,6 +18,7 @@
 
 from u1db import (
     backends,
+    ids,
     tests,
     )
 
@@ -31,3 +32,16 @@ class TestCommonBackendImpl(tests.TestCase):
         self.assertEqual(34, len(doc_id1))
         int(doc_id1[len('D-'):], 16)
         self.assertNotEqual(doc_id1, db._allocate_doc_id())
+
+    def test__allocate_doc_id_time_ordered(self):
+        db = backends.CommonBackend()
+        doc_ids = [db._allocate_doc_id() for i in range(100)]
+        self.assertEqual(sorted(doc_ids), doc_ids)
+
+    def test_set_id_allocator(self):
+        db = backends.CommonBackend()
+        db.set_id_allocator(lambda: 'f' * 32)
+        self.assertEqual('D-' + 'f' * 32, db._allocate_doc_id())
+        self.assertEqual('T-' + 'f' * 32, db._allocate_transaction_id())
+        db.set_id_allocator(ids.random_id)
+        self.assertEqual(34, len(db._allocate_doc_id()))
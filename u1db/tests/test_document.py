@@ -15,9 +15,16 @@
 # along with u1db.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import pickle
+
+import u1db
 from u1db import errors, tests
 
 
+class PickledTask(u1db.Document):
+    """A Document subclass with a __dict__, at module level for pickle."""
+
+
 class TestDocument(tests.TestCase):
 
     scenarios = ([(
@@ -139,6 +146,65 @@ class TestPyDocument(tests.TestCase):
             'c', 'd', '{"key2": "val2", "key1": "val1"}')
         self.assertTrue(doc_a.same_content_as(doc_b))
 
+    def test_get_content_digest(self):
+        doc = self.make_document('a', 'b', '{"key2": [1], "key1": "val1"}')
+        self.assertEqual(
+            u1db.content_digest({'key1': 'val1', 'key2': [1]}),
+            doc.get_content_digest())
+        doc.set_json('{"key": "new"}')
+        self.assertEqual(
+            u1db.content_digest({'key': 'new'}), doc.get_content_digest())
+        doc.make_tombstone()
+        self.assertIs(None, doc.get_content_digest())
+
+    def test_get_content_digest_after_content_change(self):
+        doc = self.make_document('a', 'b', '{}')
+        doc.get_content_digest()
+        doc.content['key'] = 'value'
+        self.assertEqual(
+            u1db.content_digest({'key': 'value'}), doc.get_content_digest())
+
+    def test_get_parsed_json(self):
+        doc = self.make_document('a', 'b', '{"key": "value"}')
+        self.assertEqual({'key': 'value'}, doc.get_parsed_json())
+        doc.set_json('{"key": "new"}')
+        self.assertEqual({'key': 'new'}, doc.get_parsed_json())
+        doc.make_tombstone()
+        self.assertIs(None, doc.get_parsed_json())
+
+    def test_no_instance_dict(self):
+        doc = self.make_document('id', 'rev', '{"content":""}')
+        self.assertFalse(hasattr(doc, '__dict__'))
+        self.assertRaises(AttributeError, setattr, doc, 'other', 1)
+
+    def test_subclass_attributes(self):
+
+        class Task(u1db.Document):
+
+            def _get_title(self):
+                return self.content.get('title')
+        task = Task('id', 'rev', '{"title": "t"}')
+        task.other = 1
+        self.assertEqual(1, task.other)
+        self.assertEqual('t', task._get_title())
+
+    def test_pickle(self):
+        doc = self.make_document('id', 'rev', '{"content": ""}', True)
+        self.assertEqual({'content': ''}, doc.content)
+        for protocol in [0, 2]:
+            unpickled = pickle.loads(pickle.dumps(doc, protocol))
+            self.assertEqual(doc, unpickled)
+            self.assertTrue(unpickled.has_conflicts)
+            self.assertEqual({'content': ''}, unpickled.content)
+
+    def test_pickle_subclass(self):
+        for protocol in [0, 2]:
+            task = PickledTask('id', 'rev', '{"title": "t"}')
+            task.other = 1
+            unpickled = pickle.loads(pickle.dumps(task, protocol))
+            self.assertEqual(task, unpickled)
+            self.assertEqual(1, unpickled.other)
+
     def test_set_json(self):
         doc = self.make_document('id', 'rev', '{"content":""}')
         doc.set_json('{"content": "new"}')
@@ -153,4 +219,46 @@ class TestPyDocument(tests.TestCase):
         self.assertRaises(errors.InvalidJSON, doc.set_json, 'is not json')
 
 
+
+class TestMakeTrustedDocument(tests.TestCase):
+
+    def test_document(self):
+        doc = u1db.make_trusted_document(
+            u1db.Document, 'id', 'rev', '{"key": "value"}')
+        self.assertEqual(u1db.Document('id', 'rev', '{"key": "value"}'), doc)
+        self.assertEqual({'key': 'value'}, doc.content)
+
+    def test_skips_validation(self):
+        doc = u1db.make_trusted_document(
+            u1db.DocumentBase, 'id', 'rev', 'not json')
+        self.assertEqual('not json', doc.get_json())
+
+    def test_tombstone(self):
+        doc = u1db.make_trusted_document(u1db.Document, 'id', 'rev', None)
+        self.assertTrue(doc.is_tombstone())
+
+    def test_subclass_without_init(self):
+
+        class Task(u1db.Document):
+            pass
+        doc = u1db.make_trusted_document(Task, 'id', 'rev', 'not json')
+        self.assertIsInstance(doc, Task)
+        self.assertEqual('not json', doc.get_json())
+
+    def test_factory_with_own_init(self):
+        calls = []
+
+        class CustomDocument(u1db.Document):
+
+            def __init__(self, doc_id, rev, json):
+                calls.append(json)
+                super(CustomDocument, self).__init__(doc_id, rev, json)
+        doc = u1db.make_trusted_document(
+            CustomDocument, 'id', 'rev', '{"key": 1}')
+        self.assertEqual(['{"key": 1}'], calls)
+        self.assertEqual({'key': 1}, doc.content)
+        self.assertRaises(errors.InvalidJSON, u1db.make_trusted_document,
+                          CustomDocument, 'id', 'rev', 'not json')
+
+
 load_tests = tests.load_with_scenarios
@@ -0,0 +1,60 @@
+# Copyright 2011 Canonical Ltd.
+#
+# This file is part of u1db.
+#
+# u1db is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation.
+#
+# u1db is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with u1db.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the id allocators."""
+
+import time
+
+from u1db import (
+    ids,
+    tests,
+    )
+
+
+class TestIds(tests.TestCase):
+
+    def test_random_id(self):
+        new_id = ids.random_id()
+        self.assertEqual(32, len(new_id))
+        int(new_id, 16)
+        self.assertNotEqual(new_id, ids.random_id())
+
+    def test_time_ordered_id(self):
+        new_id = ids.time_ordered_id()
+        self.assertEqual(32, len(new_id))
+        int(new_id, 16)
+        millis = int(new_id[:12], 16)
+        self.assertTrue(abs(time.time() * 1000 - millis) < 60000)
+
+    def test_time_ordered_id_increases(self):
+        new_ids = [ids.time_ordered_id() for i in range(1000)]
+        self.assertEqual(sorted(set(new_ids)), new_ids)
+
+    def test_time_ordered_id_clock_going_back(self):
+        self.patch(ids, '_last_time_ordered', [0, 0])
+        first = ids.time_ordered_id()
+        self.patch(time, 'time', lambda: 1.0)
+        second = ids.time_ordered_id()
+        self.assertTrue(first < second)
+        self.assertEqual(first[:12], second[:12])
+        self.assertEqual(int(first[12:], 16) + 1, int(second[12:], 16))
+
+    def test_time_ordered_id_random_part_overflow(self):
+        self.patch(ids, '_last_time_ordered', [int(time.time() * 1000) + 10,
+                                               2 ** 80 - 1])
+        millis = ids._last_time_ordered[0]
+        self.assertEqual('%012x%020x' % (millis + 1, 0),
+                         ids.time_ordered_id())
@@ -55,7 +55,7 @@ class TestInMemoryIndex(tests.TestCase):
 
     def test_evaluate_json(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
-        self.assertEqual(['value'], idx.evaluate_json(simple_doc))
+        self.assertEqual([('value',)], idx.evaluate_json(simple_doc))
 
     def test_evaluate_json_field_None(self):
         idx = inmemory.InMemoryIndex('idx-name', ['missing'])
@@ -68,8 +68,7 @@ class TestInMemoryIndex(tests.TestCase):
     def test_evaluate_multi_index(self):
         doc = '{"key": "value", "key2": "value2"}'
         idx = inmemory.InMemoryIndex('idx-name', ['key', 'key2'])
-        self.assertEqual(['value\x01value2'],
-                         idx.evaluate_json(doc))
+        self.assertEqual([('value', 'value2')], idx.evaluate_json(doc))
 
     def test_update_ignores_None(self):
         idx = inmemory.InMemoryIndex('idx-name', ['nokey'])
@@ -79,12 +78,12 @@ class TestInMemoryIndex(tests.TestCase):
     def test_update_adds_entry(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
-        self.assertEqual({'value': ['doc-id']}, idx._values)
+        self.assertEqual({('value',): ['doc-id']}, idx._values)
 
     def test_remove_json(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
-        self.assertEqual({'value': ['doc-id']}, idx._values)
+        self.assertEqual({('value',): ['doc-id']}, idx._values)
         idx.remove_json('doc-id', simple_doc)
         self.assertEqual({}, idx._values)
 
@@ -92,20 +91,33 @@ class TestInMemoryIndex(tests.TestCase):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
         idx.add_json('doc2-id', simple_doc)
-        self.assertEqual({'value': ['doc-id', 'doc2-id']}, idx._values)
+        self.assertEqual({('value',): ['doc-id', 'doc2-id']}, idx._values)
         idx.remove_json('doc-id', simple_doc)
-        self.assertEqual({'value': ['doc2-id']}, idx._values)
+        self.assertEqual({('value',): ['doc2-id']}, idx._values)
 
     def test_keys(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
-        self.assertEqual(['value'], idx.keys())
+        self.assertEqual([('value',)], idx.keys())
 
     def test_lookup(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
         self.assertEqual(['doc-id'], idx.lookup(['value']))
 
+    def test_evaluate_numeric_index(self):
+        doc = '{"key": "value", "n": 12, "b": true}'
+        idx = inmemory.InMemoryIndex(
+            'idx-name', ['number(n, 5)', 'n', 'bool(b)', 'is_null(b)'])
+        self.assertEqual([(12, '12', 1, '0')], idx.evaluate_json(doc))
+
+    def test_lookup_numeric(self):
+        idx = inmemory.InMemoryIndex('idx-name', ['number(n, 5)'])
+        idx.add_json('doc-id', '{"n": -12}')
+        self.assertEqual(['doc-id'], idx.lookup(['-12']))
+        self.assertEqual(['doc-id'], idx.lookup(['-0012']))
+        self.assertRaises(errors.InvalidValueForIndex, idx.lookup, ['-1*'])
+
     def test_lookup_multi(self):
         idx = inmemory.InMemoryIndex('idx-name', ['key'])
         idx.add_json('doc-id', simple_doc)
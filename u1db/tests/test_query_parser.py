@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with u1db.  If not, see <http://www.gnu.org/licenses/>.
 
+import pickle
+
 from u1db import (
     errors,
     query_parser,
@@ -299,12 +301,16 @@ class TestNumber(tests.TestCase):
         self.assertNumber([], None)
 
     def test_inner_returns_int(self):
-        """A single integer is converted to zero padded strings."""
-        self.assertNumber(['00009'], 9)
+        """A single integer is kept as is."""
+        self.assertNumber([9], 9)
+
+    def test_inner_returns_negative_int(self):
+        """Negative integers are kept too."""
+        self.assertNumber([-12], -12)
 
     def test_inner_returns_list(self):
-        """Integers are converted to zero padded strings."""
-        self.assertNumber(['00009', '00235'], [9, 235])
+        """Integers are kept, however many digits they have."""
+        self.assertNumber([9, 235, 1234567], [9, 235, 1234567])
 
     def test_inner_returns_string(self):
         """A string is thrown away."""
@@ -320,28 +326,66 @@ class TestNumber(tests.TestCase):
 
     def test_inner_returns_list_containing_strings(self):
         """Strings in a list are thrown away."""
-        self.assertNumber(['00009'], ['foo baz', 9, 'bar sux'])
+        self.assertNumber([9], ['foo baz', 9, 'bar sux'])
 
     def test_inner_returns_list_containing_float(self):
         """Floats in a list are thrown away."""
-        self.assertNumber(
-            ['00083', '00073'], [83, 9.2, 73])
+        self.assertNumber([83, 73], [83, 9.2, 73])
 
     def test_inner_returns_list_containing_bool(self):
         """Booleans in a list are thrown away."""
-        self.assertNumber(
-            ['00083', '00073'], [83, True, 73])
+        self.assertNumber([83, 73], [83, True, 73])
 
     def test_inner_returns_list_containing_list(self):
         """Lists in a list are thrown away."""
         # TODO: Expand sub-lists?
-        self.assertNumber(
-            ['00012', '03333'], [12, [29], 3333])
+        self.assertNumber([12, 3333], [12, [29], 3333])
 
     def test_inner_returns_list_containing_dict(self):
         """Dicts in a list are thrown away."""
-        self.assertNumber(
-            ['00012', '00001'], [12, {54: 89}, 1])
+        self.assertNumber([12, 1], [12, {54: 89}, 1])
+
+
+class TestNumericKeyValue(tests.TestCase):
+
+    def test_integers(self):
+        self.assertEqual(12, query_parser.numeric_key_value('12'))
+        self.assertEqual(12, query_parser.numeric_key_value('00012'))
+        self.assertEqual(-3, query_parser.numeric_key_value('-3'))
+
+    def test_globs_are_kept(self):
+        self.assertEqual('1*', query_parser.numeric_key_value('1*'))
+        self.assertEqual('*', query_parser.numeric_key_value('*'))
+
+    def test_other_values_are_kept(self):
+        self.assertEqual('1.5', query_parser.numeric_key_value('1.5'))
+        self.assertEqual('x', query_parser.numeric_key_value('x'))
+        self.assertEqual(
+            '1' * 20, query_parser.numeric_key_value('1' * 20))
+
+    def test_alternatives(self):
+        self.assertEqual(
+            [1, 'x'], query_parser.numeric_key_value(('1', 'x')))
+
+
+class TestNumericQueryValue(tests.TestCase):
+
+    def test_integers(self):
+        self.assertEqual(12, query_parser.numeric_query_value('00012'))
+        self.assertEqual(-3, query_parser.numeric_query_value('-3'))
+        self.assertEqual('*', query_parser.numeric_query_value('*'))
+
+    def test_other_text_is_invalid(self):
+        for value in ['1*', 'x', '1.5', '']:
+            self.assertRaises(
+                errors.InvalidValueForIndex,
+                query_parser.numeric_query_value, value)
+
+    def test_alternatives(self):
+        self.assertEqual([1, 2], query_parser.numeric_query_value(('1', '2')))
+        self.assertRaises(
+            errors.InvalidValueForIndex,
+            query_parser.numeric_query_value, ('1', 'x'))
 
 
 class TestIsNull(tests.TestCase):
@@ -441,3 +485,140 @@ class TestParser(tests.TestCase):
         self.assertEqual(["a"], getters[0].field)
         self.assertIsInstance(getters[1], query_parser.ExtractField)
         self.assertEqual(["b"], getters[1].field)
+
+
+class TestCompile(tests.TestCase):
+
+    expressions = [
+        'a', 'a.b', 'a.b.c', 'lower(a)', 'lower(split_words(title))',
+        'split_words(lower(a.b))', 'number(a, 5)', 'bool(a)', 'is_null(a.b)',
+        'combine(a.b, c)', 'combine(lower(a), number(c, 3), bool(b))',
+        'combine(a)', 'lower(combine(split_words(a), a.b))',
+        ]
+    docs = [
+        {}, {'a': None}, {'a': 'Foo Bar'}, {'a': 12, 'c': -3}, {'a': True},
+        {'a': {'b': 'X y'}, 'c': 'Z', 'title': 'The  Quick the'},
+        {'a': [{'b': 'p'}, {'b': ['q', 1, {}, [2]]}, 'r', None, {'c': 1}]},
+        {'a': {'b': {'c': [False, 'deep']}}, 'b': False, 'c': [4, 'C']},
+        {'a': [[{'b': 'nested'}]], 'title': ['One two', 3]},
+        {'a': {'b': None}, 'c': {'d': 1}}, {'a': ['U', 'v', 7, True]},
+        ]
+
+    def setUp(self):
+        super(TestCompile, self).setUp()
+        self.parser = query_parser.Parser()
+
+    def test_same_values_as_parsed_getter(self):
+        for expression in self.expressions:
+            getter = self.parser.parse(expression)
+            compiled = self.parser.compile(expression)
+            for doc in self.docs:
+                self.assertEqual(
+                    sorted(getter.get(doc)), sorted(compiled.get(doc)),
+                    '%s on %r' % (expression, doc))
+
+    def test_compile_all(self):
+        getters = self.parser.compile_all(['a', 'lower(b)'])
+        self.assertEqual([['x'], ['y']],
+                         [g.get({'a': 'x', 'b': 'Y'}) for g in getters])
+
+    def test_parse_errors(self):
+        self.assertRaises(errors.IndexDefinitionParseError,
+                          self.parser.compile, 'lower(a')
+
+    def test_unknown_getter_is_called(self):
+
+        class Reverse(query_parser.Transformation):
+
+            def transform(self, values):
+                return list(reversed(values))
+        getter = query_parser.CompiledGetter(
+            'reverse(a)', Reverse(query_parser.ExtractField('a')))
+        self.assertEqual([2, 1], getter.get({'a': [1, 2]}))
+
+    def test_pickle(self):
+        getter = self.parser.compile('lower(a.b)')
+        unpickled = pickle.loads(pickle.dumps(getter))
+        self.assertEqual('lower(a.b)', unpickled.expression)
+        self.assertEqual(['x'], unpickled.get({'a': {'b': 'X'}}))
+
+    def test_plan_same_values_as_parsed_getters(self):
+        plan = self.parser.compile_plan(self.expressions)
+        getters = self.parser.parse_all(self.expressions)
+        for doc in self.docs:
+            for expression, getter, values in zip(
+                    self.expressions, getters, plan.evaluate(doc)):
+                self.assertEqual(sorted(getter.get(doc)), sorted(values),
+                                 '%s on %r' % (expression, doc))
+
+    def test_plan_shares_subexpressions(self):
+        plan = self.parser.compile_plan(
+            ['title', 'lower(title)', 'split_words(title)',
+             'lower(split_words(title))', 'combine(title, lower(title))'])
+        self.assertEqual(1, plan.source.count(".get('title')"))
+        self.assertEqual(2, plan.source.count(".lower()"))
+        self.assertEqual(
+            (['A b'], ['a b'], ['A', 'b'], ['a', 'b'], ['A b', 'a b']),
+            tuple(sorted(values) for values in
+                  plan.evaluate({'title': 'A b'})))
+
+    def test_plan_shares_numbers_of_any_padding(self):
+        plan = self.parser.compile_plan(['number(n, 3)', 'number(n, 4)'])
+        self.assertEqual(1, plan.source.count("isinstance(v, int)"))
+        self.assertEqual(([7], [7]), plan.evaluate({'n': 7}))
+
+    def test_plan_does_not_share_unknown_transformations(self):
+
+        class Prefix(query_parser.Transformation):
+
+            def __init__(self, inner, prefix):
+                super(Prefix, self).__init__(inner)
+                self.prefix = prefix
+
+            def transform(self, values):
+                return [self.prefix + v for v in values]
+        field = query_parser.ExtractField('a')
+        plan = query_parser.CompiledPlan(
+            ['x', 'y'], [Prefix(field, 'x'), Prefix(field, 'y')])
+        self.assertEqual((['xa'], ['ya']), plan.evaluate({'a': 'a'}))
+
+    def test_plan_numeric(self):
+        plan = self.parser.compile_plan(
+            ['a', 'number(a, 3)', 'bool(b)', 'is_null(a)',
+             'combine(lower(a), number(b, 2))'])
+        self.assertEqual([False, True, True, False, True], plan.numeric)
+        self.assertEqual(
+            [False, True, True, False, False], plan.numeric_only)
+
+    def test_plan_pickle(self):
+        plan = self.parser.compile_plan(['a', 'lower(a)'])
+        unpickled = pickle.loads(pickle.dumps(plan))
+        self.assertEqual(['a', 'lower(a)'], unpickled.expressions)
+        self.assertEqual((['X'], ['x']), unpickled.evaluate({'a': 'X'}))
+
+    def test_get_many(self):
+        docs = [('doc-%d' % (i,), doc) for i, doc in enumerate(self.docs)]
+        for expression in self.expressions:
+            getter = self.parser.parse(expression)
+            compiled = self.parser.compile(expression)
+            self.assertEqual(sorted(getter.get_many(docs, 'f')),
+                             sorted(compiled.get_many(docs, 'f')),
+                             expression)
+
+    def test_get_many_rows(self):
+        getter = self.parser.compile('lower(a)')
+        self.assertEqual(
+            [('doc1', 'f', 'x'), ('doc2', 'f', 'y'), ('doc2', 'f', 'z')],
+            getter.get_many([('doc1', {'a': 'X'}), ('doc2', {'a': ['Y', 'Z']}),
+                             ('doc3', {})], 'f'))
+
+    def test_plan_evaluate_many(self):
+        plan = self.parser.compile_plan(self.expressions)
+        docs = [('doc-%d' % (i,), doc) for i, doc in enumerate(self.docs)]
+        expected = []
+        for doc_id, doc in docs:
+            for expression, values in zip(self.expressions,
+                                          plan.evaluate(doc)):
+                expected.extend([(doc_id, expression, value)
+                                 for value in values])
+        self.assertEqual(sorted(expected), sorted(plan.evaluate_many(docs)))
@@ -89,6 +89,17 @@ class TestParsingSyncStream(tests.TestCase):
                           ',\r\n]',
                           lambda doc, gen, trans_id: None)
 
+    def test_invalid_content(self):
+        tgt = http_target.HTTPSyncTarget("http://foo/foo")
+
+        for content in ['"[1, 2]"', '"{\\"a\\": "']:
+            self.assertRaises(errors.InvalidJSON,
+                              tgt._parse_sync_stream,
+                              '[\r\n{},\r\n{"id": "i", "rev": "r", '
+                              '"content": %s, "gen": 3, "trans_id": "T-sid"}'
+                              '\r\n]' % (content,),
+                              lambda doc, gen, trans_id: None)
+
     def test_error_in_stream(self):
         tgt = http_target.HTTPSyncTarget("http://foo/foo")
 
@@ -23,7 +23,9 @@ import threading
 from sqlite3 import dbapi2
 
 from u1db import (
+    content_digest,
     errors,
+    ids,
     tests,
     query_parser,
     )
@@ -35,6 +37,51 @@ simple_doc = '{"key": "value"}'
 nested_doc = '{"key": "value", "sub": {"doc": "underneath"}}'
 
 
+def make_old_schema(c, version):
+    """Undo the schema changes made since an old sql_schema version."""
+    if version < 8:
+        c.execute("DELETE FROM u1db_config WHERE name = 'id_allocator'")
+        rebuild_table(c, 'document_fields', [
+            'doc_id TEXT NOT NULL', 'field_name TEXT NOT NULL',
+            'value TEXT'])
+        c.execute("CREATE INDEX document_fields_field_value_doc_idx"
+                  " ON document_fields(field_name, value, doc_id)")
+        c.execute("CREATE INDEX document_fields_doc_id_idx"
+                  " ON document_fields(doc_id)")
+    if version < 7:
+        c.execute("DROP TABLE retired_replicas")
+    if version < 6:
+        c.execute("DROP TABLE replica_dictionary")
+    if version < 5:
+        columns = ['doc_id TEXT PRIMARY KEY', 'doc_rev TEXT NOT NULL',
+                   'content TEXT']
+        if version >= 2:
+            columns.append('has_conflicts INTEGER NOT NULL DEFAULT 0')
+        rebuild_table(c, 'document', columns)
+        rebuild_table(c, 'conflicts', [
+            'doc_id TEXT', 'doc_rev TEXT', 'content TEXT',
+            'CONSTRAINT conflicts_pkey PRIMARY KEY (doc_id, doc_rev)'])
+    if version < 4:
+        c.execute("DROP TABLE index_builds")
+    if version < 3:
+        c.execute("DROP TABLE document_changes")
+    if version < 1:
+        c.execute("DROP INDEX document_fields_doc_id_idx")
+    c.execute("UPDATE u1db_config SET value = ?"
+              " WHERE name = 'sql_schema'", (str(version),))
+
+
+def rebuild_table(c, table, columns):
+    """Recreate a table with fewer columns, keeping its rows."""
+    names = ', '.join([column.split()[0] for column in columns
+                       if not column.startswith('CONSTRAINT')])
+    c.execute("ALTER TABLE %s RENAME TO old_%s" % (table, table))
+    c.execute("CREATE TABLE %s (%s)" % (table, ', '.join(columns)))
+    c.execute("INSERT INTO %s SELECT %s FROM old_%s"
+              % (table, names, table))
+    c.execute("DROP TABLE old_%s" % (table,))
+
+
 class TestSQLiteDatabase(tests.TestCase):
 
     def test_atomic_initialize(self):
@@ -108,8 +155,9 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
         c = raw_db.cursor()
         c.execute("SELECT * FROM u1db_config")
         config = dict([(r[0], r[1]) for r in c.fetchall()])
-        self.assertEqual({'sql_schema': '0', 'replica_uid': 'test',
-                          'index_storage': 'expand referenced'}, config)
+        self.assertEqual({'sql_schema': '8', 'replica_uid': 'test',
+                          'index_storage': 'expand referenced',
+                          'id_allocator': 'time_ordered'}, config)
 
         # These tables must exist, though we don't care what is in them yet
         c.execute("SELECT * FROM transaction_log")
@@ -224,6 +272,225 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
                           (doc1.doc_id, "key2", "valy"),
                          ], c.fetchall())
 
+    def test_put_docs_updates_fields(self):
+        self.db.create_index('test', 'key1')
+        doc1 = self.db.create_doc_from_json('{"key1": "val1"}')
+        doc1.set_json('{"key1": "valx"}')
+        doc2 = self.db._factory('doc-2', None, '{"key1": "val2"}')
+        doc3 = self.db._factory('doc-2', 'test:1', '{"key1": "valy"}')
+        self.db.put_docs([doc1, doc2, doc3])
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_id, field_name, value FROM document_fields"
+                  " ORDER BY doc_id, field_name, value")
+        self.assertEqual(sorted([(doc1.doc_id, "key1", "valx"),
+                                 ('doc-2', "key1", "valy")]),
+                         c.fetchall())
+
+    def test_get_docs_in_chunks(self):
+        self.db._max_sql_variables = 2
+        docs = [self.db.create_doc_from_json('{}', doc_id='doc-%d' % (i,))
+                for i in range(5)]
+        self.db.delete_doc(docs[1])
+        doc_ids = ['doc-4', 'doc-1', 'missing', 'doc-0', 'doc-3', 'doc-2']
+        self.assertEqual(
+            ['doc-4', 'doc-0', 'doc-3', 'doc-2'],
+            [doc.doc_id for doc in self.db.get_docs(iter(doc_ids))])
+
+    def make_compactable_history(self):
+        doc1 = self.db.create_doc_from_json('{"n": 1}', doc_id='doc1')
+        doc1.set_json('{"n": 2}')
+        self.db.put_doc(doc1)
+        doc2 = self.db.create_doc_from_json('{}', doc_id='doc2')
+        self.db.delete_doc(doc2)
+        self.db.create_doc_from_json('{}', doc_id='doc3')
+        return doc1
+
+    def test_compact(self):
+        doc1 = self.make_compactable_history()
+        self.assertEqual(5, self.db.compact(keep_generations_after=5))
+        self.assertEqual(['doc1', 'doc3'],
+                         [doc_id for doc_id, _ in
+                          self.db._get_transaction_log()])
+        self.assertIs(None, self.db.get_doc('doc2', include_deleted=True))
+        self.assertEqual(doc1, self.db.get_doc('doc1'))
+        self.assertEqual(5, self.db._get_generation())
+        self.assertEqual(
+            ['doc1', 'doc3'],
+            [doc_id for doc_id, _, _ in self.db.whats_changed()[2]])
+
+    def test_compact_keeps_history_after_horizon(self):
+        self.make_compactable_history()
+        self.assertEqual(3, self.db.compact(keep_generations_after=3))
+        self.assertEqual(['doc1', 'doc2', 'doc2', 'doc3'],
+                         [doc_id for doc_id, _ in
+                          self.db._get_transaction_log()])
+        self.assertIsNot(None, self.db.get_doc('doc2', include_deleted=True))
+
+    def test_compact_keeps_conflicted_tombstones(self):
+        self.make_compactable_history()
+        self.db._put_doc_if_newer(
+            self.db._factory('doc2', 'other:1', '{}'), save_conflict=True,
+            replica_uid='other', replica_gen=1, replica_trans_id='T-1')
+        self.db.create_doc_from_json('{}', doc_id='doc4')
+        self.db.compact(keep_generations_after=7)
+        doc2 = self.db.get_doc('doc2', include_deleted=True)
+        self.assertTrue(doc2.has_conflicts)
+
+    def test_compact_horizon_is_capped_at_generation(self):
+        self.make_compactable_history()
+        self.assertEqual(5, self.db.compact(keep_generations_after=10))
+
+    def test_compact_horizon_does_not_go_back(self):
+        self.make_compactable_history()
+        self.db.compact(keep_generations_after=4)
+        self.assertEqual(4, self.db.compact(keep_generations_after=2))
+
+    def test_validate_gen_and_trans_id_after_compact(self):
+        self.make_compactable_history()
+        trans_id = self.db._get_trans_id_for_gen(4)
+        self.db.compact(keep_generations_after=4)
+        self.db.validate_gen_and_trans_id(0, '')
+        self.db.validate_gen_and_trans_id(4, trans_id)
+        self.assertRaises(
+            errors.GenerationCompacted,
+            self.db.validate_gen_and_trans_id, 3, 'T-3')
+
+    def test_set_rev_storage_replica_dictionary(self):
+        doc = self.db.create_doc_from_json('{}', doc_id='doc1')
+        self.db.set_rev_storage('replica dictionary')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT replica_id, replica_uid FROM replica_dictionary")
+        self.assertEqual([(1, 'test')], c.fetchall())
+        c.execute("SELECT doc_rev FROM document")
+        self.assertEqual([('1.1',)], c.fetchall())
+        self.assertEqual(doc, self.db.get_doc('doc1'))
+        self.db.put_doc(doc)
+        self.assertEqual('test:2', self.db.get_doc('doc1').rev)
+        c.execute("SELECT value FROM u1db_config"
+                  " WHERE name = 'rev_storage'")
+        self.assertEqual([('replica dictionary',)], c.fetchall())
+
+    def test_set_rev_storage_converts_conflicts(self):
+        self.db.create_doc_from_json('{}', doc_id='doc1')
+        self.db._put_doc_if_newer(
+            self.db._factory('doc1', 'other:2|alt:1', '{"x": 1}'),
+            save_conflict=True, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-1')
+        self.db.set_rev_storage('replica dictionary')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT replica_id, replica_uid FROM replica_dictionary")
+        self.assertEqual([(1, 'alt'), (2, 'other'), (3, 'test')],
+                         c.fetchall())
+        c.execute("SELECT doc_rev FROM document UNION ALL"
+                  " SELECT doc_rev FROM conflicts")
+        self.assertEqual([('2.2,1.1',), ('3.1',)], c.fetchall())
+        self.assertEqual(['other:2|alt:1', 'test:1'],
+                         [doc.rev for doc in
+                          self.db.get_doc_conflicts('doc1')])
+        self.db.set_rev_storage('text')
+        c.execute("SELECT doc_rev FROM document UNION ALL"
+                  " SELECT doc_rev FROM conflicts")
+        self.assertEqual([('other:2|alt:1',), ('test:1',)], c.fetchall())
+
+    def test_set_rev_storage_unknown(self):
+        self.assertRaises(ValueError, self.db.set_rev_storage, 'binary')
+
+    def test_rev_storage_survives_reopen(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/rev.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        db.set_rev_storage('replica dictionary')
+        doc = db.create_doc_from_json('{}')
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        self.assertEqual(doc, db.get_doc(doc.doc_id))
+
+    def test_replica_dictionary_sees_other_connections(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/rev.db'
+        db1 = sqlite_backend.SQLitePartialExpandDatabase(path)
+        self.addCleanup(db1.close)
+        db1.set_rev_storage('replica dictionary')
+        db2 = sqlite_backend.SQLitePartialExpandDatabase(path)
+        self.addCleanup(db2.close)
+        db2._put_doc_if_newer(
+            db2._factory('doc1', 'other:1', '{}'), save_conflict=False,
+            replica_uid='other', replica_gen=1, replica_trans_id='T-1')
+        self.assertEqual('other:1', db1.get_doc('doc1').rev)
+
+    def test_replica_number_rolled_back(self):
+        self.db.set_rev_storage('replica dictionary')
+        doc = self.db._factory('doc1', 'other:1', '{}')
+        try:
+            with self.db._get_sqlite_handle():
+                self.db._put_and_update_indexes(None, doc)
+                raise errors.U1DBError()
+        except errors.U1DBError:
+            pass
+        self.db._put_doc_if_newer(
+            self.db._factory('doc2', 'alt:1', '{}'), save_conflict=False,
+            replica_uid='alt', replica_gen=1, replica_trans_id='T-1')
+        self.assertEqual('alt:1', self.db.get_doc('doc2').rev)
+        self.db._put_doc_if_newer(
+            doc, save_conflict=False, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-2')
+        self.assertEqual('other:1', self.db.get_doc('doc1').rev)
+        self.assertEqual('alt:1', self.db.get_doc('doc2').rev)
+
+    def test_retired_replicas_survive_reopen(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/retired.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        db._set_replica_uid('test')
+        db.retire_replicas(['other'])
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        self.assertEqual(frozenset(['other']), db._get_retired_replicas())
+        self.assertEqual('retired:1|test:1', db._allocate_doc_rev('other:1'))
+
+    def test_put_doc_stores_content_digest(self):
+        doc = self.db.create_doc_from_json('{"b": 1, "a": [2]}')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT content_digest FROM document")
+        self.assertEqual([(content_digest({'a': [2], 'b': 1}),)],
+                         c.fetchall())
+        self.db.delete_doc(doc)
+        c.execute("SELECT content_digest FROM document")
+        self.assertEqual([(None,)], c.fetchall())
+
+    def test_get_doc_returns_stored_content_digest(self):
+        doc = self.db.create_doc_from_json('{"b": 1, "a": [2]}')
+        stored = self.db.get_doc(doc.doc_id)
+        self.assertEqual(doc.get_content_digest(), stored._content_digest[1])
+        self.assertTrue(stored.same_content_as(doc))
+
+    def test_put_doc_if_newer_stores_conflict_digest(self):
+        doc = self.db.create_doc_from_json('{}', doc_id='doc1')
+        self.db._put_doc_if_newer(
+            self.db._factory('doc1', 'other:1', '{"x": 1}'),
+            save_conflict=True, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-1')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_rev, content_digest FROM conflicts")
+        self.assertEqual([(doc.rev, content_digest({}))], c.fetchall())
+
+    def test_prune_conflicts_without_stored_digest(self):
+        self.db.create_doc_from_json('{}', doc_id='doc1')
+        self.db._put_doc_if_newer(
+            self.db._factory('doc1', 'other:1', '{"x": 1}'),
+            save_conflict=True, replica_uid='other', replica_gen=1,
+            replica_trans_id='T-1')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("UPDATE conflicts SET content_digest = NULL")
+        self.db._put_doc_if_newer(
+            self.db._factory('doc1', 'third:1', '{}'),
+            save_conflict=True, replica_uid='third', replica_gen=1,
+            replica_trans_id='T-2')
+        c.execute("SELECT doc_rev FROM conflicts")
+        self.assertEqual([('other:1',)], c.fetchall())
+
     def test_put_updates_nested_fields(self):
         self.db.create_index('test', 'key', 'sub.doc')
         doc1 = self.db.create_doc_from_json(nested_doc)
@@ -234,6 +501,147 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
                           (doc1.doc_id, "sub.doc", "underneath"),
                          ], c.fetchall())
 
+    def test_put_doc_only_changes_modified_fields(self):
+        self.db.create_index('test', 'key1', 'key2')
+        doc = self.db.create_doc_from_json('{"key1": "val1", "key2": "val2"}')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT rowid FROM document_fields"
+                  " WHERE field_name = 'key1'")
+        key1_rowid = c.fetchall()
+        doc.set_json('{"key1": "val1", "key2": "valx"}')
+        self.db.put_doc(doc)
+        c.execute("SELECT rowid FROM document_fields"
+                  " WHERE field_name = 'key1'")
+        self.assertEqual(key1_rowid, c.fetchall())
+        c.execute("SELECT doc_id, field_name, value FROM document_fields"
+                  " ORDER BY doc_id, field_name, value")
+        self.assertEqual([(doc.doc_id, "key1", "val1"),
+                          (doc.doc_id, "key2", "valx")], c.fetchall())
+
+    def test_put_doc_updates_repeated_and_null_values(self):
+        self.db.create_index('test', 'key')
+        doc = self.db.create_doc_from_json('{"key": ["a", "a", null]}')
+        doc.set_json('{"key": ["a", "b"]}')
+        self.db.put_doc(doc)
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_id, field_name, value FROM document_fields"
+                  " ORDER BY doc_id, field_name, value")
+        self.assertEqual([(doc.doc_id, "key", "a"),
+                          (doc.doc_id, "key", "b")], c.fetchall())
+        self.db.delete_doc(doc)
+        c.execute("SELECT * FROM document_fields")
+        self.assertEqual([], c.fetchall())
+
+    def test__ensure_schema_upgrades_old_schema(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/old.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        c = db._get_sqlite_handle().cursor()
+        make_old_schema(c, 0)
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        c = db._get_sqlite_handle().cursor()
+        self.assertEqual(8, db._get_sql_schema_version(c))
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'index'"
+                  " AND name = 'document_fields_doc_id_idx'")
+        self.assertEqual([('document_fields_doc_id_idx',)], c.fetchall())
+
+    def test__ensure_schema_upgrade_sets_has_conflicts(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/old.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        c = db._get_sqlite_handle().cursor()
+        make_old_schema(c, 1)
+        c.executemany("INSERT INTO document VALUES (?, ?, ?)",
+                      [('doc1', 'test:1', '{}'), ('doc2', 'test:1', '{}')])
+        c.execute("INSERT INTO conflicts VALUES (?, ?, ?)",
+                  ('doc2', 'other:1', '{"x": 1}'))
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        self.assertFalse(db.get_doc('doc1').has_conflicts)
+        self.assertTrue(db.get_doc('doc2').has_conflicts)
+
+    def test__ensure_schema_upgrade_fills_document_changes(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/old.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        db.create_doc_from_json('{}', doc_id='doc1')
+        doc2 = db.create_doc_from_json('{}', doc_id='doc2')
+        db.put_doc(doc2)
+        expected = db.whats_changed()
+        c = db._get_sqlite_handle().cursor()
+        make_old_schema(c, 2)
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        self.assertEqual(expected, db.whats_changed())
+        self.assertEqual(3, db._get_generation())
+
+    def test__ensure_schema_upgrade_fills_content_digests(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/old.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        doc = db.create_doc_from_json('{"b": 1, "a": 2}', doc_id='doc1')
+        c = db._get_sqlite_handle().cursor()
+        make_old_schema(c, 4)
+        c.execute("INSERT INTO conflicts VALUES (?, ?, ?)",
+                  ('doc1', 'other:1', '{"x": 1}'))
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        c = db._get_sqlite_handle().cursor()
+        c.execute("SELECT content_digest FROM document")
+        self.assertEqual([(doc.get_content_digest(),)], c.fetchall())
+        c.execute("SELECT content_digest FROM conflicts")
+        self.assertEqual([(content_digest({'x': 1}),)], c.fetchall())
+
+    def test__ensure_schema_upgrade_types_index_values(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/old.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        db.create_index('by-n', 'n')
+        db.create_index('by-number', 'number(n, 3)')
+        doc = db.create_doc_from_json('{"n": 12}')
+        c = db._get_sqlite_handle().cursor()
+        make_old_schema(c, 7)
+        # Numbers used to be zero padded text.
+        c.execute("UPDATE document_fields SET value = '012'"
+                  " WHERE field_name = 'number(n, 3)'")
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        c = db._get_sqlite_handle().cursor()
+        c.execute("SELECT field_name, value, typeof(value)"
+                  " FROM document_fields ORDER BY field_name")
+        self.assertEqual([('n', '12', 'text'),
+                          ('number(n, 3)', 12, 'integer')], c.fetchall())
+        self.assertEqual([doc], db.get_from_index('by-number', '12'))
+        self.assertEqual([doc], db.get_from_index('by-n', '12'))
+
+    def test_new_database_allocates_time_ordered_ids(self):
+        self.assertEqual(ids.time_ordered_id, self.db._id_allocator)
+
+    def test_old_database_keeps_random_ids(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/old.db'
+        db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        c = db._get_sqlite_handle().cursor()
+        make_old_schema(c, 7)
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        self.assertEqual(ids.random_id, db._id_allocator)
+        db.set_id_allocator(ids.time_ordered_id)
+        self.assertEqual(ids.time_ordered_id, db._id_allocator)
+
     def test__ensure_schema_rollback(self):
         temp_dir = self.createTempDir(prefix='u1db-test-')
         path = temp_dir + '/rollback.db'
@@ -384,6 +792,203 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
                   " ORDER BY doc_id, field_name, value")
         self.assertEqual([(doc1.doc_id, 'key1', 'val1')], c.fetchall())
 
+    def make_docs_for_index_build(self):
+        self.db._index_build_chunk_size = 2
+        for i in range(5):
+            self.db.create_doc_from_json(
+                '{"key1": "val%d"}' % (i,), doc_id='doc-%d' % (i,))
+        self.db.create_doc_from_json('{"key1": "gone"}', doc_id='deleted')
+        self.db.delete_doc(self.db.get_doc('deleted'))
+
+    def test_create_index_reports_progress(self):
+        self.make_docs_for_index_build()
+        progress = []
+        self.db.set_index_build_options(
+            processes=1, progress=lambda *args: progress.append(args))
+        self.db.create_index('idx1', 'key1')
+        self.assertEqual([(2, 5), (4, 5), (5, 5)], progress)
+        self.assertEqual(
+            ['doc-3'],
+            [doc.doc_id for doc in self.db.get_from_index('idx1', 'val3')])
+
+    def test_create_index_in_worker_processes(self):
+        self.make_docs_for_index_build()
+        self.db._parallel_index_build_threshold = 0
+        progress = []
+        self.db.set_index_build_options(
+            processes=2, progress=lambda *args: progress.append(args))
+        self.db.create_index('idx1', 'key1')
+        self.assertEqual([(4, 5), (5, 5)], progress)
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_id, field_name, value FROM document_fields"
+                  " ORDER BY doc_id")
+        self.assertEqual(
+            [('doc-%d' % (i,), 'key1', 'val%d' % (i,)) for i in range(5)],
+            c.fetchall())
+
+    def test_create_index_starts_workers_outside_transaction(self):
+        path = self.createTempDir(prefix='u1db-test-') + '/test.sqlite'
+        self.db = sqlite_backend.SQLitePartialExpandDatabase(path)
+        self.make_docs_for_index_build()
+        self.db._parallel_index_build_threshold = 0
+        self.db.set_index_build_options(processes=2)
+        other = dbapi2.connect(path, timeout=0)
+        self.addCleanup(other.close)
+        make_pool = sqlite_backend.multiprocessing.Pool
+
+        def checked_pool(processes):
+            # Fails with "database is locked" if the write lock is held.
+            other.execute("BEGIN IMMEDIATE")
+            other.rollback()
+            return make_pool(processes)
+        self.patch(sqlite_backend.multiprocessing, 'Pool', checked_pool)
+        self.db.create_index('idx1', 'key1')
+        self.assertEqual(5, self.db.count_from_index('idx1', '*'))
+
+    def test_create_index_failure_rolls_back(self):
+        self.make_docs_for_index_build()
+
+        def progress(done, total):
+            raise RuntimeError('stop')
+        self.db.set_index_build_options(progress=progress)
+        self.assertRaises(RuntimeError, self.db.create_index, 'idx1', 'key1')
+        self.assertEqual([], self.db.list_indexes())
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT * FROM document_fields")
+        self.assertEqual([], c.fetchall())
+        self.db.set_index_build_options()
+        self.db.create_index('idx1', 'key1')
+        self.assertEqual(5, self.db.count_from_index('idx1', '*'))
+
+    def test_create_index_online(self):
+        self.make_docs_for_index_build()
+        self.db._online_index_build_batch_size = 2
+        progress = []
+
+        def write_during_build(done, total):
+            progress.append((done, total))
+            self.assertEqual([], self.db.list_indexes())
+            self.assertRaises(errors.IndexDoesNotExist,
+                              self.db.get_from_index, 'idx1', '*')
+            if done == 2:
+                doc = self.db.get_doc('doc-0')
+                doc.set_json('{"key1": "new"}')
+                self.db.put_doc(doc)
+                # Indexed fields are unchanged, but doc-1 was backfilled.
+                doc = self.db.get_doc('doc-1')
+                doc.set_json('{"key1": "val1", "other": 1}')
+                self.db.put_doc(doc)
+                self.db.delete_doc(self.db.get_doc('doc-2'))
+                self.db.create_doc_from_json('{"key1": "a"}', doc_id='doc-a')
+        self.db.set_index_build_options(progress=write_during_build)
+        self.db.create_index_online('idx1', 'key1')
+        self.assertEqual([(2, 5), (4, 5), (5, 5)], progress)
+        self.assertEqual([('idx1', ['key1'])], self.db.list_indexes())
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_id, value FROM document_fields"
+                  " ORDER BY doc_id")
+        self.assertEqual([('doc-0', 'new'), ('doc-1', 'val1'),
+                          ('doc-3', 'val3'), ('doc-4', 'val4'),
+                          ('doc-a', 'a')], c.fetchall())
+        c.execute("SELECT * FROM index_builds")
+        self.assertEqual([], c.fetchall())
+
+    def test_create_index_online_existing_index(self):
+        self.db.create_index('idx1', 'key1')
+        self.db.create_index_online('idx1', 'key1')
+        self.assertRaises(errors.IndexNameTakenError,
+                          self.db.create_index_online, 'idx1', 'key2')
+        self.db.create_index_online('idx2', 'key1')
+        self.assertEqual([('idx1', ['key1']), ('idx2', ['key1'])],
+                         self.db.list_indexes())
+
+    def test_create_index_online_restarts_build(self):
+        self.make_docs_for_index_build()
+
+        def progress(done, total):
+            raise RuntimeError('stop')
+        self.db.set_index_build_options(progress=progress)
+        self.db._online_index_build_batch_size = 2
+        self.assertRaises(RuntimeError, self.db.create_index_online,
+                          'idx1', 'key1')
+        self.assertEqual([], self.db.list_indexes())
+        self.assertRaises(errors.IndexBuildInProgress,
+                          self.db.create_index, 'idx2', 'key1')
+        self.assertRaises(errors.IndexBuildInProgress,
+                          self.db.create_index_online, 'idx2', 'key1')
+        self.assertRaises(errors.IndexNameTakenError,
+                          self.db.create_index_online, 'idx1', 'key2')
+        self.db.set_index_build_options()
+        self.db.create_index_online('idx1', 'key1')
+        self.assertEqual(5, self.db.count_from_index('idx1', '*'))
+
+    def test_create_index_online_after_shared_index_deleted(self):
+        docs = [self.db.create_doc_from_json(
+            '{"x": "a%d", "y": "b"}' % (i,)) for i in range(5)]
+        self.db.create_index('G', 'x')
+        self.db._online_index_build_batch_size = 2
+
+        def delete_shared_index(done, total):
+            if done == 2:
+                self.db.delete_index('G')
+                docs[0].set_json('{"x": "changed", "y": "b"}')
+                self.db.put_doc(docs[0])
+        self.db.set_index_build_options(progress=delete_shared_index)
+        self.db.create_index_online('B', 'x', 'y')
+        self.assertEqual([], self.db.get_from_index('B', 'a0', '*'))
+        self.assertEqual(
+            [docs[0]], self.db.get_from_index('B', 'changed', '*'))
+        self.assertEqual(5, self.db.count_from_index('B', '*', '*'))
+        docs[1].set_json('{"x": "again", "y": "b"}')
+        self.db.put_doc(docs[1])
+        self.assertEqual([docs[1]], self.db.get_from_index('B', 'again', '*'))
+
+    def test_delete_index_cancels_online_build(self):
+        self.make_docs_for_index_build()
+
+        def cancel(done, total):
+            self.db.delete_index('idx1')
+        self.db.set_index_build_options(progress=cancel)
+        self.db._online_index_build_batch_size = 2
+        self.assertRaises(errors.IndexDoesNotExist,
+                          self.db.create_index_online, 'idx1', 'key1')
+        self.assertEqual([], self.db.list_indexes())
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT * FROM document_fields")
+        self.assertEqual([], c.fetchall())
+
+    def test__get_index_getters_cached(self):
+        self.db.create_index('idx1', 'key1')
+        getters = self.db._get_index_getters()
+        self.assertEqual(['key1'], getters.keys())
+        self.db.create_doc_from_json('{"key1": "val1"}')
+        self.assertIs(getters, self.db._get_index_getters())
+
+    def test__get_index_getters_invalidated_by_index_changes(self):
+        self.db.create_index('idx1', 'key1')
+        getters = self.db._get_index_getters()
+        self.db.create_index('idx2', 'key2')
+        self.assertEqual(set(['key1', 'key2']),
+                         set(self.db._get_index_getters()))
+        self.assertIsNot(getters, self.db._get_index_getters())
+        self.db.delete_index('idx1')
+        self.assertEqual(['key2'], self.db._get_index_getters().keys())
+
+    def test_index_created_by_other_connection(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/index.db'
+        db1 = sqlite_backend.SQLitePartialExpandDatabase(path)
+        self.addCleanup(db1.close)
+        db2 = sqlite_backend.SQLitePartialExpandDatabase(path)
+        self.addCleanup(db2.close)
+        db1.create_doc_from_json('{"key1": "val1"}')
+        db2.create_index('idx1', 'key1')
+        doc = db1.create_doc_from_json('{"key1": "val2"}')
+        self.assertEqual(set(['key1']), db1._get_indexed_fields())
+        self.assertEqual([doc], db1.get_from_index('idx1', 'val2'))
+        db2.delete_index('idx1')
+        self.assertEqual(set(), db1._get_indexed_fields())
+
     def assertFormatQueryEquals(self, exp_statement, exp_args, definition,
                                 values):
         statement, args = self.db._format_query(definition, values)
@@ -392,36 +997,33 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
 
     def test__format_query(self):
         self.assertFormatQueryEquals(
-            "SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM "
-            "document d, document_fields d0 LEFT OUTER JOIN conflicts c ON "
-            "c.doc_id = d.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name "
-            "= ? AND d0.value = ? GROUP BY d.doc_id, d.doc_rev, d.content "
-            "ORDER BY d0.value;", ["key1", "a"],
+            "SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM "
+            "document d, document_fields d0 WHERE d.doc_id = d0.doc_id AND "
+            "d0.field_name = ? AND d0.value = ? GROUP BY d.doc_id ORDER BY "
+            "d0.value;", ["key1", "a"],
             ["key1"], ["a"])
 
     def test__format_query2(self):
         self.assertFormatQueryEquals(
-            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
+            'SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM '
             'document d, document_fields d0, document_fields d1, '
-            'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
-            'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
-            'd0.value = ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
-            'd1.value = ? AND d.doc_id = d2.doc_id AND d2.field_name = ? AND '
-            'd2.value = ? GROUP BY d.doc_id, d.doc_rev, d.content ORDER BY '
-            'd0.value, d1.value, d2.value;',
+            'document_fields d2 WHERE d.doc_id = d0.doc_id AND d0.field_name '
+            '= ? AND d0.value = ? AND d.doc_id = d1.doc_id AND d1.field_name '
+            '= ? AND d1.value = ? AND d.doc_id = d2.doc_id AND d2.field_name '
+            '= ? AND d2.value = ? GROUP BY d.doc_id ORDER BY d0.value, '
+            'd1.value, d2.value;',
             ["key1", "a", "key2", "b", "key3", "c"],
             ["key1", "key2", "key3"], ["a", "b", "c"])
 
     def test__format_query_wildcard(self):
         self.assertFormatQueryEquals(
-            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
+            'SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM '
             'document d, document_fields d0, document_fields d1, '
-            'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
-            'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
-            'd0.value = ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
-            'd1.value GLOB ? AND d.doc_id = d2.doc_id AND d2.field_name = ? '
-            'AND d2.value NOT NULL GROUP BY d.doc_id, d.doc_rev, d.content '
-            'ORDER BY d0.value, d1.value, d2.value;',
+            'document_fields d2 WHERE d.doc_id = d0.doc_id AND d0.field_name '
+            '= ? AND d0.value = ? AND d.doc_id = d1.doc_id AND d1.field_name '
+            '= ? AND d1.value GLOB ? AND d.doc_id = d2.doc_id AND '
+            'd2.field_name = ? AND d2.value NOT NULL GROUP BY d.doc_id ORDER '
+            'BY d0.value, d1.value, d2.value;',
             ["key1", "a", "key2", "b*", "key3"], ["key1", "key2", "key3"],
             ["a", "b*", "*"])
 
@@ -434,60 +1036,354 @@ class TestSQLitePartialExpandDatabase(tests.TestCase):
 
     def test__format_range_query(self):
         self.assertFormatRangeQueryEquals(
-            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
+            'SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM '
             'document d, document_fields d0, document_fields d1, '
-            'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
-            'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
-            'd0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
-            'd1.value >= ? AND d.doc_id = d2.doc_id AND d2.field_name = ? AND '
-            'd2.value >= ? AND d.doc_id = d0.doc_id AND d0.field_name = ? AND '
-            'd0.value <= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
-            'd1.value <= ? AND d.doc_id = d2.doc_id AND d2.field_name = ? AND '
-            'd2.value <= ? GROUP BY d.doc_id, d.doc_rev, d.content ORDER BY '
-            'd0.value, d1.value, d2.value;',
+            'document_fields d2 WHERE d.doc_id = d0.doc_id AND d0.field_name '
+            '= ? AND d0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name '
+            '= ? AND d1.value >= ? AND d.doc_id = d2.doc_id AND d2.field_name '
+            '= ? AND d2.value >= ? AND d.doc_id = d0.doc_id AND d0.field_name '
+            '= ? AND d0.value <= ? AND d.doc_id = d1.doc_id AND d1.field_name '
+            '= ? AND d1.value <= ? AND d.doc_id = d2.doc_id AND d2.field_name '
+            '= ? AND d2.value <= ? GROUP BY d.doc_id ORDER BY d0.value, '
+            'd1.value, d2.value;',
             ['key1', 'a', 'key2', 'b', 'key3', 'c', 'key1', 'p', 'key2', 'q',
              'key3', 'r'],
             ["key1", "key2", "key3"], ["a", "b", "c"], ["p", "q", "r"])
 
     def test__format_range_query_no_start(self):
         self.assertFormatRangeQueryEquals(
-            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
+            'SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM '
             'document d, document_fields d0, document_fields d1, '
-            'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
-            'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
-            'd0.value <= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
-            'd1.value <= ? AND d.doc_id = d2.doc_id AND d2.field_name = ? AND '
-            'd2.value <= ? GROUP BY d.doc_id, d.doc_rev, d.content ORDER BY '
-            'd0.value, d1.value, d2.value;',
+            'document_fields d2 WHERE d.doc_id = d0.doc_id AND d0.field_name '
+            '= ? AND d0.value <= ? AND d.doc_id = d1.doc_id AND d1.field_name '
+            '= ? AND d1.value <= ? AND d.doc_id = d2.doc_id AND d2.field_name '
+            '= ? AND d2.value <= ? GROUP BY d.doc_id ORDER BY d0.value, '
+            'd1.value, d2.value;',
             ['key1', 'a', 'key2', 'b', 'key3', 'c'],
             ["key1", "key2", "key3"], None, ["a", "b", "c"])
 
     def test__format_range_query_no_end(self):
         self.assertFormatRangeQueryEquals(
-            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
+            'SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM '
             'document d, document_fields d0, document_fields d1, '
-            'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
-            'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
-            'd0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
-            'd1.value >= ? AND d.doc_id = d2.doc_id AND d2.field_name = ? AND '
-            'd2.value >= ? GROUP BY d.doc_id, d.doc_rev, d.content ORDER BY '
-            'd0.value, d1.value, d2.value;',
+            'document_fields d2 WHERE d.doc_id = d0.doc_id AND d0.field_name '
+            '= ? AND d0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name '
+            '= ? AND d1.value >= ? AND d.doc_id = d2.doc_id AND d2.field_name '
+            '= ? AND d2.value >= ? GROUP BY d.doc_id ORDER BY d0.value, '
+            'd1.value, d2.value;',
             ['key1', 'a', 'key2', 'b', 'key3', 'c'],
             ["key1", "key2", "key3"], ["a", "b", "c"], None)
 
     def test__format_range_query_wildcard(self):
         self.assertFormatRangeQueryEquals(
-            'SELECT d.doc_id, d.doc_rev, d.content, count(c.doc_rev) FROM '
+            'SELECT d.doc_id, d.doc_rev, d.content, d.has_conflicts FROM '
             'document d, document_fields d0, document_fields d1, '
-            'document_fields d2 LEFT OUTER JOIN conflicts c ON c.doc_id = '
-            'd.doc_id WHERE d.doc_id = d0.doc_id AND d0.field_name = ? AND '
-            'd0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? AND '
-            'd1.value >= ? AND d.doc_id = d2.doc_id AND d2.field_name = ? AND '
-            'd2.value NOT NULL AND d.doc_id = d0.doc_id AND d0.field_name = ? '
-            'AND d0.value <= ? AND d.doc_id = d1.doc_id AND d1.field_name = ? '
-            'AND (d1.value < ? OR d1.value GLOB ?) AND d.doc_id = d2.doc_id '
-            'AND d2.field_name = ? AND d2.value NOT NULL GROUP BY d.doc_id, '
-            'd.doc_rev, d.content ORDER BY d0.value, d1.value, d2.value;',
+            'document_fields d2 WHERE d.doc_id = d0.doc_id AND d0.field_name '
+            '= ? AND d0.value >= ? AND d.doc_id = d1.doc_id AND d1.field_name '
+            '= ? AND d1.value >= ? AND d.doc_id = d2.doc_id AND d2.field_name '
+            '= ? AND d2.value NOT NULL AND d.doc_id = d0.doc_id AND '
+            'd0.field_name = ? AND d0.value <= ? AND d.doc_id = d1.doc_id AND '
+            'd1.field_name = ? AND (d1.value < ? OR d1.value GLOB ?) AND '
+            'd.doc_id = d2.doc_id AND d2.field_name = ? AND d2.value NOT NULL '
+            'GROUP BY d.doc_id ORDER BY d0.value, d1.value, d2.value;',
             ['key1', 'a', 'key2', 'b', 'key3', 'key1', 'p', 'key2', 'q', 'q*',
              'key3'],
             ["key1", "key2", "key3"], ["a", "b*", "*"], ["p", "q*", "*"])
+
+
+class TestSQLiteCompositeKeyDatabase(tests.TestCase):
+
+    def setUp(self):
+        super(TestSQLiteCompositeKeyDatabase, self).setUp()
+        self.db = sqlite_backend.SQLiteCompositeKeyDatabase(':memory:')
+        self.db._set_replica_uid('test')
+
+    def test_open_database_with_backend_cls(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/composite.db'
+        db = sqlite_backend.SQLiteDatabase.open_database(
+            path, create=True,
+            backend_cls=sqlite_backend.SQLiteCompositeKeyDatabase)
+        db.close()
+        db2 = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db2.close)
+        self.assertIsInstance(db2, sqlite_backend.SQLiteCompositeKeyDatabase)
+
+    def test_index_keys_rows(self):
+        self.db.create_index('test-idx', 'key', 'sub')
+        doc = self.db.create_doc_from_json(
+            '{"key": ["a", "b"], "sub": "x"}')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT index_name, key, doc_id FROM index_keys"
+                  " ORDER BY key")
+        self.assertEqual([('test-idx', 'a\x00x\x00', doc.doc_id),
+                          ('test-idx', 'b\x00x\x00', doc.doc_id)],
+                         [(n, str(k), d) for n, k, d in c.fetchall()])
+        c.execute("SELECT * FROM document_fields")
+        self.assertEqual([], c.fetchall())
+
+    def test_create_index_in_worker_processes(self):
+        self.db._index_build_chunk_size = 2
+        self.db._parallel_index_build_threshold = 0
+        self.db.set_index_build_options(processes=2)
+        docs = [self.db.create_doc_from_json('{"key": ["x%d", "y"]}' % (i,))
+                for i in range(5)]
+        self.db.create_index('test-idx', 'key')
+        self.assertEqual([docs[3]], self.db.get_from_index('test-idx', 'x3'))
+        self.assertEqual(5, self.db.count_from_index('test-idx', 'y'))
+
+    def test_create_index_online(self):
+        docs = [self.db.create_doc_from_json('{"key": ["x%d", "y"]}' % (i,))
+                for i in range(5)]
+        self.db._online_index_build_batch_size = 2
+
+        def write_during_build(done, total):
+            if done == 2:
+                self.assertEqual([], self.db.list_indexes())
+                docs[0].set_json('{"key": "z"}')
+                self.db.put_doc(docs[0])
+        self.db.set_index_build_options(progress=write_during_build)
+        self.db.create_index_online('test-idx', 'key')
+        self.assertEqual([('test-idx', ['key'])], self.db.list_indexes())
+        self.assertEqual([docs[0]], self.db.get_from_index('test-idx', 'z'))
+        self.assertEqual(4, self.db.count_from_index('test-idx', 'y'))
+
+    def test_update_and_delete_doc_index_keys(self):
+        self.db.create_index('test-idx', 'key')
+        doc = self.db.create_doc_from_json('{"key": ["a", "b"]}')
+        doc.set_json('{"key": ["b", "c"]}')
+        self.db.put_doc(doc)
+        self.assertEqual([(u'b',), (u'c',)],
+                         self.db.get_index_keys('test-idx'))
+        self.db.delete_doc(doc)
+        self.assertEqual([], self.db.get_index_keys('test-idx'))
+
+    def test_delete_index_removes_keys(self):
+        self.db.create_index('test-idx', 'key')
+        self.db.create_doc_from_json('{"key": "a"}')
+        self.db.delete_index('test-idx')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT * FROM index_keys")
+        self.assertEqual([], c.fetchall())
+
+    def test_keys_sort_like_tuples(self):
+        self.db.create_index('test-idx', 'k1', 'k2')
+        doc1 = self.db.create_doc_from_json('{"k1": "a", "k2": "z"}')
+        doc2 = self.db.create_doc_from_json('{"k1": "a\\u0000", "k2": "a"}')
+        doc3 = self.db.create_doc_from_json('{"k1": "a\\u0001", "k2": "a"}')
+        doc4 = self.db.create_doc_from_json('{"k1": "ab", "k2": "a"}')
+        self.assertEqual(
+            [doc1, doc2, doc3, doc4],
+            self.db.get_range_from_index('test-idx', ('a', '*')))
+        self.assertEqual(
+            [(u'a', u'z'), (u'a\x00', u'a'), (u'a\x01', u'a'), (u'ab', u'a')],
+            self.db.get_index_keys('test-idx'))
+
+    def test_get_from_index_prefix_does_not_cross_columns(self):
+        self.db.create_index('test-idx', 'k1', 'k2')
+        doc1 = self.db.create_doc_from_json('{"k1": "ab", "k2": "c"}')
+        self.db.create_doc_from_json('{"k1": "a", "k2": "bc"}')
+        self.assertEqual(
+            [doc1], self.db.get_from_index('test-idx', 'ab*', '*'))
+
+    def test_numeric_keys_sort_as_numbers(self):
+        self.db.create_index('test-idx', 'number(n, 2)', 'key')
+        doc1 = self.db.create_doc_from_json('{"n": -20, "key": "a"}')
+        doc2 = self.db.create_doc_from_json('{"n": 3, "key": "a"}')
+        doc3 = self.db.create_doc_from_json('{"n": 100, "key": "a"}')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT key FROM index_keys WHERE doc_id = ?",
+                  (doc2.doc_id,))
+        self.assertEqual('\x01\x03%016x\x00a\x00' % (2 ** 63 + 3,),
+                         str(c.fetchone()[0]))
+        self.assertEqual([(-20, u'a'), (3, u'a'), (100, u'a')],
+                         self.db.get_index_keys('test-idx'))
+        self.assertEqual(
+            [doc1, doc2],
+            self.db.get_range_from_index(
+                'test-idx', ('-20', 'a'), ('3', '*')))
+        self.assertEqual(
+            [doc3], self.db.get_from_index('test-idx', '100', '*'))
+
+    def test_upgrade_encodes_numbers_again(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/composite.db'
+        db = sqlite_backend.SQLiteDatabase.open_database(
+            path, create=True,
+            backend_cls=sqlite_backend.SQLiteCompositeKeyDatabase)
+        db.create_index('by-number', 'number(n, 3)', 'key')
+        db.create_index('by-key', 'key')
+        doc = db.create_doc_from_json('{"n": 12, "key": "012"}')
+        c = db._get_sqlite_handle().cursor()
+        # Numbers used to be encoded as zero padded text.
+        c.execute("UPDATE index_keys SET key = ?"
+                  " WHERE index_name = 'by-number'",
+                  (buffer('012\x00012\x00'),))
+        c.execute("UPDATE u1db_config SET value = '7'"
+                  " WHERE name = 'sql_schema'")
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        self.assertEqual([(12, u'012')], db.get_index_keys('by-number'))
+        self.assertEqual([(u'012',)], db.get_index_keys('by-key'))
+        self.assertEqual([doc], db.get_from_index('by-number', '12', '012'))
+
+
+class TestSQLiteSurrogateKeyDatabase(tests.TestCase):
+
+    def setUp(self):
+        super(TestSQLiteSurrogateKeyDatabase, self).setUp()
+        self.db = sqlite_backend.SQLiteSurrogateKeyDatabase(':memory:')
+        self.db._set_replica_uid('test')
+
+    def get_value_rows(self):
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT d.doc_id, f.field, v.value"
+                  " FROM document_values v, document d, index_fields f"
+                  " WHERE v.doc_key = d.doc_key AND v.field_id = f.field_id"
+                  " ORDER BY d.doc_id, f.field, v.value")
+        return c.fetchall()
+
+    def test_open_database_with_backend_cls(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/surrogate.db'
+        db = sqlite_backend.SQLiteDatabase.open_database(
+            path, create=True,
+            backend_cls=sqlite_backend.SQLiteSurrogateKeyDatabase)
+        db.close()
+        db2 = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db2.close)
+        self.assertIsInstance(db2, sqlite_backend.SQLiteSurrogateKeyDatabase)
+
+    def test_document_values_rows(self):
+        self.db.create_index('test-idx', 'key', 'sub')
+        doc = self.db.create_doc_from_json('{"key": ["a", "b"], "sub": "x"}')
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT doc_key FROM document WHERE doc_id = ?",
+                  (doc.doc_id,))
+        doc_key, = c.fetchone()
+        c.execute("SELECT field, field_id FROM index_fields")
+        field_ids = dict(c.fetchall())
+        self.assertEqual(['key', 'sub'], sorted(field_ids))
+        c.execute("SELECT doc_key, field_id, value FROM document_values"
+                  " ORDER BY value")
+        self.assertEqual([(doc_key, field_ids['key'], 'a'),
+                          (doc_key, field_ids['key'], 'b'),
+                          (doc_key, field_ids['sub'], 'x')], c.fetchall())
+        c.execute("SELECT * FROM document_fields")
+        self.assertEqual([], c.fetchall())
+
+    def test_update_and_delete_doc(self):
+        self.db.create_index('test-idx', 'key')
+        doc = self.db.create_doc_from_json('{"key": ["a", "b"]}')
+        doc.set_json('{"key": ["b", "c"]}')
+        self.db.put_doc(doc)
+        self.assertEqual([(doc.doc_id, 'key', 'b'), (doc.doc_id, 'key', 'c')],
+                         self.get_value_rows())
+        self.db.delete_doc(doc)
+        self.assertEqual([], self.get_value_rows())
+
+    def test_doc_keys_survive_vacuum(self):
+        self.db.create_index('test-idx', 'key')
+        docs = [self.db.create_doc_from_json('{"key": "%d"}' % (i,))
+                for i in range(3)]
+        self.db.delete_doc(docs[0])
+        self.db.compact(self.db._get_generation())
+        self.db._get_sqlite_handle().cursor().execute("VACUUM")
+        self.assertEqual([docs[2]], self.db.get_from_index('test-idx', '2'))
+        self.assertEqual([docs[1].doc_id, docs[2].doc_id],
+                         self.db.get_doc_ids_from_index('test-idx', '*'))
+
+    def test_create_index_in_worker_processes(self):
+        self.db._index_build_chunk_size = 2
+        self.db._parallel_index_build_threshold = 0
+        self.db.set_index_build_options(processes=2)
+        docs = [self.db.create_doc_from_json('{"key": ["x%d", "y"]}' % (i,))
+                for i in range(5)]
+        self.db.create_index('test-idx', 'key')
+        self.assertEqual([docs[3]], self.db.get_from_index('test-idx', 'x3'))
+        self.assertEqual(5, self.db.count_from_index('test-idx', 'y'))
+
+    def test_create_index_online_after_shared_index_deleted(self):
+        docs = [self.db.create_doc_from_json(
+            '{"x": "a%d", "y": "b"}' % (i,)) for i in range(5)]
+        self.db.create_index('G', 'x')
+        self.db._online_index_build_batch_size = 2
+
+        def delete_shared_index(done, total):
+            if done == 2:
+                self.db.delete_index('G')
+                docs[0].set_json('{"x": "changed", "y": "b"}')
+                self.db.put_doc(docs[0])
+        self.db.set_index_build_options(progress=delete_shared_index)
+        self.db.create_index_online('B', 'x', 'y')
+        self.assertEqual([], self.db.get_from_index('B', 'a0', '*'))
+        self.assertEqual(
+            [docs[0]], self.db.get_from_index('B', 'changed', '*'))
+        self.assertEqual(5, self.db.count_from_index('B', '*', '*'))
+        docs[1].set_json('{"x": "again", "y": "b"}')
+        self.db.put_doc(docs[1])
+        self.assertEqual([docs[1]], self.db.get_from_index('B', 'again', '*'))
+
+    def test_create_index_online(self):
+        docs = [self.db.create_doc_from_json('{"key": ["x%d", "y"]}' % (i,))
+                for i in range(5)]
+        self.db._online_index_build_batch_size = 2
+
+        def write_during_build(done, total):
+            if done == 2:
+                self.assertEqual([], self.db.list_indexes())
+                docs[0].set_json('{"key": "z"}')
+                self.db.put_doc(docs[0])
+        self.db.set_index_build_options(progress=write_during_build)
+        self.db.create_index_online('test-idx', 'key')
+        self.assertEqual([('test-idx', ['key'])], self.db.list_indexes())
+        self.assertEqual([docs[0]], self.db.get_from_index('test-idx', 'z'))
+        self.assertEqual(4, self.db.count_from_index('test-idx', 'y'))
+
+    def test_delete_index_removes_unused_fields(self):
+        self.db.create_index('idx-1', 'key', 'sub')
+        self.db.create_index('idx-2', 'key')
+        doc = self.db.create_doc_from_json('{"key": "a", "sub": "x"}')
+        self.db.delete_index('idx-1')
+        self.assertEqual([(doc.doc_id, 'key', 'a')], self.get_value_rows())
+        c = self.db._get_sqlite_handle().cursor()
+        c.execute("SELECT field FROM index_fields")
+        self.assertEqual([('key',)], c.fetchall())
+        self.assertEqual([doc], self.db.get_from_index('idx-2', 'a'))
+
+    def test_upgrade_types_values(self):
+        temp_dir = self.createTempDir(prefix='u1db-test-')
+        path = temp_dir + '/surrogate.db'
+        db = sqlite_backend.SQLiteDatabase.open_database(
+            path, create=True,
+            backend_cls=sqlite_backend.SQLiteSurrogateKeyDatabase)
+        db.create_index('by-number', 'number(n, 3)')
+        db.create_index('by-n', 'n')
+        doc = db.create_doc_from_json('{"n": 12}')
+        c = db._get_sqlite_handle().cursor()
+        # document_values used to have a TEXT value, holding zero padded
+        # numbers.
+        c.execute("ALTER TABLE document_values RENAME TO old_values")
+        c.execute("CREATE TABLE document_values (doc_key INTEGER NOT NULL,"
+                  " field_id INTEGER NOT NULL, value TEXT)")
+        c.execute("INSERT INTO document_values SELECT * FROM old_values")
+        c.execute("DROP TABLE old_values")
+        c.execute("UPDATE document_values SET value = '012' WHERE field_id ="
+                  " (SELECT field_id FROM index_fields"
+                  " WHERE field = 'number(n, 3)')")
+        c.execute("UPDATE u1db_config SET value = '7'"
+                  " WHERE name = 'sql_schema'")
+        db._get_sqlite_handle().commit()
+        db.close()
+        db = sqlite_backend.SQLiteDatabase.open_database(path, create=False)
+        self.addCleanup(db.close)
+        c = db._get_sqlite_handle().cursor()
+        c.execute("SELECT f.field, v.value, typeof(v.value)"
+                  " FROM document_values v, index_fields f"
+                  " WHERE v.field_id = f.field_id ORDER BY f.field")
+        self.assertEqual([('n', '12', 'text'),
+                          ('number(n, 3)', 12, 'integer')], c.fetchall())
+        self.assertEqual([doc], db.get_from_index('by-number', '12'))
+        self.assertEqual([doc], db.get_from_index('by-n', '12'))
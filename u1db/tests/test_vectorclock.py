@@ -16,6 +16,8 @@
 
 """VectorClockRev helper class tests."""
 
+import pickle
+
 from u1db import tests, vectorclock
 
 try:
@@ -118,4 +120,80 @@ class TestVectorClockRev(tests.TestCase):
         self.assertMaximize('a:1|c:2|e:3', 'b:3|d:4|f:5',
                             'a:1|b:3|c:2|d:4|e:3|f:5')
 
+
+class TestPyVectorClockRev(tests.TestCase):
+
+    def test_no_instance_dict(self):
+        vcr = vectorclock.VectorClockRev('x:1')
+        self.assertFalse(hasattr(vcr, '__dict__'))
+
+    def test_as_str_sorts_replicas(self):
+        vcr = vectorclock.VectorClockRev('y:2|x:1')
+        self.assertEqual('x:1|y:2', vcr.as_str())
+
+    def test_as_str_after_changes(self):
+        vcr = vectorclock.VectorClockRev('y:2')
+        self.assertEqual('y:2', vcr.as_str())
+        vcr.increment('x')
+        self.assertEqual('x:1|y:2', vcr.as_str())
+        vcr.maximize(vectorclock.VectorClockRev('z:3'))
+        self.assertEqual('x:1|y:2|z:3', vcr.as_str())
+
+    def test_retire(self):
+        vcr = vectorclock.VectorClockRev('a:2|b:3|x:1')
+        vcr.retire(set(['a', 'b', 'c']))
+        self.assertEqual('retired:5|x:1', vcr.as_str())
+        vcr = vectorclock.VectorClockRev('c:1|retired:5|x:1')
+        vcr.retire(set(['c']))
+        self.assertEqual('retired:6|x:1', vcr.as_str())
+
+    def test_pickle(self):
+        vcr = vectorclock.VectorClockRev('a:2|x:1')
+        for protocol in [0, 2]:
+            unpickled = pickle.loads(pickle.dumps(vcr, protocol))
+            self.assertEqual('a:2|x:1', unpickled.as_str())
+            self.assertTrue(unpickled.is_newer(
+                vectorclock.VectorClockRev('a:1|x:1')))
+
+    def test_is_folded(self):
+        self.assertFalse(vectorclock.VectorClockRev('a:2|x:1').is_folded())
+        self.assertTrue(
+            vectorclock.VectorClockRev('retired:5|x:1').is_folded())
+
+    def test_retire_nothing_to_fold(self):
+        vcr = vectorclock.VectorClockRev('retired:5|x:1')
+        vcr.retire(set(['a']))
+        self.assertEqual('retired:5|x:1', vcr.as_str())
+        vcr.retire(set())
+        self.assertEqual('retired:5|x:1', vcr.as_str())
+
+    def test_retire_keeps_order(self):
+        retired = set(['a', 'b'])
+        newer = vectorclock.VectorClockRev('a:2|b:3|x:2')
+        older = vectorclock.VectorClockRev('a:1|b:3|x:1')
+        other = vectorclock.VectorClockRev('a:2|b:3|y:1')
+        for vcr in (newer, older, other):
+            vcr.retire(retired)
+        self.assertTrue(newer.is_newer(older))
+        self.assertFalse(older.is_newer(newer))
+        self.assertFalse(newer.is_newer(other))
+        self.assertFalse(other.is_newer(newer))
+
+    def test_parsed_clocks_are_shared(self):
+        vcr1 = vectorclock.VectorClockRev('x:1|y:2')
+        vcr2 = vectorclock.VectorClockRev('x:1|y:2')
+        self.assertIs(vcr1._clock, vcr2._clock)
+        vcr1.increment('x')
+        self.assertEqual('x:1|y:2', vcr2.as_str())
+
+    def test_parsed_cache_is_bounded(self):
+        self.patch(vectorclock, '_parsed_cache_size', 2)
+        self.patch(vectorclock, '_recent_parsed', {})
+        self.patch(vectorclock, '_old_parsed', {})
+        for counter in range(1, 6):
+            vectorclock.VectorClockRev('x:%d' % (counter,))
+        self.assertEqual(['x:5'], vectorclock._recent_parsed.keys())
+        self.assertEqual(['x:3', 'x:4'],
+                         sorted(vectorclock._old_parsed.keys()))
+
 load_tests = tests.load_with_scenarios
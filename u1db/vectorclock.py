@@ -16,6 +16,44 @@
 
 """VectorClockRev helper class."""
 
+# The component that the counters of retired replicas are folded into.
+RETIRED_REPLICA_UID = 'retired'
+
+
+# Parsed clocks of recently seen rev strings. The same revs are parsed over
+# and over during sync, and the parsed clocks are immutable so they can be
+# shared. This is a two generation approximation of an LRU cache: once the
+# recent generation is full it becomes the old one, and the clocks that are
+# not used again before the next turnover are dropped. Only single dict
+# operations are used, so no lock is needed.
+_parsed_cache_size = 1000
+_recent_parsed = {}
+_old_parsed = {}
+
+
+def _parse(value):
+    """Return the clock of a rev string as a sorted tuple of pairs.
+
+    :param value: A rev string, 'replica_uid:counter|...'.
+    :return: A tuple of (replica_uid, counter) sorted by replica_uid.
+    """
+    global _recent_parsed, _old_parsed
+    clock = _recent_parsed.get(value)
+    if clock is not None:
+        return clock
+    clock = _old_parsed.get(value)
+    if clock is None:
+        counters = {}
+        for replica_info in value.split('|'):
+            replica_uid, counter = replica_info.split(':')
+            counters[replica_uid] = int(counter)
+        clock = tuple(sorted(counters.iteritems()))
+    if len(_recent_parsed) >= _parsed_cache_size:
+        _old_parsed = _recent_parsed
+        _recent_parsed = {}
+    _recent_parsed[value] = clock
+    return clock
+
 
 class VectorClockRev(object):
     """Track vector clocks for multiple replica ids.
@@ -28,48 +66,60 @@ class VectorClockRev(object):
     something greater than the current value.
     """
 
+    __slots__ = ('_clock', '_str')
+
     def __init__(self, value):
-        self._values = self._expand(value)
+        if value is None:
+            self._clock = ()
+        else:
+            self._clock = _parse(value)
+        self._str = None
+
+    def __getstate__(self):
+        return (self._clock, self._str)
+
+    def __setstate__(self, state):
+        self._clock, self._str = state
 
     def __repr__(self):
         s = self.as_str()
         return '%s(%s)' % (self.__class__.__name__, s)
 
     def as_str(self):
-        s = '|'.join(['%s:%d' % (m, r) for m, r
-                      in sorted(self._values.items())])
-        return s
-
-    def _expand(self, value):
-        result = {}
-        if value is None:
-            return result
-        for replica_info in value.split('|'):
-            replica_uid, counter = replica_info.split(':')
-            counter = int(counter)
-            result[replica_uid] = counter
-        return result
+        if self._str is None:
+            self._str = '|'.join(['%s:%d' % (m, r) for m, r in self._clock])
+        return self._str
 
     def is_newer(self, other):
         """Is this VectorClockRev strictly newer than other.
         """
-        if not self._values:
+        this_clock = self._clock
+        other_clock = other._clock
+        if not this_clock:
             return False
-        if not other._values:
+        if not other_clock:
             return True
         this_is_newer = False
-        other_expand = dict(other._values)
-        for key, value in self._values.iteritems():
-            if key in other_expand:
-                other_value = other_expand.pop(key)
-                if other_value > value:
+        # Both clocks are sorted, so walk them side by side.
+        this_len = len(this_clock)
+        i = 0
+        for other_uid, other_counter in other_clock:
+            while True:
+                if i == this_len:
+                    return False
+                replica_uid, counter = this_clock[i]
+                i += 1
+                if replica_uid == other_uid:
+                    break
+                if replica_uid > other_uid:
                     return False
-                elif other_value < value:
-                    this_is_newer = True
-            else:
                 this_is_newer = True
-        if other_expand:
-            return False
+            if other_counter > counter:
+                return False
+            elif other_counter < counter:
+                this_is_newer = True
+        if i < this_len:
+            return True
         return this_is_newer
 
     def increment(self, replica_uid):
@@ -77,13 +127,80 @@ class VectorClockRev(object):
 
         :return: A string representing the new vector clock value
         """
-        self._values[replica_uid] = self._values.get(replica_uid, 0) + 1
+        clock = self._clock
+        for i, (uid, counter) in enumerate(clock):
+            if uid == replica_uid:
+                clock = clock[:i] + ((uid, counter + 1),) + clock[i + 1:]
+                break
+            if uid > replica_uid:
+                clock = clock[:i] + ((replica_uid, 1),) + clock[i:]
+                break
+        else:
+            clock += ((replica_uid, 1),)
+        self._clock = clock
+        self._str = None
 
     def maximize(self, other_vcr):
-        for replica_uid, counter in other_vcr._values.iteritems():
-            if replica_uid not in self._values:
-                self._values[replica_uid] = counter
+        this_clock = self._clock
+        other_clock = other_vcr._clock
+        merged = []
+        i = j = 0
+        this_len = len(this_clock)
+        other_len = len(other_clock)
+        while i < this_len and j < other_len:
+            this_item = this_clock[i]
+            other_item = other_clock[j]
+            if this_item[0] == other_item[0]:
+                merged.append(max(this_item, other_item))
+                i += 1
+                j += 1
+            elif this_item[0] < other_item[0]:
+                merged.append(this_item)
+                i += 1
+            else:
+                merged.append(other_item)
+                j += 1
+        merged.extend(this_clock[i:])
+        merged.extend(other_clock[j:])
+        merged = tuple(merged)
+        if merged != this_clock:
+            self._clock = merged
+            self._str = None
+
+    def is_folded(self):
+        """Does this clock have a RETIRED_REPLICA_UID component."""
+        for replica_uid, counter in self._clock:
+            if replica_uid == RETIRED_REPLICA_UID:
+                return True
+        return False
+
+    def retire(self, replica_uids):
+        """Fold the counters of retired replicas into a single component.
+
+        The sum of their counters is added to the RETIRED_REPLICA_UID
+        component. Clocks folded with the same retired replicas compare as
+        they did before, as long as every clock already included all the
+        changes of those replicas.
+
+        :param replica_uids: A set of replica uids that no longer make
+            changes.
+        """
+        if not replica_uids:
+            return
+        kept = []
+        retired = 0
+        folded = False
+        for replica_uid, counter in self._clock:
+            if replica_uid in replica_uids:
+                folded = True
+                retired += counter
+            elif replica_uid == RETIRED_REPLICA_UID:
+                retired += counter
             else:
-                this_counter = self._values[replica_uid]
-                if this_counter < counter:
-                    self._values[replica_uid] = counter
+                kept.append((replica_uid, counter))
+        if not folded:
+            return
+        kept.append((RETIRED_REPLICA_UID, retired))
+        kept.sort()
+        self._clock = tuple(kept)
+        self._str = None